@@ -0,0 +1,2 @@
+#
+# Benchmarks of f6ifyTCI.py, run from the top directory: python -m bench.bench_f6ifyTCI, python -m bench.bench_jog...
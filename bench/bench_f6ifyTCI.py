@@ -0,0 +1,173 @@
+#
+# Offline benchmark of f6ifyTCI.py: synthetic controller -> midi_rx -> TciLink -> mock TCI server
+# For every gesture it reports the events/s handled, the commands received by the mock server
+# and the latency per stage (see latency.py), everything runs locally without radio nor midi device
+# Usage: python -m bench.bench_f6ifyTCI [--layout DJ|DJS] [--min-eps N] [--max-ptt-p99-ms N] [--meter-rate N]
+# The exit code is 1 if a threshold is not met, so a regression in midi_rx shows up in CI
+
+import argparse
+import asyncio
+import contextlib
+import json
+import os
+import sys
+import tempfile
+import time
+
+import f6ifyTCI as app
+from mock_tci import MockTciServer
+from synthetic_midi import SyntheticController, open_deck, open_link, play_in_thread
+
+async def settle(deck, count, timeout = 10.0):
+    # waits for midi_rx to handle all the events of the gesture
+    end = time.perf_counter() + timeout
+    while deck.events < count and time.perf_counter() < end:
+        await asyncio.sleep(0.001)
+
+class FakeOutput:
+    # the midi output of the synthetic controller, keeps the LED messages and the number of updates
+    def __init__(self):
+        self.messages = []
+        self.updates = 0
+        self.last = 0.0
+
+    def send_message(self, message):
+        now = time.perf_counter()
+        if now - self.last > 0.005:   # the messages of one update are sent together
+            self.updates += 1
+        self.last = now
+        self.messages.append(message)
+
+    def close(self):
+        pass
+
+# a contest band change bound to a button the controllers do not have, pressed by the synthetic controller
+MACRO_BUTTON = (0x9F, 0x7F)
+MACRO = {"bind": {"": ["note_on", MACRO_BUTTON[0] & 0x0F, MACRO_BUTTON[1], "down"]},
+         "steps": [["MODULATION:{rx},CW;", "DDS:{rx},7025000;", "IF:{rx},{subrx},0;", "RX_FILTER_BAND:{rx},-250,250;",
+                    "DRIVE:{rx},50;"], {"wait": ["MODULATION", "{rx}", None, "CW"]}]}
+
+async def run(layout, echo_delay, meter_rate):
+    server = await MockTciServer(port = 0, echo_delay = echo_delay, meter_rate = meter_rate).start()
+    with tempfile.NamedTemporaryFile("w", suffix = ".json", delete = False) as f:
+        json.dump({"bench_macro": MACRO}, f)
+    app.MACRO_FILE = f.name
+    link = await open_link(server.uri)
+    supervisor = asyncio.create_task(link.supervise())
+    ctl = SyntheticController(layout)
+    out = FakeOutput()
+    deck, rx, midi_in = await open_deck(link, ctl.port, open_output = lambda port: out)
+    await asyncio.sleep(0.1)   # the LEDs of the initial state
+    gestures = [("jog spin", ctl.jog_spin(), 1.0), ("long spin", ctl.jog_spin(2000, 0.0005, 0.0015), 1.0),
+                ("RIT spin", ctl.rit_spin(), 1.0),
+                ("crossfader sweep", ctl.fader_sweep(), 1.0), ("volume sweep", ctl.volume_sweep(), 1.0),
+                ("filter pot sweep", ctl.filter_sweep(), 1.0),
+                ("button storm", ctl.button_storm(), 1.0), ("PTT storm", ctl.ptt_storm(), 1.0),
+                ("macro", ctl.button_storm(10, 0.2, MACRO_BUTTON), 1.0),
+                ("jog flood", ctl.flood(), 0)]
+    results = []
+    loop = asyncio.get_running_loop()
+    for name, events, speed in gestures:
+        link.stats.clear()
+        leds, updates = len(out.messages), out.updates
+        moves, retunes, held = link.radio.if_moves, link.radio.dds_retunes, deck.takeover.blocked
+        start = time.perf_counter()
+        thread = play_in_thread(events, midi_in, speed)
+        target = deck.events + len(events)
+        await loop.run_in_executor(None, thread.join)
+        await settle(deck, target)
+        elapsed = time.perf_counter() - start
+        await asyncio.sleep(0.2 + echo_delay)   # the last writes and their echoes
+        results.append((name, len(events), elapsed, server.counts(start),
+                        link.stats.dump() + f"\n{len(out.messages) - leds} LED messages in {out.updates - updates} updates"
+                        f", {link.radio.if_moves - moves} IF moves, {link.radio.dds_retunes - retunes} DDS retunes"
+                        f", {deck.takeover.blocked - held} moves held by the soft takeover", link.stats))
+        if out.updates - updates > app.LED_RATE * (elapsed + 0.2 + echo_delay) + 1:
+            results[-1] = results[-1][:4] + (results[-1][4] + f"\nFAIL: more LED messages than LED_RATE",) + results[-1][5:]
+    # ExpertSDR restarted: the jog goes on while it is away, then the time to the first command accepted
+    link.stats = app.LatencyStats()
+    port = server.port
+    await server.stop()
+    start = time.perf_counter()
+    events = ctl.jog_spin(100) + ctl.ptt_storm(2)
+    thread = play_in_thread(events, midi_in, 1.0)
+    await loop.run_in_executor(None, thread.join)
+    server = await MockTciServer(port = port, echo_delay = echo_delay).start()
+    restarted = time.perf_counter()
+    while ("TCI", "recovery") not in link.stats.histograms and time.perf_counter() < restarted + 5:
+        await asyncio.sleep(0.001)
+    recovery = time.perf_counter() - restarted
+    await asyncio.sleep(0.2 + echo_delay)
+    results.append(("server restart", len(events), time.perf_counter() - start, server.counts(start),
+                    link.stats.dump() + f"\nfrom the restart to the first command accepted: {recovery * 1000:.0f} ms", link.stats))
+    # Hot-plug: the ports are listed every 10 ms (a slow listing of 20 ms) during a PTT storm,
+    # then the controller is unplugged and plugged again under another name
+    rx.cancel()
+    link.stats = app.LatencyStats()
+    ports = [ctl.port]
+    replugged = ctl.port[:-1] + "1"
+    def list_ports():
+        time.sleep(0.02)
+        return list(ports)
+    plugged = {}
+    watcher = app.PortWatcher([(ctl.port[:-2], server.uri, 0)], {server.uri: link},
+                              open_input = lambda port, cb: plugged.__setitem__(port, cb), list_ports = list_ports, open_output = None)
+    polling = asyncio.create_task(watcher.run(0.01))
+    start = time.perf_counter()
+    events = ctl.ptt_storm()
+    for port in (ctl.port, replugged):
+        while port not in plugged:
+            await asyncio.sleep(0.001)
+        thread = play_in_thread(events, plugged[port], 1.0)
+        await loop.run_in_executor(None, thread.join)
+        ports.clear()   # unplugged
+        while port in watcher.decks:
+            await asyncio.sleep(0.001)
+        ports.append(replugged)
+    await asyncio.sleep(0.2 + echo_delay)
+    polling.cancel()
+    results.append(("hot-plug", 2 * len(events), time.perf_counter() - start, server.counts(start),
+                    link.stats.dump() + f"\n{watcher.polls} polls of the ports, {link.sessions} TCI sessions", link.stats))
+    link.shutdown()
+    await supervisor
+    await server.stop()
+    os.remove(f.name)
+    return results
+
+def main():
+    parser = argparse.ArgumentParser(description = "Offline benchmark of f6ifyTCI.py")
+    parser.add_argument("--layout", default = "DJS", choices = ["DJ", "DJS"])
+    parser.add_argument("--echo-delay", type = float, default = 0.0, help = "radio processing time in seconds")
+    parser.add_argument("--min-eps", type = float, default = 0, help = "minimum events/s of the jog flood")
+    parser.add_argument("--max-ptt-p99-ms", type = float, default = 0, help = "maximum p99 from callback to send of TRX")
+    parser.add_argument("--meter-rate", type = float, default = 0, help = "RX_SMETER messages per second sent by the mock server")
+    parser.add_argument("--max-recovery-ms", type = float, default = 1000, help = "maximum time from a server restart to the first command accepted")
+    args = parser.parse_args()
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        results = asyncio.run(run(args.layout, args.echo_delay, args.meter_rate))
+    failed = False
+    for name, count, elapsed, counts, dump, stats in results:
+        eps = count / elapsed
+        sent = ", ".join(f"{n} {c}" for n, c in sorted(counts.items())) or "none"
+        print(f"== {name}: {count} events in {elapsed * 1000:.0f} ms, {eps:.0f} events/s, {sum(counts.values())} commands ({sent})")
+        print(dump)
+        if "FAIL:" in dump:
+            failed = True
+        if name == "jog flood" and eps < args.min_eps:
+            print(f"FAIL: {eps:.0f} events/s is below {args.min_eps:.0f}")
+            failed = True
+        trx = stats.histograms.get(("TRX", "total"))
+        if name in ("PTT storm", "hot-plug") and args.max_ptt_p99_ms and trx and trx.percentile(0.99) * 1000 > args.max_ptt_p99_ms:
+            print(f"FAIL: PTT p99 {trx.percentile(0.99) * 1000:.2f} ms is above {args.max_ptt_p99_ms} ms")
+            failed = True
+        if name == "hot-plug" and counts.get("TRX", 0) != count:
+            print(f"FAIL: {counts.get('TRX', 0)} PTT commands for {count} PTT events")
+            failed = True
+        recovery = stats.histograms.get(("TCI", "recovery"))
+        if name == "server restart" and (recovery is None or recovery.max * 1000 > args.max_recovery_ms):
+            print(f"FAIL: no recovery under {args.max_recovery_ms} ms")
+            failed = True
+    sys.exit(1 if failed else 0)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,129 @@
+#
+# Benchmark of the snap to signal of f6ifyTCI.py (iq_peaks.py)
+# 1. CPU: synthetic IQ packets at the highest IQ rate of ExpertSDR go through iq_samples() and the PeakDetector,
+#    on the clock of the stream, the CPU time per second of stream is the load on the event loop
+# 2. Accuracy: the carriers found are compared with the synthetic ones
+# 3. End to end: the mock TCI server streams IQ with carriers, the Starlight snap buttons tune to them
+# Usage: python -m bench.bench_iq [--seconds N] [--max-cpu N]
+# The exit code is 1 if the CPU is above the limit (5 % of one core by default), a carrier is missed or a snap is wrong
+
+import argparse
+import asyncio
+import contextlib
+import os
+import sys
+import time
+
+import numpy as np
+from eesdr_tci.tci import TciDataPacket, TciSampleType, TciStreamType
+
+import f6ifyTCI as app
+from iq_peaks import PeakDetector, iq_samples
+from mock_tci import MockTciServer
+from synthetic_midi import SyntheticController, open_deck, open_link, play
+
+PACKET = 2048
+CARRIERS = [(-61234.5, -40), (-6600.0, -55), (-3270.0, -70), (1150.0, -45), (6020.5, -60), (90000.0, -50)]
+# carriers of the end to end run, around the 14025000 DDS of the mock server, the last one is near the edge
+RF_CARRIERS = [(14018400, -40), (14021730, -50), (14026150, -35), (14031020, -45), (14065000, -45)]
+SNAP_UP, SNAP_DOWN = (0x9F, 0x7D), (0x9F, 0x7C)    # buttons the Starlight does not have
+
+def in_span(rate):
+    # the carriers inside the IQ span, ExpertSDR filters the others out
+    return [(f, db) for f, db in CARRIERS if abs(f) < rate * 0.45]
+
+def packets(rate, seconds, fmt = TciSampleType.FLOAT32):
+    # the binary frames of ExpertSDR, carriers and noise
+    rng = np.random.default_rng(1)
+    n = int(rate * seconds) // PACKET * PACKET
+    t = np.arange(n) / rate
+    iq = sum(10 ** (db / 20) * np.exp(2j * np.pi * f * t) for f, db in in_span(rate))
+    iq = iq + (rng.standard_normal(n) + 1j * rng.standard_normal(n)) * 1e-3
+    values = iq.astype(np.complex64).view(np.float32)
+    if fmt == TciSampleType.INT16:
+        values = (values * 32767).astype(np.int16)
+    frames = []
+    for i in range(0, 2 * n, 2 * PACKET):
+        frames.append(TciDataPacket(0, rate, fmt, 0, 0, 2 * PACKET, TciStreamType.IQ_STREAM, 2,
+                                    values[i:i + 2 * PACKET].tobytes()).to_bytes())
+    return frames
+
+def cpu_run(rate, seconds, fmt):
+    detector = PeakDetector()
+    frames = packets(rate, seconds, fmt)
+    clock = 0.0
+    start = time.process_time()
+    for frame in frames:
+        _, sample_rate, samples = iq_samples(frame)
+        clock += len(samples) / sample_rate
+        detector.feed(samples, sample_rate, clock)
+    cpu = (time.process_time() - start) / (len(frames) * PACKET / rate)
+    return detector, cpu, clock
+
+def missed_carriers(detector, rate):
+    # the synthetic carriers without a peak within one bin, and the peaks of no carrier
+    bin_hz = rate / detector.fft_size
+    found = list(detector.peaks)
+    truth = [f for f, _ in in_span(rate)]
+    missed = [f for f in truth if not any(abs(p - f) <= bin_hz for p in found)]
+    extra = [p for p in found if not any(abs(p - f) <= bin_hz for f in truth)]
+    errors = [min(abs(p - f) for p in found) for f in truth if f not in missed]
+    return missed, extra, max(errors, default = 0.0)
+
+async def snap_run(rate):
+    server = await MockTciServer(port = 0, iq_carriers = RF_CARRIERS).start()
+    link = await open_link(server.uri, lambda link: app.enable_iq_snap(link, rate))
+    ctl = SyntheticController("DJS")
+    app.MAPPINGS["DJControl Starlight"] = app.DJS_MAP + [("note_on", SNAP_UP[0] & 0x0F, SNAP_UP[1], "down", "snap_up"),
+                                                         ("note_on", SNAP_DOWN[0] & 0x0F, SNAP_DOWN[1], "down", "snap_down")]
+    _, rx, midi_in = await open_deck(link, ctl.port)
+    await asyncio.sleep(0.5)    # the first spectra
+    snap = (0x96, app.DJS.BTN_3L)
+    steps = [(SNAP_UP, 14026150), (SNAP_UP, 14031020), (SNAP_UP, 14065000), (SNAP_UP, 14065000),
+             (SNAP_DOWN, 14031020), (SNAP_DOWN, 14026150), (snap, 14026150)]
+    results = []
+    for button, expected in steps:
+        if button is snap:      # 700 Hz away from the carrier, the snap puts the VFO back on it
+            play(ctl.jog_spin(7, direction = -1), midi_in, 1.0)
+            await asyncio.sleep(0.4)
+        since = time.perf_counter()
+        play([(0, (button[0], button[1], app.MIDI.KEYDOWN)), (0.01, (button[0], button[1], app.MIDI.KEYUP))], midi_in, 0)
+        await asyncio.sleep(0.4)
+        vfo = int(server.state[("VFO", 0, 0)][0])
+        results.append((expected, vfo, server.counts(since)))
+    rx.cancel()
+    link.shutdown()
+    count = server.iq_packets
+    await server.stop()
+    return results, count
+
+def main():
+    parser = argparse.ArgumentParser(description = "Snap to signal of f6ifyTCI.py")
+    parser.add_argument("--seconds", type = float, default = 10.0, help = "seconds of IQ stream for the CPU run")
+    parser.add_argument("--max-cpu", type = float, default = 5.0, help = "maximum CPU in % of one core at the full IQ rate")
+    args = parser.parse_args()
+    failed = False
+    for rate, fmt in ((384000, TciSampleType.FLOAT32), (384000, TciSampleType.INT16), (48000, TciSampleType.FLOAT32)):
+        detector, cpu, clock = cpu_run(rate, args.seconds, fmt)
+        missed, extra, error = missed_carriers(detector, rate)
+        print(f"== {rate} Hz {fmt.name}: {cpu * 100:.2f} % of one core, {detector.ffts} spectra in {clock:.1f} s, "
+              f"{len(detector.peaks)} peaks, largest error {error:.1f} Hz (bin {rate / detector.fft_size:.1f} Hz)")
+        if cpu * 100 > args.max_cpu:
+            print(f"FAIL: CPU above {args.max_cpu} %")
+            failed = True
+        if missed or extra:
+            print(f"FAIL: carriers missed {missed}, peaks of no carrier {extra}")
+            failed = True
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        results, count = asyncio.run(snap_run(96000))
+    print(f"== snap buttons, {count} IQ packets from the mock server")
+    for expected, vfo, counts in results:
+        writes = {k: v for k, v in counts.items() if k in ("IF", "DDS")}
+        print(f"VFO {vfo} (carrier {expected}), commands {writes}")
+        if abs(vfo - expected) > 10 or counts.get("IF", 0) > 2:
+            print("FAIL: wrong snap")
+            failed = True
+    sys.exit(1 if failed else 0)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,71 @@
+#
+# Benchmark of the jog acceleration of f6ifyTCI.py (JOG_ACCEL)
+# The Starlight jog is spun at a constant speed, slow, medium and fast, with and without the acceleration,
+# through midi_rx to the mock TCI server: the midi events and the DDS/IF commands needed per 100 kHz moved
+# Usage: python -m bench.bench_jog [--ticks N]
+# The exit code is 1 if a slow spin does not move by exactly vfo_step per tick with the acceleration,
+# or if the fast spin does not need at least 10 times fewer events per 100 kHz with it
+
+import argparse
+import asyncio
+import contextlib
+import os
+import sys
+import time
+
+import f6ifyTCI as app
+from mock_tci import MockTciServer
+from synthetic_midi import SyntheticController, open_deck, open_link, play_in_thread
+
+SPINS = [("slow", 0.020), ("medium", 0.005), ("fast", 0.001)]   # seconds per tick
+
+async def spin(link, server, deck, callback, ctl, ticks, interval):
+    vfo = int(server.state[("VFO", 0, 0)][0])
+    start = time.perf_counter()
+    thread = play_in_thread(ctl.jog_spin(ticks, interval, interval), callback, 1.0)
+    await asyncio.get_running_loop().run_in_executor(None, thread.join)
+    await asyncio.sleep(0.3)    # the last writes and their echoes, the jog is idle again
+    counts = server.counts(start)
+    return int(server.state[("VFO", 0, 0)][0]) - vfo, counts.get("IF", 0) + counts.get("DDS", 0)
+
+async def run(ticks):
+    server = await MockTciServer(port = 0).start()
+    link = await open_link(server.uri)
+    ctl = SyntheticController("DJS")
+    deck, rx, midi_in = await open_deck(link, ctl.port)
+    results = []
+    for accel in (False, True):
+        app.JOG_ACCEL = accel
+        for name, interval in SPINS:
+            n = ticks if interval < 0.01 else ticks // 5
+            moved, commands = await spin(link, server, deck, midi_in, ctl, n, interval)
+            results.append((accel, name, n, interval, moved, commands))
+    rx.cancel()
+    link.shutdown()
+    await server.stop()
+    return results, deck.vfo_step
+
+def main():
+    parser = argparse.ArgumentParser(description = "Jog acceleration of f6ifyTCI.py")
+    parser.add_argument("--ticks", type = int, default = 1000, help = "ticks of the medium and fast spins")
+    args = parser.parse_args()
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        results, vfo_step = asyncio.run(run(args.ticks))
+    failed = False
+    per_100k = {}
+    for accel, name, n, interval, moved, commands in results:
+        events = n * 100000 / moved if moved else float("inf")
+        writes = commands * 100000 / moved if moved else float("inf")
+        per_100k[(accel, name)] = events
+        print(f"{'accel' if accel else 'fixed'} {name:6} {1 / interval:5.0f} ticks/s: {n} events moved {moved} Hz, "
+              f"{commands} commands; per 100 kHz {events:.0f} events, {writes:.0f} commands")
+        if accel and name == "slow" and moved != n * vfo_step:
+            print(f"FAIL: a slow spin must move {n * vfo_step} Hz (vfo_step {vfo_step} Hz per tick)")
+            failed = True
+    if per_100k[(True, "fast")] * 10 > per_100k[(False, "fast")]:
+        print("FAIL: the acceleration does not divide the events per 100 kHz of a fast spin by 10")
+        failed = True
+    sys.exit(1 if failed else 0)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,140 @@
+#
+# Benchmark of the CW keyer of f6ifyTCI.py under load
+# A memory is keyed here (local mode) while the jog is spun as fast as possible and the mock TCI server sends
+# meters, then a straight key is played by a synthetic button. The jitter is the lateness of every KEYER
+# command on its deadline, seen by the keyer and by the mock server (error of the element lengths)
+# The mock server runs in its own process so its clock is not delayed by the load it measures, on a single
+# CPU its own scheduling is in the error of the element lengths
+# The keyer cannot be more on time than the timers of the system: their lateness is measured first, idle, in a
+# process like the keyer's (on a virtual machine they may wake up several ms late)
+# Usage: python -m bench.bench_keyer [--wpm N] [--max-jitter-ms N]
+# The exit code is 1 if the p99 of the keyer lateness is above the latest timer plus the limit (3 ms by default)
+
+import argparse
+import asyncio
+import contextlib
+import multiprocessing
+import os
+import sys
+import time
+
+import f6ifyTCI as app
+from cw_keyer import CwKeyer, elements, realtime_priority
+from latency import Histogram
+from mock_tci import MockTciServer
+from synthetic_midi import SyntheticController, open_deck, open_link, play_in_thread
+
+TEXT = "CQ TEST F6IFY F6IFY TEST"
+STRAIGHT_KEY = (0x9F, 0x7E)
+
+def serve(port, meter_rate, stop, results):
+    # the mock server in a child process, the commands received are sent back when stop is set
+    async def main():
+        server = await MockTciServer(port = 0, meter_rate = meter_rate).start()
+        port.put(server.port)
+        while not stop.is_set():
+            await asyncio.sleep(0.05)
+        results.put(server.received)
+        await server.stop()
+    asyncio.run(main())
+
+def timer_lateness(results, count = 300):
+    # lateness of the wake up of a wait on a pipe, as in keyer_process, for waits of 1 to 40 ms
+    realtime_priority()
+    conn, _ = multiprocessing.Pipe()
+    h = Histogram()
+    for i in range(count):
+        wait = 0.001 * (1 + i % 40)
+        start = time.perf_counter()
+        conn.poll(wait)
+        h.record(time.perf_counter() - start - wait)
+    results.put((h.percentile(0.5), h.percentile(0.99), h.max))
+
+def element_errors(received, since, until, expected):
+    # |measured - expected| of the time between two KEYER commands received by the server
+    times = [t for t, cmd in received if since <= t < until and cmd.startswith("KEYER")]
+    h = Histogram()
+    for i in range(1, min(len(times), len(expected))):
+        h.record(abs((times[i] - times[i - 1]) - (expected[i] - expected[i - 1])))
+    return h, len(times)
+
+async def run(wpm, uri):
+    link = await open_link(uri)
+    loop = asyncio.get_running_loop()
+    keyer = CwKeyer(uri, wpm, "local", link.stats)
+    await loop.run_in_executor(None, keyer.start)
+    link.keyer = keyer
+    ctl = SyntheticController("DJS")
+    # a button the Starlight does not have is the straight key of the bench
+    app.MAPPINGS["DJControl Starlight"] = app.DJS_MAP + [("note_on", STRAIGHT_KEY[0] & 0x0F, STRAIGHT_KEY[1], None, "cw_key")]
+    deck, rx, midi_in = await open_deck(link, ctl.port)
+    # memory under a jog flood
+    expected = [t for t, _ in elements(TEXT, wpm)]
+    start = time.perf_counter()
+    keyer.memory(0, TEXT)
+    flood = play_in_thread(ctl.flood(200000), midi_in, 0)
+    await asyncio.sleep(expected[-1] + 0.1)
+    await loop.run_in_executor(None, flood.join)
+    runs = [("memory + jog flood", start, time.perf_counter(), expected)]
+    # straight key: the button is pressed like a hand keying dits and dahs, while the jog spins
+    key_events = []
+    dit = 1.2 / wpm
+    for symbol in "-.-.--.-" * 4:
+        key_events.append((dit, (STRAIGHT_KEY[0], STRAIGHT_KEY[1], app.MIDI.KEYDOWN)))
+        key_events.append((dit if symbol == "." else 3 * dit, (STRAIGHT_KEY[0], STRAIGHT_KEY[1], app.MIDI.KEYUP)))
+    start = time.perf_counter()
+    spin = play_in_thread(ctl.jog_spin(2000, 0.0005, 0.001), midi_in, 1.0)
+    hand = play_in_thread(key_events, midi_in, 1.0)
+    await loop.run_in_executor(None, hand.join)
+    await loop.run_in_executor(None, spin.join)
+    await asyncio.sleep(0.1)
+    expected, t = [], 0.0
+    for delay, _ in key_events:
+        t += delay
+        expected.append(t)
+    runs.append(("straight key + jog", start, time.perf_counter(), expected))
+    rx.cancel()
+    keyer.close()
+    link.shutdown()
+    return runs, keyer
+
+def main():
+    parser = argparse.ArgumentParser(description = "CW keyer jitter of f6ifyTCI.py")
+    parser.add_argument("--wpm", type = int, default = 30)
+    parser.add_argument("--max-jitter-ms", type = float, default = 3.0, help = "maximum p99 of the keyer lateness")
+    args = parser.parse_args()
+    timers = multiprocessing.Queue()
+    calibration = multiprocessing.Process(target = timer_lateness, args = (timers,), daemon = True)
+    calibration.start()
+    timer_p50, timer_p99, timer_max = timers.get(timeout = 60)
+    calibration.join()
+    print(f"timers of the system, idle: late by p50 {timer_p50 * 1000:.2f} ms, p99 {timer_p99 * 1000:.2f} ms, "
+          f"max {timer_max * 1000:.2f} ms")
+    port, results, stop = multiprocessing.Queue(), multiprocessing.Queue(), multiprocessing.Event()
+    server = multiprocessing.Process(target = serve, args = (port, 200, stop, results), daemon = True)
+    server.start()
+    uri = f"ws://127.0.0.1:{port.get(timeout = 10)}"
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        runs, keyer = asyncio.run(run(args.wpm, uri))
+    stop.set()
+    received = results.get(timeout = 10)
+    server.join()
+    failed = False
+    for name, start, end, expected in runs:
+        h, count = element_errors(received, start, end, expected)
+        print(f"== {name}: {count} KEYER commands, element length error p50 {h.percentile(0.5) * 1000:.2f} ms, "
+              f"p99 {h.percentile(0.99) * 1000:.2f} ms, max {h.max * 1000:.2f} ms")
+        if count < len(expected):
+            print(f"FAIL: {len(expected)} KEYER commands expected")
+            failed = True
+    j = keyer.jitter
+    print(f"keyer lateness on its deadlines: p50 {j.percentile(0.5) * 1000:.2f} ms, p99 {j.percentile(0.99) * 1000:.2f} ms, "
+          f"max {j.max * 1000:.2f} ms, {keyer.errors} errors")
+    limit = args.max_jitter_ms + timer_max * 1000
+    if j.count == 0 or j.percentile(0.99) * 1000 > limit:
+        print(f"FAIL: p99 above {limit:.2f} ms ({args.max_jitter_ms} ms over the timers of the system)")
+        failed = True
+    sys.exit(1 if failed else 0)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,91 @@
+#
+# Microbenchmark of the midi input of f6ifyTCI.py
+# Compare the mido path (a mido Message built for every event, then stringified to find its type)
+# with the raw path (the 3 midi bytes as a tuple, decoded with the precomputed status tables)
+# Usage: python -m bench.bench_midi [number of events]
+# No midi device is needed, the events are injected in the input callback by a thread
+
+import asyncio
+import sys
+import threading
+import time
+from collections import deque
+
+import mido
+
+import f6ifyTCI as app
+
+def synthetic_events(count):
+    # A jog spin on the Starlight with a few buttons in the middle
+    events = []
+    for i in range(count):
+        if i % 50 == 49:
+            events.append((0x96, app.DJS.BTN_2, 127 if i % 100 == 49 else 0))
+        else:
+            events.append((0xB1, app.DJS.JOG, app.MIDI.ENCUP))
+    return events
+
+def msg_key(msg):
+    # the way midi_rx decoded a mido Message before the raw input
+    kind = str(msg)[0:7]
+    if kind == "control":
+        return (app.CONTROL_CHANGE | msg.channel, msg.control, None)
+    if kind == "note_on":
+        return (app.NOTE_ON | msg.channel, msg.note, app.VEL_CLASS[msg.velocity])
+    return None
+
+async def run(path, events, pace = 0):
+    dispatch = app.MidiMap(app.DJS_MAP).dispatch
+    cb, stream = app.midi_stream(ring = app.MidiRing(len(events) + 1))   # no jog summing and never full, every event is measured
+    stamps = deque()
+    if path == "mido":
+        parser = mido.Parser()
+        key = msg_key
+        def feed(data):
+            parser.feed(data)        # what the mido rtmidi backend does for every event
+            for msg in parser:
+                cb(msg)
+    else:
+        key = app.midi_key
+        def feed(data):
+            cb((data[0], data[1], data[2], time.perf_counter()))
+
+    def producer():
+        next_t = time.perf_counter()
+        for data in events:
+            if pace:
+                next_t += pace
+                while time.perf_counter() < next_t:
+                    pass
+            stamps.append(time.perf_counter())
+            feed(data)
+
+    latencies = []
+    thread = threading.Thread(target = producer)
+    start = time.perf_counter()
+    thread.start()
+    async for ev, ticks in stream:
+        latencies.append(time.perf_counter() - stamps.popleft())
+        dispatch.get(key(ev))
+        if len(latencies) == len(events):
+            break
+    elapsed = time.perf_counter() - start
+    thread.join()
+    latencies.sort()
+    n = len(latencies)
+    return n / elapsed, latencies[n // 2], latencies[int(n * 0.99)], latencies[-1]
+
+def report(title, res):
+    eps, p50, p99, worst = res
+    print(f"{title:28s} {eps:10.0f} events/s   latency p50 {p50 * 1e6:7.1f} us  p99 {p99 * 1e6:7.1f} us  max {worst * 1e6:8.1f} us")
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    events = synthetic_events(count)
+    paced = events[:min(count, 5000)]
+    for path in ("mido", "raw"):
+        report(f"{path} flood", asyncio.run(run(path, events)))
+        report(f"{path} 1000 events/s", asyncio.run(run(path, paced, pace = 0.001)))
+
+if __name__ == "__main__":
+    main()
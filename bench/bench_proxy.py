@@ -0,0 +1,144 @@
+#
+# Benchmark of the TCI proxy of f6ifyTCI.py (tci_proxy.py)
+# The mock TCI server is slow to answer (handshake delay) and sends meters at a high rate, three clients connect
+# to the proxy: the time to their READY is compared with a direct connection, a write of one client is echoed
+# to the others, a read is answered from the cache, the meters and the IQ stream go only where they are wanted.
+# Then a fourth client asks for IQ and stops reading: its packets are dropped, not kept in memory, and the
+# malformed commands of another client are dropped without closing its connection or changing the state
+# Usage: python -m bench.bench_proxy [--handshake-delay-ms N]
+# The exit code is 1 if a client waits longer than 50 ms for its READY or a message goes to the wrong place
+
+import argparse
+import asyncio
+import contextlib
+import os
+import socket
+import sys
+import time
+
+import websockets
+
+import f6ifyTCI as app
+from mock_tci import MockTciServer
+from synthetic_midi import open_link
+from tci_proxy import TciProxy
+
+async def connect(uri, sock = None):
+    # a TCI client: the time to READY, then everything it receives
+    start = time.perf_counter()
+    ws = await websockets.connect(uri, sock = sock)
+    messages = []
+    while True:
+        msg = await ws.recv()
+        messages.append(msg)
+        if msg == "READY;":
+            return ws, time.perf_counter() - start, messages
+
+async def collect(ws, messages, seconds):
+    with contextlib.suppress(asyncio.TimeoutError):
+        end = time.perf_counter() + seconds
+        while True:
+            messages.append(await asyncio.wait_for(ws.recv(), max(end - time.perf_counter(), 0.001)))
+
+def count(messages, prefix):
+    return sum(1 for m in messages if isinstance(m, str) and m.startswith(prefix))
+
+def binary(messages):
+    return sum(1 for m in messages if isinstance(m, bytes))
+
+async def run(handshake_delay):
+    server = await MockTciServer(port = 0, meter_rate = 200, handshake_delay = handshake_delay,
+                                 iq_carriers = [(14026000, -40)]).start()
+    ws, direct, dump = await connect(server.uri)
+    await ws.close()
+    async def share(link):
+        link.proxy = await TciProxy(link, port = 0, meter_rate = 5).start()
+    link = await open_link(server.uri, share)
+    uri = f"ws://127.0.0.1:{link.proxy.port}"
+    clients = [await connect(uri) for _ in range(3)]
+    (a, _, got_a), (b, _, got_b), (c, _, got_c) = clients
+    failed = []
+    lines = {m for m in dump if isinstance(m, str)}
+    missing = [m for m in lines if m not in set(got_a) and not m.startswith("RX_SMETER")]
+    if missing:
+        failed.append(f"state missing from the proxy dump: {missing[:5]}")
+    # a write of a client, echoed by ExpertSDR to every client; a read answered by the proxy
+    since = time.perf_counter()
+    await a.send("DDS:0,14030000;")
+    await b.send("DDS:0;")
+    await c.send("RX_SENSORS_ENABLE:true,50;IQ_START:0;")
+    marks = [len(got) for _, _, got in clients]
+    await asyncio.gather(*(collect(ws, got, 1.0) for ws, _, got in clients))
+    new = [got[n:] for (_, _, got), n in zip(clients, marks)]
+    counts = server.counts(since)
+    if "DDS:0,14030000;" not in new[1] or "DDS:0,14030000;" not in new[2]:
+        failed.append("the write of a client is not echoed to the others")
+    if counts.get("DDS") != 1:
+        failed.append(f"{counts.get('DDS', 0)} DDS commands upstream, 1 expected (the read is answered by the proxy)")
+    meters = [count(n, "RX_SMETER") for n in new]
+    iq = [binary(n) for n in new]
+    if not meters[0] <= 7 or not meters[2] >= 15 or iq[0] or iq[1] or not iq[2]:
+        failed.append("meters or IQ sent to the wrong clients")
+    # a stalled client (small receive window, stops reading), the IQ at the highest rate of ExpertSDR
+    link.proxy.stream_buffer = 64 * 1024
+    sock = socket.socket()
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4096)
+    sock.connect(("127.0.0.1", link.proxy.port))
+    d, _, _ = await connect(uri, sock)
+    await d.send("IQ_SAMPLERATE:384000;IQ_START:0;")
+    await asyncio.sleep(0.1)
+    d.transport.pause_reading()
+    stalled = next(p for p in link.proxy.clients if p.ws.remote_address == d.local_address)
+    if_before = app.default_radio.state.get("IF", 0, 0)
+    await a.send("DDS:x;IF:0,0,abc;")
+    filtered, mark = link.proxy.filtered, len(got_c)
+    await collect(c, got_c, 2.0)
+    await a.send("DDS:0;")
+    mark_a = len(got_a)
+    await collect(a, got_a, 0.3)
+    buffered = stalled.ws.transport.get_write_buffer_size()
+    iq_c, filtered = binary(got_c[mark:]), link.proxy.filtered - filtered
+    # without the limit every packet the reading client got would be waiting for the stalled one
+    if buffered > 2 * link.proxy.stream_buffer or iq_c * 16384 < 4 * link.proxy.stream_buffer:
+        failed.append(f"stalled client: {buffered} bytes waiting, {iq_c} IQ packets to the client reading")
+    if not any(m.startswith("DDS:0,") for m in got_a[mark_a:]):
+        failed.append("the connection of a client is lost after a malformed command")
+    if link.proxy.rejected != 2 or app.default_radio.state.get("IF", 0, 0) != if_before:
+        failed.append(f"{link.proxy.rejected} malformed commands rejected, 2 expected, IF {app.default_radio.state.get('IF', 0, 0)}")
+    await d.close()
+    await c.close()
+    await asyncio.sleep(0.2)
+    stopped = server.counts(since).get("IQ_STOP", 0)
+    if not stopped:
+        failed.append("the IQ stream is not stopped when its last client leaves")
+    report = [f"READY: direct {direct * 1000:.0f} ms, through the proxy "
+              + ", ".join(f"{t * 1000:.1f} ms" for _, t, _ in clients),
+              f"upstream connections {len(server.clients)}, commands upstream {counts}",
+              f"RX_SMETER in 1 s per client {meters}, IQ packets {iq}, forwarded {link.proxy.forwarded}, "
+              f"filtered {link.proxy.filtered}",
+              f"stalled client: {buffered} bytes waiting in the proxy while the client reading got {iq_c} IQ packets "
+              f"in 2 s, filtered +{filtered} (its IQ and the meters of all), malformed commands rejected {link.proxy.rejected}"]
+    if max(t for _, t, _ in clients) > 0.05:
+        failed.append("a client waited more than 50 ms for READY")
+    if len(server.clients) != 1:
+        failed.append(f"{len(server.clients)} connections to the server, the link only expected")
+    await a.close()
+    await b.close()
+    link.shutdown()
+    await link.proxy.stop()
+    await server.stop()
+    return report, failed
+
+def main():
+    parser = argparse.ArgumentParser(description = "TCI proxy of f6ifyTCI.py")
+    parser.add_argument("--handshake-delay-ms", type = float, default = 300)
+    args = parser.parse_args()
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        report, failed = asyncio.run(run(args.handshake_delay_ms / 1000))
+    print("\n".join(report))
+    for f in failed:
+        print("FAIL:", f)
+    sys.exit(1 if failed else 0)
+
+if __name__ == "__main__":
+    main()
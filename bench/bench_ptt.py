@@ -0,0 +1,111 @@
+#
+# Benchmark of the PTT latency of f6ifyTCI.py while the jog is saturated
+# A thread spins the Starlight jog as fast as it can, another one presses and releases the PTT (BTN_3 channel 6)
+# every 20 ms, the time from the midi callback to the websocket send of each TRX command is measured
+# Usage: python -m bench.bench_ptt [seconds]
+# The exit code is 1 if the p99 is above 5 ms, no radio and no midi device are needed
+
+import asyncio
+import contextlib
+import os
+import sys
+import threading
+import time
+from collections import deque
+
+import f6ifyTCI as app
+
+LIMIT_P99 = 0.005
+
+def fill_state():
+    # The few parameters the Starlight handlers read, as ExpertSDR would send them
+    for name, rx, subrx, value in [("IF_LIMITS", None, None, [-48000, 48000]), ("MUTE", None, None, False),
+                                   ("DDS", 0, None, 14000000), ("MODULATION", 0, None, "CW"), ("RIT_OFFSET", 0, None, 0),
+                                   ("RX_MUTE", 0, None, False), ("IF", 0, 0, 0), ("IF", 0, 1, 0),
+                                   ("VFO", 0, 0, 14000000), ("VFO", 0, 1, 14000000)]:
+        app.update_params(name, rx, subrx, value)
+
+class FakeWebSocket:
+    def __init__(self, send_cost):
+        self.send_cost = send_cost
+        self.sent = 0
+        self.on_send = None
+
+    async def send(self, cmd):
+        end = time.perf_counter() + self.send_cost
+        while time.perf_counter() < end:   # the write of the frame
+            pass
+        self.sent += 1
+        self.on_send(cmd)
+        await asyncio.sleep(0)
+
+async def run(seconds, send_cost = 0.0002):
+    fill_state()
+    callbacks = []
+    def fake_input(midi_port, callback):
+        callbacks.append(callback)
+    link = app.TciLink("ws://bench")
+    ws = FakeWebSocket(send_cost)
+    presses = deque()
+    latencies = []
+    counts = {"jog": 0, "DDS": 0, "IF": 0}
+    def on_send(cmd):
+        name = app.command_name(cmd)
+        if name == "TRX":
+            latencies.append(time.perf_counter() - presses.popleft())
+        elif name in counts:
+            counts[name] += 1
+    ws.on_send = on_send
+    link._ready_event = asyncio.Event()  # no handshake with the fake websocket
+    link._ready_event.set()
+    link.connected = True
+    sender = asyncio.create_task(link._sender_main(ws))
+    rx = asyncio.create_task(app.midi_rx(link, "DJControl Starlight 0", open_input = fake_input))
+    while not callbacks:
+        await asyncio.sleep(0.01)
+    cb = callbacks[0]
+    stop = threading.Event()
+
+    def jog():
+        while not stop.is_set():
+            cb((0xB1, app.DJS.JOG, app.MIDI.ENCUP, time.perf_counter()))
+            counts["jog"] += 1
+            time.sleep(0.0001)
+
+    def ptt():
+        velocity = 127
+        while not stop.is_set():
+            time.sleep(0.02)
+            presses.append(time.perf_counter())
+            cb((0x96, app.DJS.BTN_3, velocity, time.perf_counter()))
+            velocity = 127 - velocity
+
+    threads = [threading.Thread(target = jog), threading.Thread(target = ptt)]
+    for t in threads:
+        t.start()
+    await asyncio.sleep(seconds)
+    stop.set()
+    for t in threads:
+        t.join()
+    await asyncio.sleep(0.1)
+    rx.cancel()
+    sender.cancel()
+    return latencies, counts, ws.sent, link.stats
+
+def main():
+    seconds = float(sys.argv[1]) if len(sys.argv) > 1 else 5
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        latencies, counts, sent, stats = asyncio.run(run(seconds))
+    latencies.sort()
+    n = len(latencies)
+    p50 = latencies[n // 2]
+    p99 = latencies[int(n * 0.99)]
+    print(f"{counts['jog']} jog events, {counts['DDS']} DDS and {counts['IF']} IF writes, {sent} commands sent")
+    print(f"{n} PTT presses/releases: p50 {p50 * 1000:.2f} ms  p99 {p99 * 1000:.2f} ms  max {latencies[-1] * 1000:.2f} ms")
+    print(stats.dump())
+    if p99 > LIMIT_P99:
+        print(f"FAIL: p99 above {LIMIT_P99 * 1000:.0f} ms")
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
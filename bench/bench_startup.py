@@ -0,0 +1,81 @@
+#
+# Startup time of f6ifyTCI.py: from the process start to the first midi event handled
+# main() runs in a child process against the mock TCI server, whose handshake is slowed down like ExpertSDR,
+# and its synthetic midi input sends a jog tick as soon as it is opened
+# Usage: python -m bench.bench_startup [runs] [handshake delay in seconds]
+
+import asyncio
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+def child(uri, snapshot, t0):
+    # the time of the imports is part of the measure
+    import f6ifyTCI as app
+    times = {"imported": time.time() - t0}
+    app.STATE_SNAPSHOT = snapshot or None
+    handler = app.HANDLERS["freq_scroll"]
+    def first_handler(deck, value, ticks):
+        times.setdefault("first_event", time.time() - t0)
+        return handler(deck, value, ticks)
+    app.HANDLERS["freq_scroll"] = first_handler
+    handshake = app.TciLink.handshake
+    async def timed_handshake(self, timeout = None):
+        await handshake(self, timeout)
+        times.setdefault("ready", time.time() - t0)
+    app.TciLink.handshake = timed_handshake
+    def fake_input(port, callback):
+        threading.Thread(target = callback, args = ((0xB1, app.DJS.JOG, app.MIDI.ENCUP, time.perf_counter()),)).start()
+    async def run():
+        task = asyncio.create_task(app.main(uri, "DJControl Starlight 0", open_input = fake_input,
+                                            list_ports = lambda: ["DJControl Starlight 0"], open_output = None))
+        while len(times) < 3:
+            await asyncio.sleep(0.001)
+        task.cancel()   # main() saves the snapshot on its way out
+        try:
+            await task
+        except asyncio.CancelledError:
+            pass
+    with open(os.devnull, "w") as devnull:
+        sys.stdout = devnull
+        asyncio.run(run())
+        sys.stdout = sys.__stdout__
+    print(json.dumps(times))
+
+def measure(uri, snapshot, runs):
+    res = []
+    for _ in range(runs):
+        t0 = time.time()
+        out = subprocess.run([sys.executable, "-m", __spec__.name, "--child", uri, snapshot, str(t0)],
+                             capture_output = True, text = True, timeout = 60)
+        if out.returncode:
+            sys.exit(out.stderr)
+        res.append(json.loads(out.stdout.strip().splitlines()[-1]))
+    return res
+
+async def bench(runs, handshake_delay):
+    from mock_tci import MockTciServer
+    server = await MockTciServer(port = 0, handshake_delay = handshake_delay).start()
+    loop = asyncio.get_running_loop()
+    with tempfile.TemporaryDirectory() as tmp:
+        snapshot = os.path.join(tmp, "state.json")
+        await loop.run_in_executor(None, measure, server.uri, snapshot, 1)   # writes the snapshot
+        for name, path in (("without snapshot", ""), ("with snapshot", snapshot)):
+            res = await loop.run_in_executor(None, measure, server.uri, path, runs)
+            line = ", ".join(f"{key} {statistics.median(r[key] for r in res) * 1000:.0f} ms" for key in ("imported", "ready", "first_event"))
+            print(f"{name:18s} median of {runs}: {line}")
+    await server.stop()
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1 and sys.argv[1] == "--child":
+        child(sys.argv[2], sys.argv[3], float(sys.argv[4]))
+    else:
+        runs = int(sys.argv[1]) if len(sys.argv) > 1 else 5
+        delay = float(sys.argv[2]) if len(sys.argv) > 2 else 0.5
+        print(f"handshake delay of the mock server {delay * 1000:.0f} ms")
+        asyncio.run(bench(runs, delay))
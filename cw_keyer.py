@@ -0,0 +1,240 @@
+#
+# CW keyer for f6ifyTCI.py: straight key and memories over TCI
+# The keyer has its own TCI connection and its own process: every key down/up has a deadline on the
+# perf_counter clock (the clock of the midi timestamps, the same in every process) and is sent at that time,
+# whatever the event loop of f6ifyTCI.py is doing (jog, meters, logging). A thread of f6ifyTCI.py would wait
+# for the GIL behind them, the process does not share it. The lateness of each send is recorded (stage "jitter")
+#   straight key: the key follows the button with a fixed delay (KEY_DELAY) from the midi timestamp,
+#                 so the time spent in the midi queue and the handlers does not change the timing
+#   memories:     "radio" mode sends CW_MACROS, ExpertSDR keys the text itself,
+#                 "local" mode keys every element here with KEYER
+
+import heapq
+import multiprocessing
+import os
+import sys
+import threading
+import time
+
+import websockets
+
+from latency import Histogram
+
+KEY_DELAY = 0.015   # seconds from the midi event to the key down/up, above the worst delay of the event loop
+SPIN = 0.002        # the last 2 ms before a deadline are waited without sleeping
+SWITCH_INTERVAL = 0.0005    # the reader thread of the keyer process gives the GIL back within 0.5 ms instead of 5 ms
+RECONNECT_DELAYS = (0.05, 0.1, 0.2, 0.5, 1.0, 2.0)  # seconds before each connect attempt, the last one is repeated
+OPEN_TIMEOUT = 2.0  # seconds for the websocket handshake of ExpertSDR
+START_TIMEOUT = 10.0    # seconds start() waits for the process and its first connection
+
+MORSE = {
+    "A": ".-", "B": "-...", "C": "-.-.", "D": "-..", "E": ".", "F": "..-.", "G": "--.", "H": "....", "I": "..",
+    "J": ".---", "K": "-.-", "L": ".-..", "M": "--", "N": "-.", "O": "---", "P": ".--.", "Q": "--.-", "R": ".-.",
+    "S": "...", "T": "-", "U": "..-", "V": "...-", "W": ".--", "X": "-..-", "Y": "-.--", "Z": "--..",
+    "0": "-----", "1": ".----", "2": "..---", "3": "...--", "4": "....-", "5": ".....", "6": "-....",
+    "7": "--...", "8": "---..", "9": "----.", "/": "-..-.", "?": "..--..", "=": "-...-", ".": ".-.-.-", ",": "--..--",
+}
+
+def elements(text, wpm):
+    # (start in seconds from the beginning, key down) of every key change, PARIS timing
+    dit = 1.2 / wpm
+    res = []
+    t = 0.0
+    for word in text.upper().split():
+        for char in word:
+            for symbol in MORSE.get(char, ""):
+                res.append((t, True))
+                t += dit if symbol == "." else 3 * dit
+                res.append((t, False))
+                t += dit            # gap between two elements
+            t += 2 * dit            # 3 dits between two characters
+        t += 4 * dit                # 7 dits between two words
+    return res
+
+def realtime_priority():
+    # The keyer thread before the others when the system allows it (Linux with CAP_SYS_NICE), else a lower nice
+    try:
+        os.sched_setscheduler(0, os.SCHED_FIFO, os.sched_param(10))
+        return True
+    except (AttributeError, OSError):
+        pass
+    try:
+        os.setpriority(os.PRIO_PROCESS, threading.get_native_id(), -10)
+        return True
+    except (AttributeError, OSError):
+        return False
+
+class KeyerLink:
+    # The TCI connection of the keyer process, connected again with backoff when ExpertSDR restarts
+    def __init__(self, uri, conn):
+        self.uri = uri
+        self.conn = conn        # pipe to CwKeyer, for the results
+        self.errors = (OSError, websockets.WebSocketException)
+        self.ws = None
+        self.attempt = 0
+        self.retry_at = 0.0     # perf_counter time of the next connect attempt
+
+    def connect(self):
+        from websockets.sync.client import connect
+        try:
+            self.ws = connect(self.uri, open_timeout = OPEN_TIMEOUT)
+        except self.errors as exc:
+            if self.attempt == 0:
+                self.conn.send(("error", repr(exc)))
+            self.retry_at = time.perf_counter() + RECONNECT_DELAYS[min(self.attempt, len(RECONNECT_DELAYS) - 1)]
+            self.attempt += 1
+            return
+        self.conn.send(("connected", self.attempt))
+        self.attempt = 0
+        threading.Thread(target = self._drain, args = (self.ws,), name = "keyer-rx", daemon = True).start()
+
+    def send(self, cmd):
+        # True when sent; a lost connection is tried again later, the command is lost
+        if self.ws is None:
+            return False
+        try:
+            self.ws.send(cmd)
+            return True
+        except self.errors as exc:
+            self.conn.send(("error", repr(exc)))
+            self.ws = None
+            self.attempt = 1    # the loss is reported, not the failed attempts which follow
+            self.retry_at = time.perf_counter()
+            return False
+
+    def close(self):
+        if self.ws is not None:
+            self.ws.close()
+
+    def _drain(self, ws):
+        # the messages of ExpertSDR (meters, echoes) are read so they never pile up
+        try:
+            for _ in ws:
+                pass
+        except Exception:
+            pass
+
+def keyer_process(uri, conn):
+    # The scheduler: a heap of (deadline, sequence, command) filled by CwKeyer through the pipe. It waits on
+    # the pipe until SPIN before the next deadline, then spins, so the send is on time within the scheduling
+    # of the system, never behind another Python thread of f6ifyTCI.py
+    realtime_priority()
+    sys.setswitchinterval(SWITCH_INTERVAL)
+    link = KeyerLink(uri, conn)
+    schedule = []
+    sequence = 0
+    while True:
+        now = time.perf_counter()
+        wait = schedule[0][0] - now - SPIN if schedule else None
+        if link.ws is None:
+            wait = link.retry_at - now if wait is None else min(wait, link.retry_at - now)
+        if wait is None or wait > 0:
+            if conn.poll(wait):
+                msg = conn.recv()
+                if msg is None:
+                    break
+                if msg[0] == "clear":
+                    schedule.clear()
+                else:
+                    heapq.heappush(schedule, (msg[1], sequence, msg[2]))
+                    sequence += 1
+                continue
+        if link.ws is None and time.perf_counter() >= link.retry_at:
+            link.connect()
+            continue
+        if not schedule or schedule[0][0] - time.perf_counter() > SPIN:
+            continue
+        deadline, _, cmd = heapq.heappop(schedule)
+        while time.perf_counter() < deadline:
+            pass
+        if link.send(cmd):
+            conn.send(("late", time.perf_counter() - deadline))
+        else:
+            conn.send(("lost", cmd))
+    link.close()
+
+class CwKeyer:
+    # The side of f6ifyTCI.py: the key changes go with their deadline to the keyer process,
+    # a thread reads its results (lateness, connection errors). Called from the event loop only
+    def __init__(self, uri, wpm = 25, mode = "radio", stats = None, delay = KEY_DELAY, log = None):
+        self.uri = uri
+        self.wpm = wpm
+        self.mode = mode        # memories: "radio" (CW_MACROS) or "local" (KEYER per element)
+        self.delay = delay
+        self.log = log
+        self.jitter = Histogram()   # lateness of the sends, recorded by the results thread only
+        if stats is not None:
+            stats.histograms[("KEYER", "jitter")] = self.jitter
+        self.conn = None
+        self.process = None
+        self.sent = 0
+        self.errors = 0         # commands lost while ExpertSDR was not connected
+
+    def start(self):
+        # Blocking, called from an executor thread: returns when the process is connected to ExpertSDR or
+        # has failed once, it connects by itself again after each restart (RECONNECT_DELAYS)
+        ctx = multiprocessing.get_context("spawn")
+        self.conn, child = ctx.Pipe()
+        self.process = ctx.Process(target = keyer_process, args = (self.uri, child), name = "keyer", daemon = True)
+        self.process.start()
+        child.close()
+        if self.conn.poll(START_TIMEOUT):
+            try:
+                self._result(self.conn.recv())
+            except EOFError:
+                raise OSError("the keyer process ended at its start") from None
+        threading.Thread(target = self._results, name = "keyer-results", daemon = True).start()
+        return self
+
+    def close(self):
+        if self.process is None:
+            return
+        try:
+            self.conn.send(None)
+        except OSError:
+            pass
+        self.process.join(1.0)
+        if self.process.is_alive():
+            self.process.terminate()
+        self.process = None
+
+    def at(self, deadline, cmd):
+        self.conn.send(("at", deadline, cmd))
+
+    def key(self, rx, down, t = None):
+        # straight key, t is the perf_counter time of the midi event
+        self.at((t or time.perf_counter()) + self.delay, f"KEYER:{rx},{'true' if down else 'false'};")
+
+    def memory(self, rx, text):
+        if self.mode == "local":
+            start = time.perf_counter() + self.delay
+            for t, down in elements(text, self.wpm):
+                self.at(start + t, f"KEYER:{rx},{'true' if down else 'false'};")
+        else:
+            self.at(time.perf_counter(), f"CW_MACROS:{rx},{text.upper().replace(';', ' ')};")
+
+    def stop(self, rx):
+        # the memory being sent is stopped and the key released at once
+        self.conn.send(("clear",))
+        now = time.perf_counter()
+        self.at(now, "CW_MACROS_STOP;")
+        self.at(now, f"KEYER:{rx},false;")
+
+    def _results(self):
+        while True:
+            try:
+                self._result(self.conn.recv())
+            except (EOFError, OSError):
+                return
+
+    def _result(self, msg):
+        if msg[0] == "late":
+            self.jitter.record(msg[1])
+            self.sent += 1
+        elif msg[0] == "lost":
+            self.errors += 1
+        elif self.log is not None:
+            if msg[0] == "error":
+                self.log.warning("CW keyer %s: %s, connecting again", self.uri, msg[1])
+            elif msg[1]:
+                self.log.warning("CW keyer %s back after %d attempts", self.uri, msg[1])
@@ -0,0 +1,67 @@
+#
+# Logging for f6ifyTCI.py without blocking the event loop
+# The records are not formatted by the caller: the console handler formats them in the thread of a
+# QueueListener, the ring keeps the last records as they are and formats them only when dumped
+# A debug() under the level of the logger costs one cached level check
+
+import logging
+import logging.handlers
+import queue
+import sys
+import threading
+from collections import deque
+
+FORMAT = "%(asctime)s %(levelname)-7s %(message)s"
+
+class LazyQueueHandler(logging.handlers.QueueHandler):
+    # QueueHandler.prepare() formats the message in the calling thread, here the record goes as it is:
+    # the arguments of the hot path (midi events, ints, strings) are not changed after the call
+    def prepare(self, record):
+        return record
+
+class RingHandler(logging.Handler):
+    # The last size records, whatever the console level, dumped on demand (SIGUSR2)
+    def __init__(self, size = 1000):
+        super().__init__(logging.DEBUG)
+        self.records = deque(maxlen = size)
+
+    def handle(self, record):
+        # no lock nor filter, deque.append is thread safe
+        self.records.append(record)
+        return True
+
+    emit = handle
+
+    def dump(self):
+        formatter = self.formatter or logging.Formatter(FORMAT)
+        return "\n".join(formatter.format(record) for record in list(self.records))
+
+def setup_logging(name, level = "INFO", ring_size = 0, stream = None):
+    # Returns the QueueListener, to stop() at exit so the last records are written
+    logging.logThreads = logging.logProcesses = logging.logMultiprocessing = False  # not in FORMAT, saved on every record
+    logger = logging.getLogger(name)
+    console_level = logging.getLevelName(level) if isinstance(level, str) else level
+    q = queue.SimpleQueue()
+    handler = LazyQueueHandler(q)
+    handler.setLevel(console_level)
+    logger.addHandler(handler)
+    if ring_size:
+        logger.addHandler(RingHandler(ring_size))
+    logger.setLevel(logging.DEBUG if ring_size else console_level)
+    logger.propagate = False
+    console = logging.StreamHandler(stream or sys.stdout)
+    console.setFormatter(logging.Formatter(FORMAT, "%H:%M:%S"))
+    listener = logging.handlers.QueueListener(q, console)
+    listener.start()
+    return listener
+
+def find_ring(logger):
+    return next((h for h in logger.handlers if isinstance(h, RingHandler)), None)
+
+def dump_ring(logger):
+    # the ring formatted in a thread, the event loop goes on
+    ring = find_ring(logger)
+    if ring is None:
+        logger.warning("no log ring (LOG_RING)")
+        return
+    threading.Thread(target = lambda: print(ring.dump()), daemon = True).start()
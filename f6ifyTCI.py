@@ -6,6 +6,35 @@
 # or the DJControl Starlight midi device from Hercules
 # Philippe Nouchi - project started on the 9th December 2024
 
+# Version 1.5 le 16 octobre 2026
+#   - The jog ticks are summed over a short window (JOG_WINDOW) and sent as one DDS/IF write
+#   - midi_rx uses a dispatch table built at startup from DJ_MAP / DJS_MAP or f6ifyTCI_mapping.json
+#   - Optional raw midi input reading the bytes from rtmidi (RAW_MIDI), see bench/bench_midi.py
+#   - The TCI commands go through TciLink, a continuous value waiting to be sent is replaced by the newest one
+#   - PTT and mute have a priority lane from the midi callback to the websocket, see bench/bench_ptt.py
+#   - Latency histograms per command and stage (latency.py), logged with SIGUSR1 or SYNC A + CUE B (Compact),
+#     SYNC left + SYNC right (Starlight), exported with METRICS_FILE / METRICS_PORT
+#   - Our writes update the state at once and are reconciled with the echoes of ExpertSDR (PendingWrites)
+#   - params_dict is replaced by StateStore, one slot per (command, rx, subrx) with getters and change callbacks
+#   - Band plan indexed by bisect, loaded from a file (BAND_PLAN), band stack registers restored on band change,
+#     band down/up on the Starlight pads 1 and 2 (channel 6, BTN_1L and BTN_2L)
+#   - Offline benchmark with a mock TCI server and synthetic controllers, see bench/bench_f6ifyTCI.py
+#   - Session log of the midi events and TCI messages (SESSION_LOG), replayed with session_log.py
+#   - Several controllers and radios in one process (ROUTES), each radio has its own state (Radio)
+#   - Reconnect to ExpertSDR with backoff, the midi side goes on and the commands wait, the state is resynced
+#   - Faster startup: mido/rtmidi imported when needed, last state saved (STATE_SNAPSHOT) and used until the handshake
+#   - Midi hot-plug: the controllers can be unplugged and plugged again without restarting (HOTPLUG_PERIOD)
+#   - Bounded midi queue (MidiRing): when midi_rx stalls the jogs are summed and the knobs collapsed, never the buttons
+#   - LEDs of the controller follow the radio state (LedOutput), only the changes are sent (LED_RATE)
+#   - logging instead of print, written by a thread (event_log.py), last records in memory (LOG_RING, SIGUSR2)
+#   - Macros (MACRO_FILE): a button sends a list of TCI commands as one batch, with waits on the state and the echoes
+#   - A jog tick is one IF write, DDS moves to center the panorama only near its edge (RECENTER_MARGIN), RIT too
+#   - CW keyer (CW_KEYER): straight key and memories on the Starlight pads, timed by its own process (cw_keyer.py)
+#   - Snap to signal (IQ_SNAP): carriers found in the TCI IQ stream (iq_peaks.py), the VFO jumps to the nearest one
+#   - Faders and pots through 128 entry tables built at startup (FADERS, FILTER_POTS) with soft takeover,
+#     the filter pots follow the mode and the Starlight bass pots move the filter edges
+#   - Local TCI server (PROXY_PORT) sharing the connection and the state with the logger, the skimmer... (tci_proxy.py)
+#   - Jog acceleration (JOG_ACCEL): the step grows with the speed of the spin (JOG_CURVES per mode), on a grid
 # Version 1.4 Ph. Nouchi - F6IFY le 18 mars 2025
 #   - Add the VFO step 10Hz with the BASS/Filter button on the DJControl Starlight
 #   - suppress all shift+buttons on the DJControl Compact because the modes roll up
@@ -31,21 +60,51 @@
 from enum import IntEnum
 from functools import partial
 from bisect import bisect_right, bisect_left
-from urllib.parse import non_hierarchical
+from collections import deque
+from contextvars import ContextVar
+import json
+import logging
+import math
+import os
+import signal
+import threading
+import time
 
 from eesdr_tci import tci
 from eesdr_tci.listener import Listener
 from eesdr_tci.tci import TciCommandSendAction
 # from config import Config
-import mido
-#import rtmidi
-import mido.backends.rtmidi
+# mido and rtmidi are imported when the midi input is opened, see load_rtmidi()
 import asyncio
+import websockets
 
-# to help future modification with new midi device
-midi_hardware = mido.get_input_names()
-midi_port = midi_hardware[0]
-print(f"midi device is {midi_port}")
+from event_log import dump_ring, setup_logging
+from latency import LatencyStats, serve_metrics, write_metrics
+# cw_keyer, session_log and tci_proxy are imported by main() when CW_KEYER, SESSION_LOG or PROXY_PORT is set
+
+RAW_MIDI = True # read the 3 midi bytes straight from rtmidi instead of building mido Messages
+METRICS_FILE = None # e.g. "f6ifyTCI_metrics.prom", latency histograms written every 10 s in the Prometheus text format
+METRICS_PORT = None # e.g. 9108, local http endpoint serving the same text
+ROUTES = None # several controllers and radios (SO2R), e.g. [("DJControl Compact", "ws://localhost:50001", 0),
+              #   ("DJControl Starlight", "ws://192.168.1.20:50001", 0)]: midi port name prefix, TCI server, rx
+HOTPLUG_PERIOD = 1.0 # seconds between two looks at the midi ports, a controller plugged or unplugged is seen, None = off
+PORT_RETRY_DELAYS = (1, 2, 5, 10, 30) # seconds before a midi port which failed is opened again, the last one is repeated
+SESSION_LOG = None # e.g. "f6ifyTCI.f6log", records the midi events and the TCI messages, see session_log.py
+PROXY_PORT = None # e.g. 50002, local TCI server for the other programs, sharing our connection to ExpertSDR
+PROXY_METER_RATE = 5 # meter values per second and per meter sent to a proxy client, unless it asks for its sensors
+STATE_SNAPSHOT = "f6ifyTCI_state.json" # last known state of the radios, loaded at startup so the controller
+                                       # works during the handshake, None = not used
+CW_KEYER = False # straight key and CW memories from the controller, with a second TCI connection (cw_keyer.py)
+CW_WPM = 28 # speed of the memories keyed here (CW_MEMORY_MODE "local")
+CW_MEMORY_MODE = "radio" # "radio": the text goes with CW_MACROS and ExpertSDR keys it, "local": keyed here with KEYER
+CW_MEMORIES = ["CQ TEST F6IFY F6IFY TEST", "5NN 14", "TU F6IFY TEST", "?"] # pads cw_mem1 to cw_mem4
+IQ_SNAP = False # the IQ stream of the receivers is read to find the carriers, the snap buttons tune to them (numpy)
+IQ_RATE = 48000 # IQ_SAMPLERATE asked to ExpertSDR, the CPU used by iq_peaks.py does not depend on it
+SNAP_MIN_STEP = 50 # Hz, snap up/down skip a carrier closer than that to the VFO, it is the one already tuned
+LOG_LEVEL = "INFO" # console level, "DEBUG" shows every midi event, written by a thread so the event loop never waits
+LOG_RING = 1000 # last log records kept in memory (DEBUG included), printed with SIGUSR2, 0 = off (nearly free debug calls)
+
+log = logging.getLogger("f6ifyTCI")
 
 class MIDI(IntEnum):
     KEYUP = 0
@@ -126,10 +185,6 @@ class DJS(IntEnum): # Value for the DJControl Starlight from hercule
 class MODS:
     UI_LIST = ["AM", "LSB", "USB", "CW", "NFM", "DIGL", "DIGU", "WFM"]
     UI_LIST_MAX = len(UI_LIST) - 1
-    DEFAULT_LEFT  = {"AM": -3000, "LSB": -3000, "USB":   25, "CW": -250, "NFM": -6000, "DIGL": -3000, "DIGU":   25, "WFM": -24000}
-    DEFAULT_RIGHT = {"AM":  3000, "LSB":   -25, "USB": 3000, "CW":  250, "NFM":  6000, "DIGL":   -25, "DIGU": 3000, "WFM":  24000}
-    WHEEL_LEFT  = {"AM": -25, "LSB": -25, "USB":  0, "CW": -25, "NFM": -25, "DIGL": -25, "DIGU":  0, "WFM": -250}
-    WHEEL_RIGHT = {"AM":  25, "LSB":   0, "USB": 25, "CW":  25, "NFM":  25, "DIGL":   0, "DIGU": 25, "WFM":  250}
 
 # class KNOBPLANE(IntEnum):
 #     BASE = 0
@@ -140,11 +195,6 @@ class MODS:
 #     VOLUME = 5
 #     MONITOR = 6
 
-class FILTERSIDE(IntEnum):
-    LEFT  = -1
-    MAIN  =  0
-    RIGHT =  1
-
 class Band:
     def __init__(self, name, min_freq, max_freq, seg1=None, seg2=None):
         self.name = name
@@ -184,40 +234,318 @@ class BANDS:
              Band("6m", 50000, 54000, 50100, 52000),
              Band("2m", 144000, 148000, 144100, 147000),
            ]
-    NAMES = [band.name for band in INFO]
-    POINTS = [i for j in [band.points() for band in INFO] for i in j]
+
+    def build(info):
+        # The bands are sorted on their lower edge, FreqBand is a bisect on these edges
+        BANDS.INFO = sorted(info, key = lambda band: band.min_freq)
+        BANDS.NAMES = [band.name for band in BANDS.INFO]
+        BANDS.POINTS = sorted(i for j in [band.points() for band in BANDS.INFO] for i in j)
+        BANDS.EDGES = [band.min_freq for band in BANDS.INFO]
+
+    def load(path):
+        # {"name": "IARU Region 1", "bands": [["160m", 1810, 2000], ["80m", 3500, 3800, 3525, 3700], ...]}
+        # the values are in kHz, in the same order as for Band()
+        with open(path) as f:
+            plan = json.load(f)
+        BANDS.build([Band(*band) for band in plan["bands"]])
+        log.info("Band plan is %s", plan.get("name", path))
 
     def FreqBand(freq):
-        chk = [band.in_band(freq) for band in BANDS.INFO]
-        if not any(chk):
+        i = bisect_right(BANDS.EDGES, freq) - 1
+        if i >= 0 and BANDS.INFO[i].in_band(freq):
+            return BANDS.INFO[i]
+        return None
+
+BANDS.build(BANDS.INFO)
+BAND_PLAN = None # e.g. "bandplans/iaru_region1.json", the built-in plan is used when None
+
+class BandStack:
+    # The last DDS, IF, mode and filter used on each band, for each rx
+    def __init__(self):
+        self.registers = {} # (rx, band name) -> {"DDS": ..., "IF": ..., "MODULATION": ..., "RX_FILTER_BAND": ...}
+
+    def save(self, rx, subrx):
+        band = BANDS.FreqBand(get_param("DDS", rx) + get_param("IF", rx, subrx))
+        if band is None:
+            return
+        self.registers[(rx, band.name)] = {"DDS": get_param("DDS", rx), "IF": get_param("IF", rx, subrx),
+                                           "MODULATION": get_param("MODULATION", rx),
+                                           "RX_FILTER_BAND": list(get_param("RX_FILTER_BAND", rx))}
+
+    def restore(self, rx, subrx, band):
+        # All the commands to go back to the band as it was left, None if the band has not been used yet
+        reg = self.registers.get((rx, band.name))
+        if reg is None:
             return None
-        else:
-            return BANDS.INFO[chk.index(True)]
+        return Batch([ tci.COMMANDS["MODULATION"].prepare_string(TciCommandSendAction.WRITE, rx=rx, params=[reg["MODULATION"]]),
+                       tci.COMMANDS["DDS"].prepare_string(TciCommandSendAction.WRITE, rx=rx, params=[int(reg["DDS"])]),
+                       tci.COMMANDS["IF"].prepare_string(TciCommandSendAction.WRITE, rx=rx, sub_rx=subrx, params=[int(reg["IF"])]),
+                       tci.COMMANDS["RX_FILTER_BAND"].prepare_string(TciCommandSendAction.WRITE, rx=rx, params=reg["RX_FILTER_BAND"]) ])
+
+MISSING = object()
+
+class StateStore:
+    # The radio state, one slot per (command, rx, subrx) in a flat list.
+    # The slots of all the known commands are allocated at startup, the (name, rx, subrx) asked by the handlers
+    # are resolved once to their slot, so a read is one dict lookup and one list index, or only the list index
+    # with a getter bound in advance
+    __slots__ = ("index", "keys", "values", "listeners")
+
+    def __init__(self, trx_count = 2, channels = 2):
+        self.index = {}      # (name, rx, subrx) -> slot, also for a rx/subrx the command does not have
+        self.keys = []       # slot -> (name, rx, subrx) as sent by ExpertSDR
+        self.values = []     # slot -> value or MISSING
+        self.listeners = []  # slot -> list of callback(value) or None
+        for info in tci.COMMANDS.values():
+            for rx in (range(trx_count) if info.has_rx else [None]):
+                for subrx in (range(channels) if info.has_sub_rx else [None]):
+                    self._add((info.name, rx, subrx))
+
+    def _add(self, key):
+        self.index[key] = len(self.values)
+        self.keys.append(key)
+        self.values.append(MISSING)
+        self.listeners.append(None)
+        return self.index[key]
+
+    def slot(self, name, rx = None, subrx = None):
+        i = self.index.get((name, rx, subrx))
+        if i is None:
+            info = tci.COMMANDS[name]
+            key = (name, rx if info.has_rx else None, subrx if info.has_sub_rx else None)
+            i = self.index.get(key)
+            if i is None:
+                i = self._add(key)
+            self.index[(name, rx, subrx)] = i
+        return i
 
-params_dict = {}
+    def get(self, name, rx = None, subrx = None):
+        value = self.values[self.slot(name, rx, subrx)]
+        if value is MISSING:
+            raise KeyError(name)
+        return value
+
+    def has(self, name, rx = None, subrx = None):
+        return self.values[self.slot(name, rx, subrx)] is not MISSING
+
+    def set(self, name, rx, subrx, value):
+        i = self.slot(name, rx, subrx)
+        old = self.values[i]
+        self.values[i] = value
+        if self.listeners[i] is not None and old != value:
+            for callback in self.listeners[i]:
+                # called in the listener task of the link, an error of one listener must not drop the connection
+                try:
+                    callback(value)
+                except Exception:
+                    log.exception("listener of %s failed", name)
+
+    def getter(self, name, rx = None, subrx = None, kind = None, default = MISSING):
+        # Returns a function reading the slot, resolved now, kind converts the value (int, float, bool...)
+        # A missing value raises KeyError like get(), or gives default when there is one
+        i = self.slot(name, rx, subrx)
+        values = self.values
+        def get():
+            value = values[i]
+            if value is MISSING:
+                if default is MISSING:
+                    raise KeyError(name)
+                return default
+            return value if kind is None else kind(value)
+        return get
+
+    def subscribe(self, name, rx, subrx, callback):
+        # callback(value) is called when the value of the slot changes
+        i = self.slot(name, rx, subrx)
+        if self.listeners[i] is None:
+            self.listeners[i] = []
+        self.listeners[i].append(callback)
+
+    def unsubscribe(self, name, rx, subrx, callback):
+        i = self.slot(name, rx, subrx)
+        if self.listeners[i] is not None and callback in self.listeners[i]:
+            self.listeners[i].remove(callback)
+
+    def items(self):
+        # ((name, rx, subrx), value) of every known value
+        return [(key, value) for key, value in zip(self.keys, self.values) if value is not MISSING]
+
+    def clear(self):
+        for i in range(len(self.values)):
+            self.values[i] = MISSING
+
+RECONNECT_DELAYS = (0.05, 0.1, 0.2, 0.5) # seconds before each reconnect attempt to ExpertSDR, the last one is repeated
+HANDSHAKE_TIMEOUT = 10.0 # seconds without a message of ExpertSDR before a connection still waiting for READY is dropped
+PENDING_TIMEOUT = 1.0 # seconds without echo before a local write is rolled back to the last value sent by ExpertSDR
+
+def same_type(a, b):
+    # the values of ExpertSDR: int and float are both numbers, lists are compared item by item
+    if isinstance(a, list) or isinstance(b, list):
+        return isinstance(a, list) and isinstance(b, list) and len(a) == len(b) and all(map(same_type, a, b))
+    if isinstance(a, bool) or isinstance(b, bool):
+        return isinstance(a, bool) and isinstance(b, bool)
+    if isinstance(a, (int, float)):
+        return isinstance(b, (int, float))
+    return type(a) is type(b)
+
+class PendingWrites:
+    # Our writes are applied to the state as soon as they are sent, so the next jog tick computes
+    # from the new value, and they are kept pending until ExpertSDR echoes them
+    def __init__(self, state, timeout = PENDING_TIMEOUT):
+        self.state = state
+        self.timeout = timeout
+        self.pending = {}    # (name, rx, subrx) -> deque of (value, deadline), oldest first
+        self.confirmed = {}  # (name, rx, subrx) -> last value echoed by ExpertSDR
+        self.on_confirmed = {}   # (name, rx, subrx) -> callbacks(value) when ExpertSDR echoes a new value
+        self.rollbacks = 0
+
+    def _parse(self, cmd):
+        slot = command_slot(cmd)
+        if slot is None:
+            return None
+        info = tci.COMMANDS[slot[0]]
+        if not info.readable or not info.writeable:
+            return None
+        args = cmd.rstrip(";").partition(":")[2].split(",")[info.has_rx + info.has_sub_rx:]
+        if len(args) != info.param_count:
+            return None
+        values = [Listener._convert_type(v) for v in args]
+        return slot, values[0] if len(values) == 1 else values
 
-async def update_params(name, rx, subrx, params):
-    global params_dict
+    def parse(self, cmd):
+        # (slot, value) of a write of a readable command, None for the others (reads included)
+        # and for a value of another type than ours, which ExpertSDR does not apply (IF:0,0,abc;)
+        parsed = self._parse(cmd)
+        if parsed is None or (self.state.has(*parsed[0]) and not same_type(self.state.get(*parsed[0]), parsed[1])):
+            return None
+        return parsed
+
+    def malformed(self, cmd):
+        # True for a known command whose rx or subrx is not a number, or whose value has not the type of ours
+        info = tci.COMMANDS.get(command_name(cmd))
+        if info is None:
+            return False
+        if (info.has_rx or info.has_sub_rx) and command_slot(cmd) is None:
+            return True
+        parsed = self._parse(cmd)
+        return parsed is not None and self.state.has(*parsed[0]) and not same_type(self.state.get(*parsed[0]), parsed[1])
+
+    def unchanged(self, cmd):
+        # True when cmd writes the value the slot already has, nothing pending: ExpertSDR may not echo it
+        parsed = self.parse(cmd)
+        if parsed is None:
+            return False
+        slot, value = parsed
+        return self.state.has(*slot) and not self.pending.get(slot) and self.state.get(*slot) == value
+
+    def write(self, cmd):
+        parsed = self.parse(cmd)
+        if parsed is None:
+            return
+        slot, value = parsed
+        if self.state.has(*slot):
+            if not self.pending.get(slot) and self.state.get(*slot) == value:
+                return  # no change, ExpertSDR may not echo it
+            if slot not in self.confirmed:
+                self.confirmed[slot] = self.state.get(*slot)
+        self.pending.setdefault(slot, deque()).append((value, time.monotonic() + self.timeout))
+        self.state.set(*slot, value)
+
+    def echo(self, name, rx, subrx, params):
+        # Returns True when the state must keep our value because newer writes are still on their way
+        slot = (name, rx, subrx)
+        changed = self.confirmed.get(slot, MISSING) != params
+        self.confirmed[slot] = params
+        if changed and slot in self.on_confirmed:
+            for callback in self.on_confirmed[slot]:
+                try:
+                    callback(params)
+                except Exception:
+                    log.exception("confirmation listener of %s failed", name)
+        q = self.pending.get(slot)
+        if not q:
+            return False
+        for i, (value, deadline) in enumerate(q):
+            if value == params:
+                for _ in range(i + 1):
+                    q.popleft()
+                return len(q) > 0
+        # ExpertSDR has another value (changed on the screen, clamped...), it wins
+        q.clear()
+        self.rollbacks += 1
+        return False
+
+    def subscribe(self, name, rx, subrx, callback):
+        # callback(value) is called when ExpertSDR has applied a new value of the slot, not when we send it
+        self.on_confirmed.setdefault((name, rx, subrx), []).append(callback)
+
+    def clear(self):
+        self.pending.clear()
+        self.confirmed.clear()
+
+    def expire(self):
+        now = time.monotonic()
+        for slot, q in self.pending.items():
+            if q and q[-1][1] < now:
+                q.clear()
+                self.rollbacks += 1
+                if slot in self.confirmed:
+                    self.state.set(*slot, self.confirmed[slot])
+
+class Radio:
+    # One ExpertSDR: its state, our writes waiting for their echo and its band stack
+    # The functions below work on current_radio, set by TciLink for its own tasks and by midi_rx for its deck
+    def __init__(self, name = "radio"):
+        self.name = name
+        self.state = StateStore()
+        self.pending_writes = PendingWrites(self.state)
+        self.band_stack = BandStack()
+        self.if_limits = self.state.getter("IF_LIMITS")  # fixed for the session, bound once
+        # the values read on every jog tick and pot move, bound once: [rx] or [rx][subrx]
+        get, rxs = self.state.getter, range(2)
+        self.dds = [get("DDS", rx) for rx in rxs]
+        self.vfo_if = [[get("IF", rx, subrx) for subrx in rxs] for rx in rxs]
+        self.rit_offset = [get("RIT_OFFSET", rx) for rx in rxs]
+        self.rit_enable = [get("RIT_ENABLE", rx, default = False) for rx in rxs]
+        self.channel_enable = [[get("RX_CHANNEL_ENABLE", rx, subrx, default = False) for subrx in rxs] for rx in rxs]
+        self.modulation = [get("MODULATION", rx, default = None) for rx in rxs]
+        self.filter_band = [get("RX_FILTER_BAND", rx, default = None) for rx in rxs]
+        self.if_moves = 0       # jog ticks sent as an IF write only
+        self.dds_retunes = 0    # DDS moved to center the panorama again, see retune()
+        self.spectra = {}       # rx -> iq_peaks.PeakDetector fed by the IQ stream, see IQ_SNAP
+
+default_radio = Radio()
+current_radio = ContextVar("current_radio", default = default_radio)
+state = default_radio.state   # with a single radio
+pending_writes = default_radio.pending_writes
+
+def set_param(name, rx, subrx, value):
+    current_radio.get().state.set(name, rx, subrx, value)
+
+def update_params(name, rx, subrx, params):
+    # Called directly by TciLink for every parameter sent by ExpertSDR, no task is created
     # print("TCI", name, rx, subrx, params)
-    if rx not in params_dict:
-        params_dict[rx] = {}
-    if subrx not in params_dict[rx]:
-        params_dict[rx][subrx] = {}
-    params_dict[rx][subrx][name] = params
+    radio = current_radio.get()
+    if radio.pending_writes.echo(name, rx, subrx, params):
+        return
+    radio.state.set(name, rx, subrx, params)
+
+def has_param(name, rx = None, subrx = None):
+    return current_radio.get().state.has(name, rx, subrx)
+
+async def expire_pending(radio = None, period = 0.25):
+    radio = radio or current_radio.get()
+    while True:
+        await asyncio.sleep(period)
+        radio.pending_writes.expire()
 
 def get_param(name, rx = None, subrx = None):
-    global params_dict
-    cmd = tci.COMMANDS[name]
-    if not cmd.has_rx:
-        rx = None
-    if not cmd.has_sub_rx:
-        subrx = None
-    return params_dict[rx][subrx][name]
+    return current_radio.get().state.get(name, rx, subrx)
 
 def do_band_scroll(val, rx, subrx):
     rx_dds = get_param("DDS", rx, subrx)
     subrx_if = get_param("IF", rx, subrx)
-    print(subrx_if)
+    log.debug("IF is %s", subrx_if)
     curr_freq = rx_dds + subrx_if
     if val == MIDI.ENCDOWN:
         idx = bisect_left(BANDS.POINTS, curr_freq) - 1
@@ -228,27 +556,94 @@ def do_band_scroll(val, rx, subrx):
 
     if idx >= len(BANDS.POINTS):
         idx = 0
+    # Leaving the band: remember where we were, and go back where we were on the new band if it has been used
+    curr_band = BANDS.FreqBand(curr_freq)
+    new_band = BANDS.FreqBand(BANDS.POINTS[idx])
+    band_stack = current_radio.get().band_stack
+    band_stack.save(rx, subrx)
+    if new_band is not curr_band:
+        cmds = band_stack.restore(rx, subrx, new_band)
+        if cmds:
+            log.info("Band %s from the band stack", new_band.name)
+            return cmds
     rx_dds = BANDS.POINTS[idx]
-    print(idx,rx_dds)
+    log.debug("band point %s, DDS %s", idx, rx_dds)
     subrx_if = 0
 
-    return [ tci.COMMANDS["DDS"].prepare_string(TciCommandSendAction.WRITE, rx=rx, params=[int(rx_dds)]),
-             tci.COMMANDS["IF"].prepare_string(TciCommandSendAction.WRITE, rx=rx, sub_rx=subrx, params=[int(subrx_if)]) ]
+    return Batch([ tci.COMMANDS["DDS"].prepare_string(TciCommandSendAction.WRITE, rx=rx, params=[int(rx_dds)]),
+                   tci.COMMANDS["IF"].prepare_string(TciCommandSendAction.WRITE, rx=rx, sub_rx=subrx, params=[int(subrx_if)]) ])
 
-def do_freq_scroll(incr, val, rx, subrx):
-    rx_dds = get_param("DDS", rx, subrx)
-    subrx_if = get_param("IF", rx, subrx)
-    subrx0_if = get_param("IF", rx, 0)
-    if_lims = get_param("IF_LIMITS")
+RECENTER_MARGIN = 0.1 # part of the IF span at each edge of the panorama: tuning into it moves DDS to center the panorama
+
+# The tuning functions read the bound getters of radio (the radio of the deck), current_radio when None
+
+def rit_enabled(rx, radio = None):
+    return (radio or current_radio.get()).rit_enable[rx]() is True
+
+def rit_heard(rx, subrx, radio = None):
+    # RIT shifts what the main receiver hears, not its VFO
+    radio = radio or current_radio.get()
+    return radio.rit_offset[rx]() if subrx == 0 and rit_enabled(rx, radio) else 0
+
+def if_window(radio = None):
+    lo, hi = (radio or current_radio.get()).if_limits()
+    margin = (hi - lo) * RECENTER_MARGIN
+    return lo + margin, hi - margin
 
-    # print(f"rx_dds is {rx_dds}, subrx_if is {subrx_if}, su")
+def retune(rx, subrx, new_if, rit = 0, radio = None):
+    # Commands putting the subrx at DDS + new_if (heard at + rit). Inside the window of the panorama it is one
+    # IF write. Past it DDS moves so what is heard is at the center: DDS moves again only after half a panorama
+    # of tuning (hysteresis), not on every tick
+    radio = radio or current_radio.get()
+    low, high = if_window(radio)
+    if not low <= new_if + rit <= high:
+        cmds = recenter(rx, subrx, new_if, rit, radio)
+        if cmds is not None:
+            radio.dds_retunes += 1
+            return cmds
+        lo, hi = radio.if_limits()  # DDS cannot move: the IF stops at the limit like before
+        new_if = min(max(new_if, lo - rit), hi - rit)
+    radio.if_moves += 1
+    return [ tci.COMMANDS["IF"].prepare_string(TciCommandSendAction.WRITE, rx=rx, sub_rx=subrx, params=[int(new_if)]) ]
+
+def recenter(rx, subrx, new_if, rit, radio = None):
+    # DDS, IF batch centering what the subrx hears, the IF of the other subrx follows to keep its frequency
+    # inside the window. None when the two subrx are too far apart for DDS to move
+    radio = radio or current_radio.get()
+    low, high = if_window(radio)
+    dds = radio.dds[rx]()
+    other = 1 - subrx
+    other_freq = None
+    if radio.state.has("IF", rx, other) and (other == 0 or radio.channel_enable[rx][other]() is True):
+        other_freq = dds + radio.vfo_if[rx][other]()
+    new_dds = dds + new_if + rit
+    if other_freq is not None:  # the other subrx stays inside the window too
+        new_dds = min(max(new_dds, other_freq - high), other_freq - low)
+    target_if = dds + new_if - new_dds
+    lo, hi = radio.if_limits()
+    if new_dds == dds or not lo <= target_if + rit <= hi:
+        return None
+    cmds = [ tci.COMMANDS["DDS"].prepare_string(TciCommandSendAction.WRITE, rx=rx, params=[int(new_dds)]),
+             tci.COMMANDS["IF"].prepare_string(TciCommandSendAction.WRITE, rx=rx, sub_rx=subrx, params=[int(target_if)]) ]
+    if other_freq is not None:
+        cmds.append(tci.COMMANDS["IF"].prepare_string(TciCommandSendAction.WRITE, rx=rx, sub_rx=other,
+                                                      params=[int(other_freq - new_dds)]))
+    log.debug("DDS of rx %d moved to %d", rx, new_dds)
+    return Batch(cmds)
+
+def do_freq_scroll(incr, val, rx, subrx, radio = None):
+    radio = radio or current_radio.get()
+    subrx_if = radio.vfo_if[rx][subrx]()
 
     if val == MIDI.CLICK:
+        rx_dds = radio.dds[rx]()
         if subrx == 0:
             rx_dds = rx_dds + subrx_if
             subrx_if = 0
         else:
-            subrx_if = subrx0_if
+            subrx_if = radio.vfo_if[rx][0]()
+        return [ tci.COMMANDS["DDS"].prepare_string(TciCommandSendAction.WRITE, rx=rx, params=[int(rx_dds)]),
+                 tci.COMMANDS["IF"].prepare_string(TciCommandSendAction.WRITE, rx=rx, sub_rx=subrx, params=[int(subrx_if)]) ]
     elif val == MIDI.ENCDOWN:
         subrx_if -= incr
     elif val == MIDI.ENCUP:
@@ -256,46 +651,61 @@ def do_freq_scroll(incr, val, rx, subrx):
     else:
         return []
 
-    if subrx_if < if_lims[0]:
-        subrx_if = if_lims[0]
-    if subrx_if > if_lims[1]:
-        subrx_if = if_lims[1]
+    return retune(rx, subrx, subrx_if, rit_heard(rx, subrx, radio), radio)
 
-    return [ tci.COMMANDS["DDS"].prepare_string(TciCommandSendAction.WRITE, rx=rx, params=[int(rx_dds)]),
-             tci.COMMANDS["IF"].prepare_string(TciCommandSendAction.WRITE, rx=rx, sub_rx=subrx, params=[int(subrx_if)]) ]
+def do_freq_snap(up, rx, subrx):
+    # One IF write (or a recentering) to the carrier above, below or nearest (up None) what is heard,
+    # from the spectrum of the IQ stream. Nothing when there is no carrier or no recent spectrum
+    # The nearest one may be the carrier already tuned: the VFO is put right on it
+    detector = current_radio.get().spectra.get(rx)
+    if detector is None:
+        log.warning("No IQ spectrum of rx %d (IQ_SNAP)", rx)
+        return []
+    rit = rit_heard(rx, subrx)
+    heard = get_param("IF", rx, subrx) + rit
+    peak = detector.nearest(heard, up, SNAP_MIN_STEP if up is not None else 0)
+    if peak is None:
+        log.info("No signal to snap to")
+        return []
+    log.debug("Snap from IF %d to %.0f", heard, peak)
+    return retune(rx, subrx, round(peak) - rit, rit)
 
-def do_filter_scroll(side, val, rx, subrx):
-    flt = get_param("RX_FILTER_BAND", rx, subrx)
-    mod = get_param("MODULATION", rx, subrx)
+def enable_iq_snap(link, rate = IQ_RATE):
+    # The IQ stream of both receivers is asked after every handshake and read by the link into the spectra
+    from iq_peaks import PeakDetector   # numpy only when it is used
+    link.radio.spectra = {rx: PeakDetector() for rx in (0, 1)}
+    for rx, detector in link.radio.spectra.items():
+        # reset when DDS is sent, so no snap uses the old panorama, and again on its echo: the IQ packets
+        # received until then may still be of the old panorama
+        link.radio.state.subscribe("DDS", rx, None, detector.reset)
+        link.radio.pending_writes.subscribe("DDS", rx, None, detector.reset)
+    link.start_cmds = [f"IQ_SAMPLERATE:{rate};", "IQ_START:0;", "IQ_START:1;"]
 
-    if val == MIDI.CLICK:
-        if side == FILTERSIDE.LEFT or side == FILTERSIDE.MAIN:
-            flt[0] = MODS.DEFAULT_LEFT[mod]
-        if side == FILTERSIDE.RIGHT or side == FILTERSIDE.MAIN:
-            flt[1] = MODS.DEFAULT_RIGHT[mod]
-    elif val == MIDI.ENCDOWN:
-        if side == FILTERSIDE.LEFT:
-            flt[0] -= 25
-        if side == FILTERSIDE.MAIN:
-            flt[0] -= MODS.WHEEL_LEFT[mod]
-            flt[1] -= MODS.WHEEL_RIGHT[mod]
-        if side == FILTERSIDE.RIGHT:
-            flt[1] -= 25
-    elif val == MIDI.ENCUP:
-        if side == FILTERSIDE.LEFT:
-            flt[0] += 25
-        if side == FILTERSIDE.MAIN:
-            flt[0] += MODS.WHEEL_LEFT[mod]
-            flt[1] += MODS.WHEEL_RIGHT[mod]
-        if side == FILTERSIDE.RIGHT:
-            flt[1] += 25
-    else:
-        return []
+def do_freq_jump(step, ticks, rx, subrx, radio = None):
+    # ticks steps (negative down) from the VFO to a multiple of step, the first one ends on the grid
+    radio = radio or current_radio.get()
+    dds = radio.dds[rx]()
+    freq = dds + radio.vfo_if[rx][subrx]()
+    grid = freq // step + ticks if ticks > 0 else -(-freq // step) + ticks
+    return retune(rx, subrx, grid * step - dds, rit_heard(rx, subrx, radio), radio)
 
-    return [ tci.COMMANDS["RX_FILTER_BAND"].prepare_string(TciCommandSendAction.WRITE, rx=rx, params=flt) ]
+def do_rit_scroll(incr, val, rx, subrx):
+    # The RIT offset, and DDS when what is heard leaves the window of the panorama
+    cmds = do_generic_scroll("RIT_OFFSET", incr, val, rx, subrx)
+    if not cmds or not rit_enabled(rx):
+        return cmds
+    rit = get_param("RIT_OFFSET", rx) + (incr if val == MIDI.ENCUP else -incr)
+    subrx_if = get_param("IF", rx, 0)
+    low, high = if_window()
+    if low <= subrx_if + rit <= high:
+        return cmds
+    moved = recenter(rx, 0, subrx_if, rit)   # the VFO never moves with the RIT
+    if moved is None:
+        return cmds
+    current_radio.get().dds_retunes += 1
+    return Batch(cmds + list(moved))
 
 def do_mod_scroll(val, rx, subrx):
-    mod_list = get_param("MODULATIONS_LIST")
     # There are many modulations exposed in this list that aren't in the interface
     # The list included in the MODS constant matches the EESDR v3 beta interface for obvious scroll order
     mod = get_param("MODULATION", rx, subrx)
@@ -365,278 +775,1540 @@ def do_volume_reset(val, rx, subrx):
         return []
 
 async def run_cmds(tci_listener, cmds):
-    for c in cmds:
-        await tci_listener.send(c)
+    await tci_listener.send(Batch(cmds))
+
+# Commands where only the newest value matters, with their max send rate per rx/subrx (per second)
+# A write still waiting is replaced by the new one, all other commands go out in order and are never dropped
+CONTINUOUS = {"DDS": 50, "IF": 50, "VFO": 50, "RIT_OFFSET": 50, "RX_FILTER_BAND": 25,
+              "DRIVE": 25, "VOLUME": 25, "MON_VOLUME": 25, "RX_VOLUME": 25, "RX_BALANCE": 25}
+# Commands sent before everything else (PTT and mute)
+PRIORITY = {"TRX", "TUNE", "MUTE", "RX_MUTE"}
+
+class Batch(tuple):
+    # Commands sent together and in order by one turn of the sender, nothing goes out between them
+    # (band change, VFO swap, macros). They are not collapsed with the continuous values, which they replace
+    pass
+
+def command_name(cmd):
+    return cmd.partition(":")[0].rstrip(";").upper() if isinstance(cmd, str) else None
+
+def command_slot(cmd):
+    # "IF:0,1,500;" -> ("IF", 0, 1), the same (name, rx, subrx) as the echo received by the param listeners
+    name = command_name(cmd)
+    info = tci.COMMANDS.get(name)
+    if info is None:
+        return None
+    args = cmd.rstrip(";").partition(":")[2].split(",")
+    try:
+        rx = int(args[0]) if info.has_rx else None
+        subrx = int(args[1]) if info.has_sub_rx else None
+    except (ValueError, IndexError):
+        return None
+    return (name, rx, subrx)
+
+def command_key(cmd):
+    # "DRIVE:0,50;" -> ("DRIVE", "0"), the command name and its rx/subrx, None if it is not a continuous command
+    name = command_name(cmd)
+    if name not in CONTINUOUS:
+        return None
+    info = tci.COMMANDS[name]
+    return (name,) + tuple(cmd.rstrip(";").partition(":")[2].split(",")[:info.has_rx + info.has_sub_rx])
+
+class CountingSocket:
+    # The websocket as seen by Listener._listen_main, counts the messages of ExpertSDR for TciLink.handshake()
+    def __init__(self, ws, link):
+        self.ws = ws
+        self.link = link
+
+    async def recv(self):
+        msg = await self.ws.recv()
+        self.link.received += 1
+        return msg
+
+    def __getattr__(self, name):
+        return getattr(self.ws, name)
+
+class TciLink(Listener):
+    # Listener whose sender task drains our own queues instead of a single FIFO:
+    # first the priority commands, then the buttons in order, then the newest continuous values
+    def __init__(self, uri, rates = CONTINUOUS, optimistic = True, radio = None):
+        super().__init__(uri)
+        self.radio = radio or default_radio
+        self.rates = rates
+        self.optimistic = optimistic  # apply our writes to the state before the echo, see PendingWrites
+        self._urgent = deque()  # PTT and mute
+        self._fifo = deque()    # buttons and toggles, in order
+        self._latest = {}       # key -> newest continuous command not sent yet
+        self._last_sent = {}    # key -> time of the last send
+        self._wakeup = asyncio.Event()
+        self._connected_event = asyncio.Event()  # the same events for every connection, see start() and ready()
+        self._ready_event = asyncio.Event()
+        self.replaced = 0       # continuous commands replaced before going out
+        self.stats = LatencyStats()
+        self._echo_wait = {}    # (name, rx, subrx) -> (trace, time of the send) until ExpertSDR echoes the value
+        self._ack_waiters = {}  # (name, rx, subrx) -> futures done on the next echo, see expect_echoes()
+        self.recorder = None    # SessionRecorder of the TCI messages in and out
+        self.proxy = None       # TciProxy sending what we receive to its clients, see PROXY_PORT
+        self.keyer = None       # CwKeyer of this radio, see CW_KEYER
+        self.start_cmds = []    # sent after every handshake, e.g. IQ_START (IQ_SNAP)
+        self.connected = False
+        self.sessions = 0       # connections to ExpertSDR, 1 + the reconnects
+        self.received = 0       # messages of ExpertSDR, a handshake which goes on is not timed out (see handshake())
+        self._connected_at = None
+        self._recovering = None # (time of the disconnect, time of the new connection) until a command is echoed
+        self._closing = False
+        self.add_param_listener("*", self._echo)
+
+    async def start(self, timeout = 3.0):
+        # Like Listener.start, but a refused connection raises at once instead of after the timeout
+        # The listener and sender tasks are created here, they keep our radio as current_radio
+        if self._launch_task is not None and not self._launch_task.done():
+            return
+        self._tci_send = asyncio.Queue()
+        self._connected_event.clear()
+        self._ready_event.clear()
+        token = current_radio.set(self.radio)
+        try:
+            self._launch_task = asyncio.create_task(self._launch_tasks())
+        finally:
+            current_radio.reset(token)
+        connected = asyncio.create_task(self._connected_event.wait())
+        done, _ = await asyncio.wait([connected, self._launch_task], timeout = timeout, return_when = asyncio.FIRST_COMPLETED)
+        if connected in done:
+            return
+        connected.cancel()
+        if self._launch_task.done():
+            self._launch_task.result()  # the connection error
+            raise ConnectionError(f"TCI connection to {self.uri} closed")
+        self._launch_task.cancel()
+        raise TimeoutError(f"Connected event not received after {timeout} sec.")
+
+    async def ready(self, timeout = 3.0):
+        # Like Listener.ready, but a timeout leaves the connection alone (Listener.ready cancels it):
+        # a proxy client waiting for the handshake must not close the link of the controller
+        try:
+            await asyncio.wait_for(self._ready_event.wait(), timeout)
+        except asyncio.TimeoutError:
+            raise TimeoutError(f"Ready event not received after {timeout} sec.") from None
+
+    async def handshake(self, timeout = None):
+        # Waits for the READY of the connection started: a slow handshake is waited for as long as ExpertSDR
+        # sends something, the connection is dropped after timeout (HANDSHAKE_TIMEOUT) seconds of silence
+        timeout = timeout or HANDSHAKE_TIMEOUT
+        received = None
+        while received != self.received:
+            received = self.received
+            ready = asyncio.create_task(self._ready_event.wait())
+            done, _ = await asyncio.wait([ready, self._launch_task], timeout = timeout, return_when = asyncio.FIRST_COMPLETED)
+            if ready in done:
+                return
+            ready.cancel()
+            if self._launch_task in done:
+                self._launch_task.result()  # the connection error
+                raise ConnectionError(f"TCI connection to {self.uri} closed before READY")
+        self._launch_task.cancel()
+        raise TimeoutError(f"Nothing received for {timeout} sec. before READY")
+
+    def shutdown(self):
+        self._closing = True
+        super().shutdown()
+
+    async def _launch_tasks(self):
+        # One connection: the state of a previous session is dropped before the new handshake is read,
+        # the sender is stopped with the listener so the commands not sent wait for the next connection
+        try:
+            async with websockets.connect(self.uri) as ws:
+                self._connected_at = time.perf_counter()
+                if self.sessions:
+                    self.radio.state.clear()
+                    self.radio.pending_writes.clear()
+                    self._echo_wait.clear()
+                self.sessions += 1
+                self.connected = True
+                listen_task = asyncio.create_task(self._listen_main(ws))
+                sender_task = asyncio.create_task(self._sender_main(ws))
+                self._connected_event.set()
+                try:
+                    await listen_task
+                except websockets.ConnectionClosed:
+                    pass
+                finally:
+                    self.connected = False
+                    self._ready_event.clear()  # until the handshake of the next connection
+                    listen_task.cancel()
+                    sender_task.cancel()
+        except asyncio.CancelledError:
+            if not self._closing:  # cancelled from outside (supervise, main), not by shutdown()
+                raise
+
+    async def supervise(self):
+        # Connects and keeps the link up until shutdown(): when ExpertSDR is not started yet, is restarted
+        # or the websocket drops, it connects again with backoff (RECONNECT_DELAYS) while midi_rx goes on,
+        # the commands wait in the queues with the continuous values collapsed, and the new handshake replaces the state
+        lost = None
+        while not self._closing:
+            attempt = 0
+            while not self._closing:
+                if attempt or lost is not None:
+                    await asyncio.sleep(RECONNECT_DELAYS[min(attempt, len(RECONNECT_DELAYS) - 1)])
+                attempt += 1
+                try:
+                    await self.start()
+                    await self.handshake()
+                    break
+                except (OSError, TimeoutError, websockets.WebSocketException) as exc:
+                    if self._launch_task is not None:
+                        self._launch_task.cancel()  # no READY: the next attempt opens a new connection
+                    if attempt == 1 and lost is None:
+                        log.warning("TCI %s: %r, trying again", self.uri, exc)
+            if self._closing:
+                return
+            if lost is not None:
+                log.warning("TCI %s back after %d attempts", self.uri, attempt)
+                if self._urgent or self._fifo or self._latest:
+                    self._recovering = (lost, self._connected_at)  # measured on the first echo, see _echo
+                else:
+                    self._recovered(lost, self._connected_at)
+            elif attempt > 1:
+                log.warning("TCI %s connected after %d attempts", self.uri, attempt)
+            try:
+                await self.wait()
+            except Exception as exc:
+                log.warning("TCI %s: %r", self.uri, exc)
+            if self._closing:
+                return
+            lost = time.perf_counter()
+            log.warning("TCI %s lost, reconnecting", self.uri)
+
+    def _recovered(self, lost, connected_at):
+        # outage: from the disconnect, recovery: from the new connection, to the first command accepted
+        now = time.perf_counter()
+        self.stats.record("TCI", "outage", now - lost)
+        self.stats.record("TCI", "recovery", now - connected_at)
+
+    async def send(self, data, trace = None):
+        self.send_nowait(data, trace)
+
+    def send_nowait(self, data, trace = None):
+        # trace is (midi callback, dequeue, handler exit) times for the latency histograms
+        if isinstance(data, Batch):
+            for cmd in data:
+                if self.optimistic:
+                    self.radio.pending_writes.write(cmd)
+                key = command_key(cmd)
+                if key in self._latest:  # an older value would undo the batch
+                    self.replaced += 1
+                    del self._latest[key]
+            self._fifo.append((data, trace))
+            self._wakeup.set()
+            return
+        for cmd in (data if isinstance(data, list) else [data]):
+            if self.optimistic:
+                self.radio.pending_writes.write(cmd)
+            if command_name(cmd) in PRIORITY:
+                if not self.connected:  # only the last PTT/mute of each rx goes out after the reconnect
+                    slot = command_slot(cmd)
+                    self._urgent = deque(item for item in self._urgent if command_slot(item[0]) != slot)
+                self._urgent.append((cmd, trace))
+                continue
+            key = command_key(cmd)
+            if key is None:
+                self._fifo.append((cmd, trace))
+            else:
+                if key in self._latest:
+                    self.replaced += 1
+                    del self._latest[key]
+                self._latest[key] = (cmd, trace)
+        self._wakeup.set()
+
+    def _sent(self, cmd, trace):
+        if trace is None:
+            return
+        now = time.perf_counter()
+        self.stats.record_send(command_name(cmd), trace, now)
+        slot = command_slot(cmd)
+        if slot is not None:
+            self._echo_wait[slot] = (trace, now)
+
+    def _schedule_callback(self, callback, *callback_args):
+        # The plain functions (update_params...) are called at once instead of in a new task for every parameter
+        if asyncio.iscoroutinefunction(callback):
+            super()._schedule_callback(callback, *callback_args)
+        else:
+            callback(*callback_args)
+
+    def expect_echoes(self, cmds):
+        # Called before the commands are sent: slot -> future done when ExpertSDR echoes the slot
+        # A write of the value the slot already has is not waited for, ExpertSDR may not echo it
+        loop = asyncio.get_running_loop()
+        acks = {}
+        for cmd in cmds:
+            slot = command_slot(cmd)
+            if slot is not None and slot not in acks and not self.radio.pending_writes.unchanged(cmd):
+                acks[slot] = loop.create_future()
+                self._ack_waiters.setdefault(slot, []).append(acks[slot])
+        return acks
+
+    async def wait_echoes(self, acks, timeout):
+        # returns the slots not echoed before the timeout
+        if acks:
+            await asyncio.wait(acks.values(), timeout = timeout)
+        missing = []
+        for slot, fut in acks.items():
+            if not fut.done():
+                missing.append(slot)
+                fut.cancel()
+                waiters = self._ack_waiters.get(slot)
+                if waiters is not None and fut in waiters:
+                    waiters.remove(fut)
+                    if not waiters:
+                        del self._ack_waiters[slot]
+        return missing
+
+    def _echo(self, name, rx, subrx, params):
+        if self._ack_waiters:
+            for fut in self._ack_waiters.pop((name, rx, subrx), ()):
+                if not fut.done():
+                    fut.set_result(params)
+        if not self._echo_wait:
+            return
+        wait = self._echo_wait.pop((name, rx, subrx), None)
+        if wait is not None:
+            now = time.perf_counter()
+            self.stats.record(name, "echo", now - wait[1])
+            self.stats.record(name, "round_trip", now - wait[0][0])
+            if self._recovering is not None:
+                self._recovered(*self._recovering)
+                self._recovering = None
 
-def midi_stream():
+    def _next_command(self, now):
+        # returns ((command, trace), None) or (None, seconds to wait before the next continuous command can go)
+        if self._urgent:
+            return self._urgent.popleft(), None
+        if self._fifo:
+            return self._fifo.popleft(), None
+        delay = None
+        for key in self._latest:
+            wait = self._last_sent.get(key, 0) + 1 / self.rates[key[0]] - now
+            if wait <= 0:
+                self._last_sent[key] = now
+                return self._latest.pop(key), None
+            if delay is None or wait < delay:
+                delay = wait
+        return None, delay
+
+    def _requeue(self, item):
+        # a command whose send failed goes back in front of its queue, unless a newer value is waiting
+        if isinstance(item[0], Batch):
+            self._fifo.appendleft(item)
+            return
+        if command_name(item[0]) in PRIORITY:
+            self._urgent.appendleft(item)
+            return
+        key = command_key(item[0])
+        if key is None:
+            self._fifo.appendleft(item)
+        elif key not in self._latest:
+            self._latest[key] = item
+
+    async def _listen_main(self, ws):
+        ws = CountingSocket(ws, self)
+        if self.recorder is not None:
+            ws = self.recorder.wrap_socket(ws)
+        if self.proxy is not None:
+            ws = self.proxy.wrap_socket(ws)
+        if self.radio.spectra:  # the IQ packets go to the spectra before the Listener sees them
+            from iq_peaks import IqSocket
+            ws = IqSocket(ws, self.radio.spectra)
+        await super()._listen_main(ws)
+
+    async def _sender_main(self, ws):
+        # One command per turn so a PTT never waits for more than the send in progress
+        # Nothing is sent before the handshake is over (READY)
+        loop = asyncio.get_running_loop()
+        await self._ready_event.wait()
+        for cmd in self.start_cmds:
+            await ws.send(cmd)
+        while True:
+            self._wakeup.clear()
+            item, delay = self._next_command(loop.time())
+            if item is not None:
+                cmds = item[0] if isinstance(item[0], Batch) else (item[0],)
+                for i, cmd in enumerate(cmds):
+                    try:
+                        await ws.send(cmd)
+                    except (websockets.ConnectionClosed, asyncio.CancelledError):
+                        self._requeue((Batch(cmds[i:]), item[1]) if isinstance(item[0], Batch) else item)
+                        raise
+                    if self.recorder is not None:
+                        self.recorder.tci_out(cmd)
+                    self._sent(cmd, item[1])
+                continue
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), delay)
+            except asyncio.TimeoutError:
+                pass
+
+JOG_WINDOW = 0.008 # seconds during which the jog ticks are summed, 0 = only what is already in the queue
+
+def jog_delta(val):
+    if val == MIDI.ENCUP:
+        return 1
+    if val == MIDI.ENCDOWN:
+        return -1
+    return 0
+
+JOG_ACCEL = True # the VFO step of the jog grows with the speed of the spin, a slow spin keeps vfo_step
+JOG_SMOOTHING = 0.3 # weight of the newest speed in the average speed of the jog (exponential moving average)
+JOG_IDLE = 0.25 # seconds without a tick after which the jog starts again from vfo_step
+JOG_CURVES = { # modulation -> (ticks per second where the step starts to grow, exponent, largest step in Hz)
+    "CW":   (100, 2.0, 1000),   # step = vfo_step * (speed / start) ** exponent, rounded down to JOG_GRID
+    "LSB":  (100, 2.0, 2500),   # and the modulations not in this table
+    "USB":  (100, 2.0, 2500),
+    "DIGL": (100, 2.0, 1000),
+    "DIGU": (100, 2.0, 1000),
+    "AM":   (100, 2.0, 5000),
+    "NFM":  (100, 2.0, 12500),
+    "WFM":  (100, 2.0, 100000),
+}
+JOG_GRID = (10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000, 12500, 25000, 50000, 100000)
+
+class JogAccel:
+    # Speed of a jog in ticks per second, from the midi timestamps of its bursts of ticks, and the step it gives
+    def __init__(self, smoothing = JOG_SMOOTHING, idle = JOG_IDLE):
+        self.smoothing = smoothing
+        self.idle = idle
+        self.speed = 0.0
+        self.last = None    # time of the previous burst
+
+    def update(self, ticks, t):
+        dt = t - self.last if self.last is not None else None
+        self.last = t
+        if dt is None or dt > self.idle:
+            self.speed = 0.0
+        else:
+            self.speed += self.smoothing * (ticks / max(dt, 0.001) - self.speed)
+        return self.speed
+
+    def step(self, ticks, t, base, curve):
+        start, exponent, largest = curve
+        speed = self.update(ticks, t)
+        if speed <= start:
+            return base
+        step = min(base * (speed / start) ** exponent, largest)
+        return max(base, JOG_GRID[max(bisect_right(JOG_GRID, step) - 1, 0)])
+
+MIDI_RING_SIZE = 256 # midi events waiting for midi_rx, when they are more the knobs and the jogs are collapsed
+
+class MidiRing:
+    # Bounded queue between the rtmidi thread and midi_rx, its slots are allocated once.
+    # When it is full (midi_rx stalled): a jog tick is added to the newest tick waiting for the same jog,
+    # a knob or fader value replaces the newest value waiting for the same control, and a note (button)
+    # goes to an overflow list which keeps the order, so the buttons are never lost
+    def __init__(self, size = MIDI_RING_SIZE):
+        self.size = size
+        self.slots = [[None, None] for _ in range(size)]   # [event, signed jog ticks or None if not a jog]
+        self.head = 0           # oldest slot
+        self.count = 0
+        self.spill = deque()    # overflow, the ring is used again when it is empty
+        self.lock = threading.Lock()
+        self.max_depth = 0
+        self.dropped = 0        # knob values replaced by a newer one
+        self.summed = 0         # jog ticks added to a waiting one
+        self.spilled = 0        # events put in the overflow list
+
+    def depth(self):
+        return self.count + len(self.spill)
+
+    def push(self, ev, ticks = None):
+        # called from the rtmidi thread, ticks is the signed jog tick (None if ev is not a jog),
+        # returns True when the queue was empty and the reader may be waiting
+        with self.lock:
+            if self.count < self.size and not self.spill:
+                slot = self.slots[(self.head + self.count) % self.size]
+                slot[0] = ev
+                slot[1] = ticks
+                self.count += 1
+                if self.count > self.max_depth:
+                    self.max_depth = self.count
+                return self.count == 1
+            if ev[0] & 0xF0 == CONTROL_CHANGE:
+                entry = self._newest(ev, ticks)
+                if entry is not None:
+                    if ticks is not None:   # the sum may be 0, the entry stays a jog and is dropped by the reader
+                        entry[1] += ticks
+                        self.summed += 1
+                    else:
+                        entry[0] = ev
+                        self.dropped += 1
+                    return False
+            self.spill.append([ev, ticks])
+            self.spilled += 1
+            return False
+
+    def _newest(self, ev, ticks):
+        # the newest waiting entry of the same control and the same kind (jog or value), None if there is none
+        for entry in reversed(self.spill):
+            if entry[0][0] == ev[0] and entry[0][1] == ev[1] and (entry[1] is None) == (ticks is None):
+                return entry
+        for i in range(self.count - 1, -1, -1):
+            entry = self.slots[(self.head + i) % self.size]
+            if entry[0][0] == ev[0] and entry[0][1] == ev[1] and (entry[1] is None) == (ticks is None):
+                return entry
+        return None
+
+    def peek(self):
+        # (event, ticks) of the oldest entry or None
+        with self.lock:
+            if self.count:
+                slot = self.slots[self.head]
+                return slot[0], slot[1]
+            if self.spill:
+                return self.spill[0][0], self.spill[0][1]
+            return None
+
+    def pop(self):
+        with self.lock:
+            if self.count:
+                slot = self.slots[self.head]
+                entry = (slot[0], slot[1])
+                slot[0] = None
+                self.head = (self.head + 1) % self.size
+                self.count -= 1
+                return entry
+            if self.spill:
+                entry = self.spill.popleft()
+                return entry[0], entry[1]
+            return None
+
+def midi_stream(is_jog = None, window = JOG_WINDOW, is_priority = None, ring = None):
+    # The events are the 3 midi bytes and the time of the callback (status, data1, data2, time) as a tuple
+    # The priority events (PTT, mute) have their own lane and cut the jog window short,
+    # the others wait in a MidiRing
     loop = asyncio.get_event_loop()
-    queue = asyncio.Queue()
-    def callback(msg):
-        loop.call_soon_threadsafe(queue.put_nowait, msg)
+    ring = ring or MidiRing()
+    urgent = deque()
+    ready = asyncio.Event()
+    hurry = asyncio.Event()
+    def callback(ev):
+        # called from the rtmidi thread, deque.append is thread safe, the loop is woken only when the queue was empty
+        # a jog value which is not a tick (CLICK) is not summed, it goes through as it is
+        if is_priority is not None and is_priority(ev):
+            urgent.append(ev)
+            loop.call_soon_threadsafe(hurry.set)
+            loop.call_soon_threadsafe(ready.set)
+        elif ring.push(ev, (jog_delta(ev[2]) or None) if is_jog is not None and is_jog(ev) else None):
+            loop.call_soon_threadsafe(ready.set)
     async def stream():
+        # yield (ev, ticks), ticks is the number of jog steps summed in ev (1 for all other events)
         while True:
-            yield await queue.get()
+            if urgent:
+                yield urgent.popleft(), 1
+                continue
+            entry = ring.pop()
+            if entry is None:
+                ready.clear()
+                hurry.clear()
+                if not ring.depth() and not urgent:
+                    await ready.wait()
+                continue
+            ev, ticks = entry
+            if ticks is None:
+                yield ev, 1
+                continue
+            # Sum the consecutive ticks of the same jog so the handler does one write for the whole burst
+            if window > 0 and not urgent:
+                hurry.clear()
+                try:
+                    await asyncio.wait_for(hurry.wait(), window)
+                except asyncio.TimeoutError:
+                    pass
+            while urgent:
+                yield urgent.popleft(), 1
+            while True:
+                nxt = ring.peek()
+                if nxt is None or nxt[1] is None or nxt[0][0] != ev[0] or nxt[0][1] != ev[1]:
+                    break
+                ticks += ring.pop()[1]
+            if ticks > 0:
+                yield (ev[0], ev[1], MIDI.ENCUP, ev[3]), ticks
+            elif ticks < 0:
+                yield (ev[0], ev[1], MIDI.ENCDOWN, ev[3]), -ticks
     return callback, stream()
 
-def set_power(msg, curr_rx):
-    val = int((100 * msg.value) / 127)
-    trx_cmd = f"DRIVE:{curr_rx},{val};"
-    print(f"Drive is {val}% of 20 Watts, soit {val * 20 / 100} Watts")
-    return trx_cmd
-
-def set_volume(msg, curr_rx):   # Volume 0 to -60 dB 
-    val = int((60 * msg.value) / 127)
-    print(f"Volume is -{val} dB")
-    trx_cmd = f"VOLUME:{-val};"
-    return trx_cmd
-
-async def midi_rx(tci_listener, midi_port):
-    global params_dict, trx_cmd
-    lower_filter = 200
-    higher_filter = 200
-    curr_subx = 0
-    curr_rx = 0
-    knob_plane = 0
-    debug = True
-    key = False
-    cb, stream = midi_stream()
-    mido.open_input(midi_port, virtual = False, callback=cb)
-    # print(f"cb is {cb} and stream is {stream}", )
-    mod = get_param("MODULATION", curr_rx, curr_subx)
-    print(f"mod is {mod}")
+def load_rtmidi():
+    # python-rtmidi, imported on first use (not needed by the benchmarks and the replay), None if missing
+    try:
+        import rtmidi
+    except ImportError:
+        return None
+    return rtmidi
+
+_port_lister = None # rtmidi client kept for the hot-plug polls, one new client per poll would cost more
+
+def midi_input_names(raw = RAW_MIDI):
+    global _port_lister
+    rtmidi = load_rtmidi() if raw else None
+    if rtmidi is not None:
+        if _port_lister is None:
+            _port_lister = rtmidi.MidiIn()
+        return _port_lister.get_ports()   # the same names as mido with its rtmidi backend
+    import mido
+    return mido.get_input_names()
+
+def open_midi_input(midi_port, callback, raw = RAW_MIDI):
+    # callback receives (status, data1, data2, time), keep the returned port object alive
+    rtmidi = load_rtmidi() if raw else None
+    if rtmidi is not None:
+        midi_in = rtmidi.MidiIn()
+        midi_in.open_port(midi_in.get_ports().index(midi_port))
+        def raw_callback(event, data = None):
+            m = event[0]
+            if len(m) == 3:
+                callback((m[0], m[1], m[2], time.perf_counter()))
+        midi_in.set_callback(raw_callback)
+        return midi_in
+    # mido fallback, the Message is turned back into its bytes
+    import mido
+    def msg_callback(msg):
+        m = msg.bytes()
+        if len(m) == 3:
+            callback((m[0], m[1], m[2], time.perf_counter()))
+    return mido.open_input(midi_port, virtual = False, callback = msg_callback)
+
+def midi_output_for(midi_port, names):
+    # the output of the same controller: the same name, or the same name but the port number (Windows)
+    if midi_port in names:
+        return midi_port
+    base = midi_port.rstrip("0123456789 ")
+    return next((name for name in names if name.rstrip("0123456789 ") == base), None)
+
+def open_midi_output(midi_port, raw = RAW_MIDI):
+    # the output of the controller for its LEDs, None if it has none
+    rtmidi = load_rtmidi() if raw else None
+    if rtmidi is not None:
+        midi_out = rtmidi.MidiOut()
+        name = midi_output_for(midi_port, midi_out.get_ports())
+        if name is None:
+            return None
+        midi_out.open_port(midi_out.get_ports().index(name))
+        return midi_out
+    import mido
+    name = midi_output_for(midi_port, mido.get_output_names())
+    return mido.open_output(name) if name is not None else None
+
+def send_midi(midi_out, messages):
+    # messages is a list of (status, data1, data2), blocking: called from an executor thread
+    if hasattr(midi_out, "send_message"):  # rtmidi
+        for m in messages:
+            midi_out.send_message(m)
+    else:                                  # mido
+        import mido
+        for m in messages:
+            midi_out.send(mido.Message.from_bytes(m))
+
+def close_midi_port(midi_port):
+    if midi_port is None:
+        return
+    if hasattr(midi_port, "close_port"):  # rtmidi
+        if hasattr(midi_port, "cancel_callback"):
+            midi_port.cancel_callback()
+        midi_port.close_port()
+    else:                                 # mido
+        midi_port.close()
+
+# ** Absolute controls (faders and pots): the 128 positions are looked up in tables built at startup **
+
+CURVES = { # position 0..1 -> part of the range
+    "linear": lambda x: x,  # linear in the unit of the parameter: dB for the volumes
+    "watt": math.sqrt,      # drive: the output power goes with the square of the drive, it is linear with the fader
+}
+FADERS = { # parameter -> (value at 0, value at 127, curve), a key (parameter, modulation) is used in this mode only
+    "DRIVE": (0, 100, "linear"),        # e.g. ("DRIVE", "DIGU"): (0, 40, "watt")
+    "VOLUME": (0, -60, "linear"),
+    "MON_VOLUME": (0, -60, "linear"),
+}
+FILTER_POTS = { # modulation -> ((low edge at 0, at 127), (high edge at 0, at 127)) in Hz, turning up widens
+    "CW":   ((-25, -1000), (25, 1000)),
+    "LSB":  ((-1500, -4000), (-500, -25)),
+    "USB":  ((500, 25), (1500, 4000)),
+    "DIGL": ((-1500, -4000), (-500, -25)),
+    "DIGU": ((500, 25), (1500, 4000)),
+    "AM":   ((-1500, -8000), (1500, 8000)),     # and the modulations not in this table
+    "NFM":  ((-3000, -12000), (3000, 12000)),
+    "WFM":  ((-12000, -100000), (12000, 100000)),
+}
+
+class FaderTable:
+    # The value of every position of an absolute control and, for each rx, the command ready to send
+    def __init__(self, name, lo, hi, curve = "linear"):
+        shape = CURVES[curve]
+        self.values = tuple(round(lo + (hi - lo) * shape(i / 127)) for i in range(128))
+        # the largest step: a pot this close to the value of the radio has caught it
+        self.tolerance = max(abs(b - a) for a, b in zip(self.values, self.values[1:]))
+        self.cmds = None
+        if name is not None:
+            info = tci.COMMANDS[name]
+            self.cmds = {rx: tuple(info.prepare_string(TciCommandSendAction.WRITE, rx = rx, params = [v]) for v in self.values)
+                         for rx in ((0, 1) if info.has_rx else (None,))}
+
+def build_fader_tables(faders = FADERS):
+    return {key: FaderTable(key if isinstance(key, str) else key[0], *spec) for key, spec in faders.items()}
+
+def build_filter_tables(filter_pots = FILTER_POTS):
+    return {mod: (FaderTable(None, *low), FaderTable(None, *high)) for mod, (low, high) in filter_pots.items()}
+
+FADER_TABLES = build_fader_tables()
+FILTER_TABLES = build_filter_tables()
+
+def modulation(rx, subrx = None, radio = None):
+    return (radio or current_radio.get()).modulation[rx]()
+
+class Takeover:
+    # Soft takeover of the absolute controls of a deck. When the value of the radio has been changed elsewhere
+    # (screen, band stack, macro, mode), the pot writes nothing until it reaches or crosses that value,
+    # then it follows the pot again. A position giving the value the radio already has is not written
+    def __init__(self):
+        self.last = {}      # key -> (position, value written, None while the pot has not caught the radio)
+        self.blocked = 0    # moves not written
+
+    def move(self, key, pos, table, current):
+        values = table.values
+        new = values[pos]
+        last = self.last.get(key)
+        if (current is None or last is not None and last[1] == current or abs(new - current) <= table.tolerance
+                or last is not None and (values[last[0]] - current) * (new - current) < 0):
+            self.last[key] = (pos, new)
+            return new != current
+        self.last[key] = (pos, None)
+        self.blocked += 1
+        return False
+
+def fader_table(name, rx, radio = None):
+    return FADER_TABLES.get((name, modulation(rx, None, radio))) or FADER_TABLES[name]
+
+def do_fader(deck, name, value):
+    # The command of the position for the rx of the deck, [] until the pot has caught the value of the radio
+    rx = deck.curr_rx
+    table = fader_table(name, rx, deck.radio)
+    cmds = table.cmds.get(rx) or table.cmds[None]
+    current = deck.faders[name][rx]()
+    if not deck.takeover.move((name, rx), value, table, current):
+        return []
+    return cmds[value]
+
+def do_filter_pot(deck, side, value):
+    # One edge of the filter (0 low, 1 high) from the table of the mode, the other edge stays
+    rx, subrx = deck.curr_rx, deck.curr_subx
+    flt = deck.radio.filter_band[rx]()
+    if flt is None:
+        return []
+    flt = list(flt)
+    table = FILTER_TABLES.get(modulation(rx, subrx, deck.radio)) or FILTER_TABLES["AM"]
+    table = table[side]
+    if not deck.takeover.move(("RX_FILTER_BAND", rx, side), value, table, flt[side]):
+        return []
+    flt[side] = table.values[value]
+    return [ tci.COMMANDS["RX_FILTER_BAND"].prepare_string(TciCommandSendAction.WRITE, rx=rx, params=flt) ]
+
+class Deck: # State of one MIDI controller: the rx/subrx it drives and its steps
+    def __init__(self, tci_listener, midi_port):
+        self.tci_listener = tci_listener
+        self.midi_port = midi_port
+        self.radio = tci_listener.radio
+        # the values of the faders per rx, bound once like the tuning getters of the radio
+        self.faders = {name: [self.radio.state.getter(name, rx, default = None) for rx in range(2)]
+                       for name in {key if isinstance(key, str) else key[0] for key in FADER_TABLES}}
+        self.curr_rx = 0
+        self.curr_subx = 0
+        self.vfo_step = 100
+        self.rit_step = 10
+        self.takeover = Takeover()  # of the faders and pots
+        self.jog = JogAccel()       # speed of the VFO jog
+        self.debug = True
+        self.midi_in = None
+        self.events = 0     # midi events handled
+        self.ring = None    # MidiRing of the events waiting
+        self.leds = None    # LedOutput of the controller
+        self.macro_task = None
+        self.event_time = 0.0   # midi timestamp of the event being handled, the straight key is timed from it
+
+# ** Handlers called by the dispatch table, all are handler(deck, value, ticks) and return the TCI command(s) **
+
+def h_power(deck, value, ticks):               # Power 0 to 100%
+    deck.debug = False
+    cmd = do_fader(deck, "DRIVE", value)
+    if cmd:
+        log.info("Drive is %s%% of 20 Watts", fader_table("DRIVE", deck.curr_rx, deck.radio).values[value])
+    return cmd
+
+def h_volume(deck, value, ticks):              # Volume 0 to -60 dB
+    return do_fader(deck, "VOLUME", value)
+
+def h_mon_volume(deck, value, ticks):          # Monitor Volume 0 to -60 dB
+    return do_fader(deck, "MON_VOLUME", value)
+
+def h_freq_scroll(deck, value, ticks):         # Frequency Scroll, faster with the speed of the jog
+    if JOG_ACCEL and value in (MIDI.ENCUP, MIDI.ENCDOWN):
+        mod = modulation(deck.curr_rx, deck.curr_subx, deck.radio)
+        step = deck.jog.step(ticks, deck.event_time, deck.vfo_step, JOG_CURVES.get(mod) or JOG_CURVES["USB"])
+        if step > deck.vfo_step:
+            return do_freq_jump(step, ticks if value == MIDI.ENCUP else -ticks, deck.curr_rx, deck.curr_subx, deck.radio)
+    return do_freq_scroll(deck.vfo_step * ticks, value, deck.curr_rx, deck.curr_subx, deck.radio)
+
+def h_rit_scroll(deck, value, ticks):          # RIT Scroll
+    return do_rit_scroll(deck.rit_step * ticks, value, deck.curr_rx, deck.curr_subx)
+
+def h_filter_low(deck, value, ticks):          # Low edge of the RX filter (FILTER_POTS)
+    return do_filter_pot(deck, 0, value)
+
+def h_filter_high(deck, value, ticks):         # High edge of the RX filter (FILTER_POTS)
+    return do_filter_pot(deck, 1, value)
+
+h_filter_scroll_left = h_filter_low    # the names of the Starlight bass pots before version 1.5
+h_filter_scroll_right = h_filter_high
+
+def h_listen_vfob(deck, value, ticks):         # Listen with VFOB
+    deck.curr_subx = 1
+    return do_toggle("RX_CHANNEL_ENABLE", MIDI.KEYDOWN, deck.curr_rx, 1)
+
+def h_equalize_vfo(deck, value, ticks):        # Equalize VFOs
+    TXFreqVFOA = get_param("VFO", deck.curr_rx, 0)
+    return f"VFO:{deck.curr_rx},1,{TXFreqVFOA};"      # VFO A --> B
+
+def h_swap_vfo(deck, value, ticks):            # SWAP VFOs
+    TXFreqVFOA = get_param("VFO", deck.curr_rx, 0)
+    TXFreqVFOB = get_param("VFO", deck.curr_rx, 1)
+    log.info("TXFreq is %s and %s", TXFreqVFOA, TXFreqVFOB)
+    return Batch([ f"VFO:{deck.curr_rx},1,{TXFreqVFOA};",      # VFO A = B
+                   f"VFO:{deck.curr_rx},0,{TXFreqVFOB};" ])   # Now Swap VFO
+
+def h_select_rx(deck, value, ticks):           # Select RX
+    deck.curr_subx = 0
+
+def h_rit_toggle(deck, value, ticks):          # Toggle RIT
+    return do_toggle("RIT_ENABLE", MIDI.KEYDOWN, deck.curr_rx, deck.curr_subx)
+
+def h_rit_toggle_rx1(deck, value, ticks):      # Toggle RIT on RX1
+    deck.curr_rx = 0
+    return do_toggle("RIT_ENABLE", MIDI.KEYDOWN, deck.curr_rx, deck.curr_subx)
+
+def h_rit_toggle_rx2(deck, value, ticks):      # Toggle RIT on RX2
+    deck.curr_rx = 1
+    return do_toggle("RIT_ENABLE", MIDI.KEYDOWN, deck.curr_rx, deck.curr_subx)
+
+def h_rit_clear(deck, value, ticks):           # Clear RIT
+    return f"RIT_OFFSET:{deck.curr_rx},0;"
+
+def h_mon_toggle(deck, value, ticks):          # Toggle Monitor On/Off
+    return do_toggle("MON_ENABLE", MIDI.KEYDOWN, deck.curr_rx, deck.curr_subx)
+
+def h_mute_toggle(deck, value, ticks):         # Toggle Mute On/Off
+    return do_toggle("MUTE", MIDI.KEYDOWN, deck.curr_rx, deck.curr_subx)
+
+def h_mode_down(deck, value, ticks):           # Change Mode Down
+    return do_mod_scroll(MIDI.ENCDOWN, deck.curr_rx, deck.curr_subx)
+
+def h_mode_up(deck, value, ticks):             # Change Mode Up
+    return do_mod_scroll(MIDI.ENCUP, deck.curr_rx, deck.curr_subx)
+
+def h_vfo_step(deck, value, ticks):            # change vfo_step 25, 50, 100, 200
+    if deck.vfo_step == 200:
+        deck.vfo_step = 25
+    else: deck.vfo_step *= 2
+    log.info("vfo_step is %d", deck.vfo_step)
+
+def h_vfo_step_10(deck, value, ticks):         # vfo_step is 10 Hz
+    deck.vfo_step = 10
+
+def h_ptt_on(deck, value, ticks):              # TX on when button down
+    return f"TRX:{deck.curr_rx},true;"
+
+def h_ptt_off(deck, value, ticks):             # RX is back when button up
+    return f"TRX:{deck.curr_rx},false;"
+
+def h_ptt_mic_on(deck, value, ticks):          # TX on with the PC micro when button down
+    return f"TRX:{deck.curr_rx},true,micPC;"
+
+def h_ptt_mic_off(deck, value, ticks):         # RX is back when button up
+    return f"TRX:{deck.curr_rx},false,micPC;"
+
+def h_filter_narrow(deck, value, ticks):       # Change filter, CW 200 Hz, SSB 2400 Hz
+    mod = get_param("MODULATION", deck.curr_rx, deck.curr_subx)
+    log.info("mod is %s", mod)
     if mod == "CW":
-        vfo_step = 25
+        log.info("CW Filter is 200 Hz")
+        return "RX_FILTER_BAND:0,-100,100;"
+    elif mod == "LSB":
+        log.info("LSB Filter is 2400 Hz")
+        return "RX_FILTER_BAND:0,-2400,10;"
+    elif mod == "USB":
+        log.info("USB Filter is 2400 Hz")
+        return "RX_FILTER_BAND:0,10,2400;"
+
+def h_filter_wide(deck, value, ticks):         # Change filter, CW 500 Hz, SSB 3 kHz
+    mod = get_param("MODULATION", deck.curr_rx, deck.curr_subx)
+    log.info("mod is %s", mod)
+    if mod == "CW":
+        log.info("CW Filter is 500 Hz")
+        return "RX_FILTER_BAND:0,-250,250;"
+    elif mod == "LSB":
+        log.info("LSB Filter is 3 kHz")
+        return "RX_FILTER_BAND:0,-3000,10;"
+    elif mod == "USB":
+        log.info("USB Filter is 3 kHz")
+        return "RX_FILTER_BAND:0,10,3000;"
+
+def h_split_toggle(deck, value, ticks):        # Toggle Split
+    deck.curr_subx = 1
+    return do_toggle("SPLIT_ENABLE", MIDI.KEYDOWN, deck.curr_rx, 1)
+
+def h_rx2_toggle(deck, value, ticks):          # Toggle RX2 On/Off
+    return do_toggle("RX_ENABLE", MIDI.KEYDOWN, 1, None)
+
+def h_mute_rx1(deck, value, ticks):            # Toggle Mute RX1 On/Off
+    return do_toggle("RX_MUTE", MIDI.KEYDOWN, 0, None)
+
+def h_mute_rx2(deck, value, ticks):            # Toggle Mute RX2 On/Off
+    return do_toggle("RX_MUTE", MIDI.KEYDOWN, 1, None)
+
+def h_band_up(deck, value, ticks):             # Next band or band segment
+    return do_band_scroll(MIDI.ENCUP, deck.curr_rx, deck.curr_subx)
+
+def h_band_down(deck, value, ticks):           # Previous band or band segment
+    return do_band_scroll(MIDI.ENCDOWN, deck.curr_rx, deck.curr_subx)
+
+def h_cw_key(deck, value, ticks):              # Straight key, down and up
+    keyer = deck.tci_listener.keyer
+    if keyer is not None:
+        keyer.key(deck.curr_rx, value == MIDI.KEYDOWN, deck.event_time)
+
+def cw_memory(deck, idx):
+    keyer = deck.tci_listener.keyer
+    if keyer is not None and idx < len(CW_MEMORIES):
+        log.info("CW memory %d: %s", idx + 1, CW_MEMORIES[idx])
+        keyer.memory(deck.curr_rx, CW_MEMORIES[idx])
+
+def h_cw_mem1(deck, value, ticks):             # Send the CW memory 1 (CQ)
+    cw_memory(deck, 0)
+
+def h_cw_mem2(deck, value, ticks):             # Send the CW memory 2 (report)
+    cw_memory(deck, 1)
+
+def h_cw_mem3(deck, value, ticks):             # Send the CW memory 3 (TU)
+    cw_memory(deck, 2)
+
+def h_cw_mem4(deck, value, ticks):             # Send the CW memory 4 (AGN)
+    cw_memory(deck, 3)
+
+def h_cw_stop(deck, value, ticks):             # Stop the memory and release the key
+    keyer = deck.tci_listener.keyer
+    if keyer is not None:
+        keyer.stop(deck.curr_rx)
+
+def h_snap(deck, value, ticks):                # Tune to the nearest carrier (IQ_SNAP)
+    return do_freq_snap(None, deck.curr_rx, deck.curr_subx)
+
+def h_snap_up(deck, value, ticks):             # Tune to the next carrier above
+    return do_freq_snap(True, deck.curr_rx, deck.curr_subx)
+
+def h_snap_down(deck, value, ticks):           # Tune to the next carrier below
+    return do_freq_snap(False, deck.curr_rx, deck.curr_subx)
+
+def h_dump_latency(deck, value, ticks):        # Log the latency histograms
+    log.info("latency histograms\n%s", deck.tci_listener.stats.dump())
+
+HANDLERS = {name[2:]: fn for name, fn in list(globals().items()) if name.startswith("h_") and callable(fn)}
+JOG_HANDLERS = {"freq_scroll", "rit_scroll"}  # relative encoders, their ticks are summed by midi_stream()
+PRIORITY_HANDLERS = {"ptt_on", "ptt_off", "ptt_mic_on", "ptt_mic_off", "mute_toggle", "mute_rx1", "mute_rx2",
+                     "cw_key", "cw_stop"}
+
+# ** Mapping tables: (message, channel, control or note, velocity, handler name[, held]) **
+# velocity is "down" (KEYDOWN), "up" (KEYUP) or None for any value
+# held is an optional (channel, note) that must be held down for the entry to replace the normal one (button combo)
+
+DJ_MAP = [ # DJControl Compact
+    ("control", 0, DJ.CROSSFADER,  None,   "power"),
+    ("control", 0, DJ.JOGA,        None,   "freq_scroll"),
+    ("control", 0, DJ.JOGB,        None,   "rit_scroll"),
+    ("control", 0, DJ.POTVOLUMEA,  None,   "volume"),
+    ("control", 0, DJ.POTVOLUMEB,  None,   "mon_volume"),
+    ("control", 0, DJ.POTBASSA,    None,   "filter_low"),
+    ("control", 0, DJ.POTBASSB,    None,   "filter_high"),
+    ("note_on", 0, DJ.BTN_PLAY_A,  "down", "listen_vfob"),
+    ("note_on", 0, DJ.BTN_CUE_A,   "down", "equalize_vfo"),
+    ("note_on", 0, DJ.BTN_SYNC_A,  "down", "select_rx"),
+    ("note_on", 0, DJ.BTN_PLAY_B,  "down", "rit_toggle_rx2"),
+    ("note_on", 0, DJ.BTN_SYNC_B,  "down", "rit_toggle_rx1"),
+    ("note_on", 0, DJ.BTN_CUE_B,   "down", "rit_clear"),
+    ("note_on", 0, DJ.BTN_AUTOMIX, "down", "mon_toggle"),
+    ("note_on", 0, DJ.BTN_REC,     "down", "mute_toggle"),
+    ("note_on", 0, DJ.BTN_MODE,    "down", "mode_down"),
+    ("note_on", 0, DJ.BTN_SHIFT,   "down", "mode_up"),
+    ("note_on", 0, DJ.BTN_1A,      "down", "swap_vfo"),
+    ("note_on", 0, DJ.BTN_2A,      "down", "vfo_step"),
+    ("note_on", 0, DJ.BTN_3A,      "down", "ptt_on"),
+    ("note_on", 0, DJ.BTN_3A,      "up",   "ptt_off"),
+    ("note_on", 0, DJ.BTN_4A,      "down", "filter_narrow"),
+    ("note_on", 0, DJ.BTN_1B,      "down", "split_toggle"),
+    ("note_on", 0, DJ.BTN_2B,      "down", "rx2_toggle"),
+    ("note_on", 0, DJ.BTN_3B,      "down", "mute_rx1"),
+    ("note_on", 0, DJ.BTN_4B,      "down", "mute_rx2"),
+    ("note_on", 0, DJ.BTN_CUE_B,   "down", "dump_latency", (0, DJ.BTN_SYNC_A)),
+]
+
+DJS_MAP = [ # DJControl Starlight, channel 1 is the left side and channel 2 the right side
+    ("control", 0, DJS.CROSSFADER, None,   "power"),
+    ("control", 0, DJS.POTVOLUME1, None,   "volume"),
+    ("control", 0, DJS.POTVOLUME2, None,   "mon_volume"),
+    ("control", 1, DJS.JOG,        None,   "freq_scroll"),
+    ("control", 1, DJS.POTBASS,    None,   "filter_low"),
+    ("control", 2, DJS.JOG,        None,   "rit_scroll"),
+    ("control", 2, DJS.POTBASS,    None,   "filter_high"),
+    ("note_on", 0, DJS.BTN_SHIFT,  "down", "mode_down"),
+    ("note_on", 0, DJS.BTN_FILTRE, None,   "vfo_step_10"),
+    ("note_on", 1, DJS.BTN_SHIFT,  "down", "mode_up"),
+    ("note_on", 1, DJS.BTN_PLAY,   "down", "listen_vfob"),
+    ("note_on", 1, DJS.BTN_CUE,    "down", "equalize_vfo"),
+    ("note_on", 1, DJS.BTN_SYNC,   "down", "select_rx"),
+    ("note_on", 1, DJS.BTN_HELMET, "down", "mute_toggle"),
+    ("note_on", 2, DJS.BTN_PLAY,   "down", "rit_toggle"),
+    ("note_on", 2, DJS.BTN_CUE,    "down", "rit_clear"),
+    ("note_on", 2, DJS.BTN_HOT,    "down", "mon_toggle"),
+    ("note_on", 2, DJS.BTN_LOOP,   "down", "mon_toggle"),
+    ("note_on", 2, DJS.BTN_HELMET, "down", "mon_toggle"),
+    ("note_on", 6, DJS.BTN_1,      "down", "swap_vfo"),
+    ("note_on", 6, DJS.BTN_2,      "down", "vfo_step"),
+    ("note_on", 6, DJS.BTN_3,      "down", "ptt_mic_on"),
+    ("note_on", 6, DJS.BTN_3,      "up",   "ptt_mic_off"),
+    ("note_on", 6, DJS.BTN_4,      "down", "filter_narrow"),
+    ("note_on", 6, DJS.BTN_4L,     "down", "filter_wide"),
+    ("note_on", 6, DJS.BTN_1L,     "down", "band_down"),
+    ("note_on", 6, DJS.BTN_2L,     "down", "band_up"),
+    ("note_on", 6, DJS.BTN_3L,     "down", "snap"),
+    ("note_on", 7, DJS.BTN_1,      "down", "split_toggle"),
+    ("note_on", 7, DJS.BTN_2,      "down", "rx2_toggle"),
+    ("note_on", 7, DJS.BTN_3,      "down", "mute_rx1"),
+    ("note_on", 7, DJS.BTN_4,      "down", "mute_rx2"),
+    ("note_on", 7, DJS.BTN_1L,     "down", "cw_mem1"),
+    ("note_on", 7, DJS.BTN_2L,     "down", "cw_mem2"),
+    ("note_on", 7, DJS.BTN_3L,     "down", "cw_mem3"),
+    ("note_on", 7, DJS.BTN_4L,     "down", "cw_stop"),
+    ("note_on", 2, DJS.BTN_SYNC,   "down", "dump_latency", (1, DJS.BTN_SYNC)),
+]
+
+# The key is the beginning of the midi port name, a new controller only needs a new table here
+# or in the mapping file
+MAPPINGS = {
+    "DJControl Compact": DJ_MAP,
+    "DJControl Starlight": DJS_MAP,
+}
+MAPPING_FILE = "f6ifyTCI_mapping.json"
+
+def load_mappings(path = MAPPING_FILE):
+    # The mapping file is {"port name": [["note_on", 6, 2, "down", "ptt_mic_on"], ...], ...}
+    # a device found in the file replaces the built-in table
+    if not os.path.exists(path):
+        return MAPPINGS
+    with open(path) as f:
+        mappings = dict(MAPPINGS)
+        mappings.update({name: [tuple(entry) for entry in table] for name, table in json.load(f).items()})
+    return mappings
+
+def find_mapping(midi_port, mappings = MAPPINGS):
+    for name, table in mappings.items():
+        if midi_port.startswith(name):
+            return table
+    raise ValueError(f"No mapping for the midi device {midi_port}")
+
+# A dispatch key is (status byte, control or note, velocity class), the status byte holds the type and the channel
+CONTROL_CHANGE = 0xB0
+NOTE_ON = 0x90
+NOTE_OFF = 0x80
+STATUS = {"control": CONTROL_CHANGE, "control_change": CONTROL_CHANGE, "note_on": NOTE_ON}
+
+class VEL(IntEnum):
+    UP = 0
+    DOWN = 1
+    OTHER = 2
+
+VEL_CLASS = [VEL.UP] + [VEL.OTHER] * 126 + [VEL.DOWN]
+VEL_NAMES = {"up": (VEL.UP,), "down": (VEL.DOWN,), None: (VEL.UP, VEL.DOWN, VEL.OTHER)}
+
+class MidiMap: # A mapping table compiled once at startup
+    def __init__(self, table, macros = None):
+        self.dispatch = {}  # key -> (handler, name)
+        self.combos = {}    # key -> ((status, note) held down, handler, name)
+        self.jogs = set()   # keys of the jogs, their ticks are summed
+        self.urgent = set() # keys of the priority events
+        for entry in table:
+            kind, channel, number, velocity, name = entry[:5]
+            status = STATUS[kind] | channel
+            if name in HANDLERS:
+                handler = HANDLERS[name]
+            elif macros and name in macros:
+                handler = partial(start_macro, name, macros[name])
+            else:
+                raise ValueError(f"Unknown handler {name} in the midi mapping")
+            if status & 0xF0 == CONTROL_CHANGE:
+                keys = [(status, number, None)]
+            else:
+                keys = [(status, number, vc) for vc in VEL_NAMES[velocity]]
+            for key in keys:
+                if len(entry) > 5:
+                    self.combos[key] = ((NOTE_ON | entry[5][0], entry[5][1]), handler, name)
+                    continue
+                self.dispatch[key] = (handler, name)
+                if name in JOG_HANDLERS:
+                    self.jogs.add(key)
+                if name in PRIORITY_HANDLERS:
+                    self.urgent.add(key)
+
+MACRO_FILE = "f6ifyTCI_macros.json" # buttons bound to a list of TCI commands, see f6ifyTCI_macros.example.json
+MACRO_ACK_TIMEOUT = 1.0 # seconds to wait for the echo of the commands of a step (or a state in a wait step)
+
+def load_macros(path = MACRO_FILE):
+    # The macro file is {"name": {"bind": {"port name": ["note_on", 6, 3, "down"]}, "ack": true,
+    #                             "steps": [["DDS:{rx},7025000;", "IF:{rx},0,0;"], {"wait": ["MODULATION", "{rx}", null, "CW"]},
+    #                                       {"sleep": 0.1}, ...]}}
+    # A list of commands goes out as one Batch, {rx} and {subrx} are the ones of the deck when the button is pressed
+    if not path or not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        macros = json.load(f)
+    for name, macro in macros.items():
+        if name in HANDLERS:
+            raise ValueError(f"The macro {name} has the name of a handler")
+        for step in macro["steps"]:
+            if not isinstance(step, list) and not (isinstance(step, dict) and ("wait" in step or "sleep" in step)):
+                raise ValueError(f"Bad step {step!r} in the macro {name}")
+    return macros
+
+def macro_entries(midi_port, macros):
+    # mapping entries of the macros bound to a button of this controller, they replace the entries of the table
+    return [tuple(button) + (name,) for name, macro in macros.items()
+            for prefix, button in macro.get("bind", {}).items() if midi_port.startswith(prefix)]
+
+def macro_arg(arg, rx, subrx):
+    return int(arg.format(rx = rx, subrx = subrx)) if isinstance(arg, str) else arg
+
+async def wait_state(name, rx, subrx, expected, timeout):
+    st = current_radio.get().state
+    if st.has(name, rx, subrx) and st.get(name, rx, subrx) == expected:
+        return True
+    done = asyncio.get_running_loop().create_future()
+    def changed(value):
+        if value == expected and not done.done():
+            done.set_result(True)
+    st.subscribe(name, rx, subrx, changed)
+    try:
+        await asyncio.wait_for(done, timeout)
+        return True
+    except asyncio.TimeoutError:
+        return False
+    finally:
+        st.unsubscribe(name, rx, subrx, changed)
+
+async def run_macro(deck, name, macro):
+    # The steps one after the other: a batch is sent without waiting between its commands, then (with "ack")
+    # the macro waits for the echo of each of them; a missing echo or state stops the macro
+    link = deck.tci_listener
+    rx, subrx = deck.curr_rx, deck.curr_subx
+    ack = macro.get("ack", True)
+    timeout = macro.get("ack_timeout", MACRO_ACK_TIMEOUT)
+    start = time.perf_counter()
+    for step in macro["steps"]:
+        if isinstance(step, list):
+            cmds = Batch(cmd.format(rx = rx, subrx = subrx) for cmd in step)
+            acks = link.expect_echoes(cmds) if ack else {}
+            link.send_nowait(cmds)
+            missing = await link.wait_echoes(acks, timeout)
+            if missing:
+                log.warning("macro %s stopped, no echo of %s", name, ", ".join(slot[0] for slot in missing))
+                return False
+        elif "wait" in step:
+            what, wrx, wsubrx, expected = step["wait"]
+            wrx, wsubrx = macro_arg(wrx, rx, subrx), macro_arg(wsubrx, rx, subrx)
+            if not await wait_state(what, wrx, wsubrx, expected, step.get("timeout", timeout)):
+                log.warning("macro %s stopped, %s is not %s", name, what, expected)
+                return False
+        else:
+            await asyncio.sleep(step["sleep"])
+    elapsed = time.perf_counter() - start
+    link.stats.record(name, "total", elapsed)
+    log.info("macro %s done in %.1f ms", name, elapsed * 1000)
+    return True
+
+def start_macro(name, macro, deck, value, ticks):
+    # the handler of a macro button, the macro runs in its own task so midi_rx goes on (PTT, jog...)
+    if deck.macro_task is not None and not deck.macro_task.done():
+        log.warning("macro %s ignored, a macro is running", name)
+        return None
+    deck.macro_task = asyncio.create_task(run_macro(deck, name, macro))
+    return None
+
+# Precomputed tables indexed by the status byte: note_off is seen as a note_on with the velocity class UP
+KEY_STATUS = [(s | 0x10) if s & 0xF0 == NOTE_OFF else s for s in range(256)]
+VEL_BY_STATUS = [[VEL.UP] * 128 if s & 0xF0 == NOTE_OFF else VEL_CLASS if s & 0xF0 == NOTE_ON else [None] * 128 for s in range(256)]
+
+def midi_key(ev):
+    status = ev[0]
+    return (KEY_STATUS[status], ev[1], VEL_BY_STATUS[status][ev[2]])
+
+LED_RATE = 30 # LED updates per second at most, the changes in between are sent together
+LED_ON = 0x7F
+LED_OFF = 0x00
+
+# Buttons whose LED shows a state of the radio: handler -> (command, rx, subrx), rx None = the rx of the deck
+LED_STATES = {
+    "listen_vfob":    ("RX_CHANNEL_ENABLE", None, 1),
+    "rit_toggle":     ("RIT_ENABLE", None, None),
+    "rit_toggle_rx1": ("RIT_ENABLE", 0, None),
+    "rit_toggle_rx2": ("RIT_ENABLE", 1, None),
+    "mon_toggle":     ("MON_ENABLE", None, None),
+    "mute_toggle":    ("MUTE", None, None),
+    "split_toggle":   ("SPLIT_ENABLE", None, None),
+    "rx2_toggle":     ("RX_ENABLE", 1, None),
+    "mute_rx1":       ("RX_MUTE", 0, None),
+    "mute_rx2":       ("RX_MUTE", 1, None),
+    "ptt_on":         ("TRX", None, None),
+    "ptt_mic_on":     ("TRX", None, None),
+}
+
+class LedOutput:
+    # The LEDs of a controller follow the state of the radio. The state changes only wake the task up,
+    # the LEDs are computed then compared to a shadow copy of what the controller shows, and only
+    # the changes are sent, LED_RATE times per second at most, from an executor thread
+    def __init__(self, deck, table, send):
+        self.deck = deck
+        self.send = send      # send(list of (status, note, velocity)), blocking
+        self.leds = []        # (status, note, command, rx, subrx)
+        self.shadow = {}      # (status, note) -> velocity shown
+        self.wakeup = asyncio.Event()
+        self.sent = 0         # LED messages sent
+        for entry in table:
+            if entry[0] == "note_on" and len(entry) == 5 and entry[4] in LED_STATES:
+                self.leds.append((NOTE_ON | entry[1], entry[2]) + LED_STATES[entry[4]])
+
+    def changed(self, value = None):
+        self.wakeup.set()
+
+    def slots(self):
+        for _, _, name, rx, subrx in self.leds:
+            for r in ((0, 1) if rx is None else (rx,)):
+                yield name, r, subrx
+
+    def subscribe(self, state):
+        for slot in set(self.slots()):
+            state.subscribe(*slot, self.changed)
+
+    def unsubscribe(self, state):
+        for slot in set(self.slots()):
+            state.unsubscribe(*slot, self.changed)
+
+    def changes(self):
+        wanted = {}
+        for status, note, name, rx, subrx in self.leds:
+            rx = self.deck.curr_rx if rx is None else rx
+            on = has_param(name, rx, subrx) and get_param(name, rx, subrx) is True
+            if on or (status, note) not in wanted:  # two handlers on one button (ptt on/off): lit if one is on
+                wanted[(status, note)] = LED_ON if on else LED_OFF
+        res = [(status, note, vel) for (status, note), vel in wanted.items() if self.shadow.get((status, note)) != vel]
+        for status, note, vel in res:
+            self.shadow[(status, note)] = vel
+        return res
+
+    async def run(self, rate = LED_RATE):
+        loop = asyncio.get_running_loop()
+        self.wakeup.set()   # all the LEDs at the start
+        while True:
+            await self.wakeup.wait()
+            self.wakeup.clear()
+            res = self.changes()
+            if res:
+                await loop.run_in_executor(None, self.send, res)
+                self.sent += len(res)
+            await asyncio.sleep(1 / rate)
+
+async def midi_rx(tci_listener, midi_port, open_input = open_midi_input, deck = None, open_output = None):
+    # open_output(midi_port) opens the output of the controller for its LEDs (open_midi_output), None = no LEDs
+    if deck is None:
+        deck = Deck(tci_listener, midi_port)
+    current_radio.set(tci_listener.radio)   # for this task only
+    macros = load_macros(MACRO_FILE)
+    table = list(find_mapping(midi_port, load_mappings())) + macro_entries(midi_port, macros)
+    mm = MidiMap(table, macros)
+    deck.ring = ring = MidiRing()
+    cb, stream = midi_stream(lambda ev: midi_key(ev) in mm.jogs, is_priority = lambda ev: midi_key(ev) in mm.urgent, ring = ring)
+    labels = f'port="{midi_port}"'
+    stats = tci_listener.stats
+    stats.add_gauge("midi_queue_depth", labels, ring.depth)
+    stats.add_gauge("midi_queue_max_depth", labels, lambda: ring.max_depth)
+    stats.add_gauge("midi_dropped_total", labels, lambda: ring.dropped, "counter")
+    stats.add_gauge("midi_summed_total", labels, lambda: ring.summed, "counter")
+    stats.add_gauge("midi_spilled_total", labels, lambda: ring.spilled, "counter")
+    midi_out = open_output(midi_port) if open_output is not None else None
+    leds = None
+    if midi_out is not None:
+        deck.leds = leds = LedOutput(deck, table, partial(send_midi, midi_out))
+        leds.subscribe(current_radio.get().state)
+        led_task = asyncio.create_task(leds.run())
+        stats.add_gauge("midi_leds_sent_total", labels, lambda: leds.sent, "counter")
+    recorder = tci_listener.recorder
+    if recorder is not None:
+        recorder.meta(f"midi_port={midi_port}")
+        cb = recorder.wrap_midi(cb)
+    deck.midi_in = open_input(midi_port, cb)
+    mod = get_param("MODULATION", deck.curr_rx, deck.curr_subx) if has_param("MODULATION", deck.curr_rx) else None
+    log.info("mod is %s", mod)
+    if mod == "CW":
+        deck.vfo_step = 25
     else:
-        vfo_step = 100
-    print(f"vfo_step is {vfo_step}")
-    async for msg in stream:
-        if debug : print(f"MIDI is {msg}")
-        rit_step = 10
-        trx_cmd = ""
-        strmsg = str(msg)
-        isButton = strmsg[0:7]
-        
-        # print(isButton)    
-        if midi_port == "DJControl Compact 0":
-            cc = DJ
-            if isButton == "control": # A JOG or a potentiometer has been turned
-                if msg.control == cc.CROSSFADER:         # Power 0 to 100%
-                    trx_cmd = set_power(msg, curr_rx)
-                    debug = False
-                elif msg.control == cc.JOGA:             # Frequency Scroll
-                    trx_cmd = do_freq_scroll(vfo_step, msg.value, curr_rx, curr_subx)
-                elif msg.control == cc.JOGB:             # Frequency Scroll
-                    trx_cmd = do_generic_scroll("RIT_OFFSET", rit_step, msg.value, curr_rx, curr_subx)
-                elif msg.control == cc.POTVOLUMEA:       # Volume 0 to -60 dB 
-                    trx_cmd = set_volume(msg, curr_rx)
-                elif msg.control == cc.POTVOLUMEB:       # Monitor Volume 0 to -60 dB
-                    val = (60 * msg.value) / 127
-                    trx_cmd = f"MON_VOLUME:{-val};"
-                elif msg.control == cc.POTBASSA:         # Value of the RX filter low
-                    if higher_filter == None: higher_filter = 200
-                    lower_filter = msg.value * 5
-                    trx_cmd = f"RX_FILTER_BAND:{curr_rx},-{lower_filter},{higher_filter};"
-                elif msg.control == cc.POTBASSB:         # Value of the RX filter hight
-                    if lower_filter == None: lower_filter = 200
-                    higher_filter = msg.value * 5
-                    trx_cmd = f"RX_FILTER_BAND:{curr_rx},-{lower_filter},{higher_filter};"
-                # await tci_listener.send(trx_cmd)
-            elif isButton == "note_on": # I press a button on the DJControl Compact
-                if msg.note == cc.BTN_PLAY_A and msg.velocity == MIDI.KEYDOWN:       # Listen with VFOB
-                    curr_subx = 1
-                    trx_cmd = do_toggle("RX_CHANNEL_ENABLE", MIDI.KEYDOWN, curr_rx, 1)
-                elif msg.note == cc.BTN_CUE_A and msg.velocity == MIDI.KEYDOWN:     # Equalize VFOs
-                    TXFreqVFOA = get_param("VFO", curr_rx, 0)
-                    trx_cmd = f"VFO:{curr_rx},1,{TXFreqVFOA};"      # VFO A --> B
-                elif msg.note == cc.BTN_SYNC_A and msg.velocity == MIDI.KEYDOWN:     # Select RX
-                    curr_subx = 0
-                elif msg.note == cc.BTN_PLAY_B and msg.velocity == MIDI.KEYDOWN:     # Toggle RIT on RX2
-                    curr_rx = 1
-                    trx_cmd = do_toggle("RIT_ENABLE", MIDI.KEYDOWN, curr_rx, curr_subx)
-                elif msg.note == cc.BTN_SYNC_B and msg.velocity == MIDI.KEYDOWN:     # Toggle RIT on RX1
-                    curr_rx = 0
-                    trx_cmd = do_toggle("RIT_ENABLE", MIDI.KEYDOWN, curr_rx, curr_subx)
-                elif msg.note == cc.BTN_CUE_B and msg.velocity == MIDI.KEYDOWN:      # Clear RIT
-                    trx_cmd = f"RIT_OFFSET:{curr_rx},0;"
-                elif msg.note == cc.BTN_AUTOMIX and msg.velocity == MIDI.KEYDOWN:    # Toggle Monitor On/Off 
-                    trx_cmd = do_toggle("MON_ENABLE", MIDI.KEYDOWN, curr_rx, curr_subx)
-                elif msg.note == cc.BTN_REC and msg.velocity == MIDI.KEYDOWN:        # Toggle Mute On/Off
-                    trx_cmd = do_toggle("MUTE", MIDI.KEYDOWN, curr_rx, curr_subx)
-                elif msg.note == cc.BTN_MODE and msg.velocity == MIDI.KEYDOWN:       # Change Mode Up 
-                    trx_cmd = do_mod_scroll(MIDI.ENCDOWN, curr_rx, curr_subx)
-                elif msg.note == cc.BTN_SHIFT and msg.velocity == MIDI.KEYDOWN:      # Change Mode Down
-                    trx_cmd = do_mod_scroll(MIDI.ENCUP, curr_rx, curr_subx)
-                elif msg.note == cc.BTN_1A and msg.velocity == MIDI.KEYDOWN:         # SWAP VFOs
-                    TXFreqVFOA = get_param("VFO", curr_rx, 0)
-                    TXFreqVFOB = get_param("VFO", curr_rx, 1)
-                    trx_cmd = f"VFO:{curr_rx},1,{TXFreqVFOA};"      # VFO A = B
-                    await tci_listener.send(trx_cmd)
-                    trx_cmd = f"VFO:{curr_rx},0,{TXFreqVFOB};"      # Now Swap VFO
-                    print(f"TXFreq is {TXFreqVFOA} and {TXFreqVFOB}")
-                elif msg.note == cc.BTN_2A and msg.velocity == MIDI.KEYDOWN:     # Toggle RX focus
-                    if vfo_step == 200:
-                        vfo_step = 25
-                    else: vfo_step *= 2
-                    print(f"vfo_step is {vfo_step}")
-                elif msg.note == cc.BTN_3A and msg.velocity == MIDI.KEYDOWN:    # TX on when button down, RX is back when button up
-                    trx_cmd = f"TRX:{curr_rx},true;"
-                elif msg.note == cc.BTN_3A and msg.velocity == MIDI.KEYUP:   # TX on when button down, RX is back when button up
-                    trx_cmd = f"TRX:{curr_rx},false;"
-                elif msg.note == cc.BTN_4A and msg.velocity == MIDI.KEYDOWN:
-                    mod = get_param("MODULATION", curr_rx, curr_subx)
-                    print(f"mod is {mod}")
-                    if mod == "CW":
-                        trx_cmd = "RX_FILTER_BAND:0,-100,100;"                      # User filter is now 200 Hz Wide
-                    elif mod == "LSB":
-                        trx_cmd = "RX_FILTER_BAND:0,-2400,10;"                    # User filter is now 2400 Hz Wide
-                    elif mod == "USB":
-                        trx_cmd = "RX_FILTER_BAND:0,10,2400;"                       # User filter is now 2400 Hz Wide
-                        
-                elif msg.note == cc.BTN_1B and msg.velocity == MIDI.KEYDOWN:       # Listen with VFOB
-                    curr_subx = 1
-                    trx_cmd = do_toggle("SPLIT_ENABLE", MIDI.KEYDOWN, curr_rx, 1)
-                elif msg.note == cc.BTN_2B and msg.velocity == MIDI.KEYDOWN: # Toggle RX2 On/Off
-                    trx_cmd = do_toggle("RX_ENABLE", MIDI.KEYDOWN, 1, None)
-                    print(f"trx_cmd is {trx_cmd}")
-                elif msg.note == cc.BTN_3B and msg.velocity == MIDI.KEYDOWN: # Toggle Mute RX1 On/Off
-                    trx_cmd = do_toggle("RX_MUTE", MIDI.KEYDOWN, 0, None)
-                    print(f"trx_cmd is {trx_cmd}")
-                elif msg.note == cc.BTN_4B and msg.velocity == MIDI.KEYDOWN: # Toggle Mute RX2 On/Off
-                    trx_cmd = do_toggle("RX_MUTE", MIDI.KEYDOWN, 1, None)
-                    print(f"trx_cmd is {trx_cmd}")
-                # await tci_listener.send(trx_cmd)
-                # print(f"message complet is {msg}")
-        elif midi_port == "DJControl Starlight 0": 
-            cc = DJS # It is the starlight (No other device is supported)
-            # print(isButton)
-            if isButton == "control":
-                if msg.channel == 0:
-                    if msg.control == cc.CROSSFADER:         # Power 0 to 100%
-                        trx_cmd = set_power(msg, curr_rx)
-                        debug = False
-                    elif msg.control == cc.POTVOLUME1:       # Volume 0 to -60 dB 
-                        trx_cmd = set_volume(msg, curr_rx)
-                    elif msg.control == cc.POTVOLUME2:       # Monitor Volume 0 to -60 dB
-                        val = (60 * msg.value) / 127
-                        trx_cmd = f"MON_VOLUME:{-val};"
-                elif msg.channel == 1:     # Left side of the DJControl Starlight
-                    if msg.control == cc.JOG:             # Frequency Scroll
-                        trx_cmd = do_freq_scroll(vfo_step, msg.value, curr_rx, curr_subx)
-                    elif msg.control == cc.POTBASS:           # Filter Scroll
-                        trx_cmd = do_filter_scroll(FILTERSIDE.LEFT, msg.value * 10, curr_rx, curr_subx)
-                elif msg.channel == 2:     # Right side of the DJControl Starlight
-                    if msg.control == cc.JOG:             # Frequency Scroll
-                        trx_cmd = do_generic_scroll("RIT_OFFSET", rit_step, msg.value, curr_rx, curr_subx)
-                    elif msg.control == cc.POTBASS:           # Filter Scroll
-                        trx_cmd = do_filter_scroll(FILTERSIDE.RIGHT, msg.value * 10, curr_rx, curr_subx)
-            elif isButton == "note_on": # Starlight buttons
-                if msg.channel == 0:
-                    if msg.note == cc.BTN_SHIFT and msg.velocity == MIDI.KEYDOWN:
-                        trx_cmd = do_mod_scroll(MIDI.ENCDOWN, curr_rx, curr_subx)
-                    elif msg.note == cc.BTN_FILTRE:
-                        vfo_step = 10
-                elif msg.channel == 1:
-                    if msg.note == cc.BTN_SHIFT and msg.velocity == MIDI.KEYDOWN:
-                        trx_cmd = do_mod_scroll(MIDI.ENCUP, curr_rx, curr_subx)
-                    elif msg.note == cc.BTN_PLAY and msg.velocity == MIDI.KEYDOWN:
-                        curr_subx = 1
-                        trx_cmd = do_toggle("RX_CHANNEL_ENABLE", MIDI.KEYDOWN, curr_rx, 1)
-                    elif msg.note == cc.BTN_CUE and msg.velocity == MIDI.KEYDOWN:
-                        TXFreqVFOA = get_param("VFO", curr_rx, 0)
-                        trx_cmd = f"VFO:{curr_rx},1,{TXFreqVFOA};"      # VFO A --> B
-                    elif msg.note == cc.BTN_SYNC and msg.velocity == MIDI.KEYDOWN:
-                        curr_subx = 0
-                    elif msg.note == cc.BTN_HELMET and msg.velocity == MIDI.KEYDOWN:
-                        trx_cmd = do_toggle("MUTE", MIDI.KEYDOWN, curr_rx, curr_subx)
-                    # elif msg.note == cc.BTN_JOG and msg.velocity == MIDI.KEYDOWN:
-                    #     if key == False:
-                    #         key = True
-                    #         trx_cmd = "KEYER:0,true,0;" 
-                    #     else:
-                    #         key = False
-                    #         trx_cmd = "KEYER:0,false,0;"
-
-                        # print("SET_IN_FOCUS")
-                elif msg.channel == 2:
-                    if msg.note == cc.BTN_PLAY and msg.velocity == MIDI.KEYDOWN:
-                        trx_cmd = do_toggle("RIT_ENABLE", MIDI.KEYDOWN, curr_rx, curr_subx)
-                    elif msg.note == cc.BTN_CUE and msg.velocity == MIDI.KEYDOWN:
-                        trx_cmd = f"RIT_OFFSET:{curr_rx},0;"
-                    elif msg.note == cc.BTN_HOT and msg.velocity == MIDI.KEYDOWN:
-                        trx_cmd = do_toggle("MON_ENABLE", MIDI.KEYDOWN, curr_rx, curr_subx)
-                    elif msg.note == cc.BTN_LOOP and msg.velocity == MIDI.KEYDOWN:
-                        trx_cmd = do_toggle("MON_ENABLE", MIDI.KEYDOWN, curr_rx, curr_subx)
-                    elif msg.note == cc.BTN_HELMET and msg.velocity == MIDI.KEYDOWN:
-                        trx_cmd = do_toggle("MON_ENABLE", MIDI.KEYDOWN, curr_rx, curr_subx)
-                elif msg.channel == 6:
-                    if msg.note == cc.BTN_1 and msg.velocity == MIDI.KEYDOWN: # SWAP VFOs
-                        TXFreqVFOA = get_param("VFO", curr_rx, 0)
-                        TXFreqVFOB = get_param("VFO", curr_rx, 1)
-                        trx_cmd = f"VFO:{curr_rx},1,{TXFreqVFOA};"      # VFO A = B
-                        await tci_listener.send(trx_cmd)
-                        trx_cmd = f"VFO:{curr_rx},0,{TXFreqVFOB};"      # Now Swap VFO
-                        print(f"TXFreq is {TXFreqVFOA} and {TXFreqVFOB}")
-                    elif msg.note == cc.BTN_2 and msg.velocity == MIDI.KEYDOWN: # change vfo_step
-                        if vfo_step == 200:
-                            vfo_step = 25
-                        else: vfo_step *= 2
-                        print(f"vfo_step is {vfo_step}")
-                    elif msg.note == cc.BTN_3 and msg.velocity == MIDI.KEYDOWN: # TX on when button down, RX is back when button up
-                        # trx_cmd = "KEYER:0,true,0;"
-                        trx_cmd = f"TRX:{curr_rx},true,micPC;"
-                    elif msg.note == cc.BTN_3 and msg.velocity == MIDI.KEYUP:   # TX on when button down, RX is back when button up
-                        # trx_cmd = "KEYER:0,false,0;"
-                        trx_cmd = f"TRX:{curr_rx},false,micPC;"
-                    elif msg.note == cc.BTN_4 and msg.velocity == MIDI.KEYDOWN: # Change filter
-                        mod = get_param("MODULATION", curr_rx, curr_subx)
-                        print(f"mod is {mod}")
-                        if mod == "CW":
-                            trx_cmd = "RX_FILTER_BAND:0,-100,100;"
-                            print("CW Filter is 200 Hz")
-                        elif mod == "LSB":
-                            trx_cmd = "RX_FILTER_BAND:0,-2400,10;"
-                            print("LSB Filter is 2400 Hz")
-                        elif mod == "USB":
-                            trx_cmd = "RX_FILTER_BAND:0,10,2400;"
-                            print("USB Filter is 2400 Hz")
-                    elif msg.note == cc.BTN_4L and msg.velocity == MIDI.KEYDOWN: # Change filter
-                        mod = get_param("MODULATION", curr_rx, curr_subx)
-                        print(f"mod is {mod}")
-                        if mod == "CW":
-                            trx_cmd = "RX_FILTER_BAND:0,-250,250;"
-                            print("CW Filter is 500 Hz")
-                        elif mod == "LSB":
-                            trx_cmd = "RX_FILTER_BAND:0,-3000,10;"
-                            print("LSB Filter is 3 kHz")
-                        elif mod == "USB":
-                            trx_cmd = "RX_FILTER_BAND:0,10,3000;"
-                            print("USB Filter is 3 kHz")
-                elif msg.channel == 7:
-                    if msg.note == cc.BTN_1 and msg.velocity == MIDI.KEYDOWN: # Toggle Split
-                        curr_subx = 1
-                        trx_cmd = do_toggle("SPLIT_ENABLE", MIDI.KEYDOWN, curr_rx, 1)
-                    elif msg.note == cc.BTN_2 and msg.velocity == MIDI.KEYDOWN: # Toggle RX2 On/Off
-                        trx_cmd = do_toggle("RX_ENABLE", MIDI.KEYDOWN, 1, None)
-                    elif msg.note == cc.BTN_3 and msg.velocity == MIDI.KEYDOWN:
-                        trx_cmd = do_toggle("RX_MUTE", MIDI.KEYDOWN, 0, None)
-                    elif msg.note == cc.BTN_4 and msg.velocity == MIDI.KEYDOWN:
-                        trx_cmd = do_toggle("RX_MUTE", MIDI.KEYDOWN, 1, None)
-                    print(f"trx_cmd is {trx_cmd}")
-
-                # print("It is the starlight and except")
-        await tci_listener.send(trx_cmd)
-async def main(uri, midi_port):
-    tci_listener = Listener(uri)
-    tci_listener.add_param_listener("*", update_params)
-    await tci_listener.start()
-    await tci_listener.ready()
-    asyncio.create_task(midi_rx(tci_listener, midi_port))
-    await tci_listener.wait()
+        deck.vfo_step = 100
+    log.info("vfo_step is %d", deck.vfo_step)
+    held = set() # buttons held down, for the combos
+    try:
+        async for ev, ticks in stream:
+            t1 = time.perf_counter()
+            deck.events += ticks
+            deck.event_time = ev[3]
+            if deck.debug : log.debug("MIDI is %s x %d", ev, ticks)
+            key = midi_key(ev)
+            entry = None
+            if key[2] is not None:
+                if key[2] == VEL.UP:
+                    held.discard(key[:2])
+                else:
+                    held.add(key[:2])
+                combo = mm.combos.get(key)
+                if combo is not None and combo[0] in held:
+                    entry = combo[1:]
+            if entry is None:
+                entry = mm.dispatch.get(key)
+                if entry is None:
+                    continue
+            handler, name = entry
+            try:
+                trx_cmd = handler(deck, ev[2], ticks)
+            except KeyError as exc:  # state not received yet from ExpertSDR (reconnect in progress)
+                log.warning("%s: no %s from ExpertSDR yet", name, exc)
+                continue
+            if leds is not None and key[2] is not None:  # a button may have changed the rx of the deck
+                leds.changed()
+            if trx_cmd:
+                await tci_listener.send(trx_cmd, (ev[3], t1, time.perf_counter()))
+    finally:
+        stats.remove_gauges(labels)
+        if deck.macro_task is not None:
+            deck.macro_task.cancel()
+        if leds is not None:
+            led_task.cancel()
+            leds.unsubscribe(current_radio.get().state)
+            deck.leds = None
+            close_midi_port(midi_out)
+
+# Commands kept in the state snapshot: what the handlers read, never TRX/TUNE
+SNAPSHOT_COMMANDS = {"DDS", "IF", "VFO", "MODULATION", "RX_FILTER_BAND", "IF_LIMITS", "VFO_LIMITS", "MODULATIONS_LIST",
+                     "TRX_COUNT", "CHANNELS_COUNT", "RX_ENABLE", "RX_CHANNEL_ENABLE", "SPLIT_ENABLE", "RIT_ENABLE",
+                     "RIT_OFFSET", "XIT_ENABLE", "XIT_OFFSET", "VOLUME", "MUTE", "RX_MUTE", "MON_VOLUME", "MON_ENABLE",
+                     "DRIVE", "RX_VOLUME", "RX_BALANCE"}
+
+def state_snapshot(links):
+    # uri -> [[name, rx, subrx, value]...] of the radios that have sent their state
+    return {uri: [[name, rx, subrx, value] for (name, rx, subrx), value in link.radio.state.items() if name in SNAPSHOT_COMMANDS]
+            for uri, link in links.items() if link.sessions and link.radio.state.has("DDS", 0)}
+
+def save_snapshot(path, snapshot):
+    # written then renamed so a crash never leaves half a file
+    with open(path + ".tmp", "w") as f:
+        json.dump(snapshot, f)
+    os.replace(path + ".tmp", path)
+
+def load_snapshot(path, links):
+    # The values of the last session, until the handshake of ExpertSDR replaces them
+    try:
+        with open(path) as f:
+            snapshot = json.load(f)
+    except (OSError, ValueError):
+        return {}
+    for uri, link in links.items():
+        for name, rx, subrx, value in snapshot.get(uri, []):
+            if name in tci.COMMANDS:
+                link.radio.state.set(name, rx, subrx, value)
+    return snapshot
+
+async def snapshot_state(path, links, snapshot, period = 30.0):
+    loop = asyncio.get_running_loop()
+    while True:
+        await asyncio.sleep(period)
+        snapshot.update(state_snapshot(links))
+        await loop.run_in_executor(None, save_snapshot, path, dict(snapshot))
+
+def resolve_routes(routes, port_names):
+    # (port name prefix, uri, rx) -> {port name: (uri, rx)} of the midi ports found, the first port of each route
+    res = {}
+    for prefix, uri, rx in routes:
+        port = next((p for p in port_names if p.startswith(prefix) and p not in res), None)
+        if port is not None:
+            res[port] = (uri, rx)
+    return res
+
+class PortWatcher:
+    # Opens a deck for every midi port matching a route and closes it when the port is gone, the TCI links
+    # and their state are not touched. The ports are listed in an executor thread, the event loop only
+    # compares two short lists
+    def __init__(self, routes, links, open_input = open_midi_input, list_ports = None, open_output = open_midi_output):
+        self.routes = routes          # (port name prefix, uri, rx)
+        self.links = links            # uri -> TciLink
+        self.open_input = open_input
+        self.open_output = open_output
+        self.list_ports = list_ports or midi_input_names
+        self.decks = {}               # port name -> (deck, midi_rx task)
+        self.failures = {}            # port name -> (failures in a row, time before which it is not opened again)
+        self.polls = 0
+
+    def update(self, port_names):
+        wanted = resolve_routes(self.routes, port_names)
+        for port, (deck, task) in list(self.decks.items()):
+            if port not in wanted or task.done():  # unplugged, or failed to open
+                self.close(port)
+            elif port in self.failures:  # opened and still running a poll later
+                del self.failures[port]
+        now = time.monotonic()
+        for port in list(self.failures):
+            if port not in wanted:  # a replug starts again without delay
+                del self.failures[port]
+        for port, (uri, rx) in wanted.items():
+            if port not in self.decks and self.failures.get(port, (0, now))[1] <= now:
+                self.open(port, uri, rx)
+
+    def open(self, port, uri, rx):
+        link = self.links[uri]
+        deck = Deck(link, port)
+        deck.curr_rx = rx
+        self.decks[port] = (deck, asyncio.create_task(midi_rx(link, port, self.open_input, deck, self.open_output)))
+        log.info("%s drives rx %s of %s", port, rx, uri)
+
+    def close(self, port):
+        deck, task = self.decks.pop(port)
+        if task.done() and not task.cancelled() and task.exception() is not None:
+            failures = self.failures.get(port, (0, 0))[0] + 1
+            delay = PORT_RETRY_DELAYS[min(failures - 1, len(PORT_RETRY_DELAYS) - 1)]
+            self.failures[port] = (failures, time.monotonic() + delay)
+            log.warning("%s failed, opened again in %d s: %r", port, delay, task.exception())
+        task.cancel()
+        close_midi_port(deck.midi_in)
+        deck.midi_in = None
+        log.info("%s closed", port)
+
+    async def poll(self):
+        names = await asyncio.get_running_loop().run_in_executor(None, self.list_ports)
+        self.update(names)
+        self.polls += 1
+
+    async def run(self, period = 1.0):
+        while True:
+            await asyncio.sleep(period)
+            await self.poll()
+
+async def main(uri, midi_port, routes = None, open_input = open_midi_input, list_ports = None, open_output = open_midi_output):
+    # routes is a list of (midi port name prefix, TCI uri, rx), one TciLink with its own Radio per uri
+    # Every TciLink has its own sender task and queues, so a slow radio does not delay the others
+    # With a state snapshot the controllers start first and work from it while ExpertSDR sends its state
+    if BAND_PLAN:
+        BANDS.load(BAND_PLAN)
+    if not routes:
+        # the controller found at startup (or any known controller) drives rx 0, found again after a replug
+        mappings = load_mappings()
+        prefix = next((name for name in mappings if midi_port and midi_port.startswith(name)), midi_port)
+        routes = [(prefix, uri, 0)] if prefix else [(name, uri, 0) for name in mappings]
+    stats = LatencyStats()  # shared by all the links
+    links = {}
+    for _, link_uri, _ in routes:
+        if link_uri in links:
+            continue
+        link = TciLink(link_uri, radio = Radio(link_uri) if links else default_radio)
+        link.stats = stats
+        labels = f'uri="{link_uri}"'
+        stats.add_gauge("tune_if_moves_total", labels, lambda radio = link.radio: radio.if_moves, "counter")
+        stats.add_gauge("tune_dds_retunes_total", labels, lambda radio = link.radio: radio.dds_retunes, "counter")
+        if IQ_SNAP:
+            enable_iq_snap(link)
+            stats.add_gauge("iq_spectra_total", labels,
+                            lambda radio = link.radio: sum(d.ffts for d in radio.spectra.values()), "counter")
+        link.add_param_listener("*", update_params)
+        if SESSION_LOG and not links:  # only the first radio is recorded
+            from session_log import SessionRecorder
+            link.recorder = SessionRecorder(SESSION_LOG)
+            asyncio.create_task(link.recorder.run())
+        if PROXY_PORT and not links:   # only the first radio is shared
+            from tci_proxy import TciProxy
+            link.proxy = await TciProxy(link, port = PROXY_PORT, meter_rate = PROXY_METER_RATE).start()
+            stats.add_gauge("proxy_clients", labels, lambda proxy = link.proxy: len(proxy.clients))
+            stats.add_gauge("proxy_forwarded_total", labels, lambda proxy = link.proxy: proxy.forwarded, "counter")
+            stats.add_gauge("proxy_filtered_total", labels, lambda proxy = link.proxy: proxy.filtered, "counter")
+            stats.add_gauge("proxy_rejected_total", labels, lambda proxy = link.proxy: proxy.rejected, "counter")
+            log.info("TCI proxy of %s on port %d", link_uri, PROXY_PORT)
+        links[link_uri] = link
+    snapshot = load_snapshot(STATE_SNAPSHOT, links) if STATE_SNAPSHOT else {}
+    watcher = PortWatcher(routes, links, open_input, list_ports, open_output)
+    if snapshot:
+        await watcher.poll()
+    # the first connection goes through supervise() like the reconnects, ExpertSDR may be started after us
+    supervisors = [asyncio.create_task(link.supervise()) for link in links.values()]
+    if not snapshot:
+        await asyncio.gather(*(link.ready(None) for link in links.values()))
+        await watcher.poll()
+    if HOTPLUG_PERIOD:
+        asyncio.create_task(watcher.run(HOTPLUG_PERIOD))
+    if STATE_SNAPSHOT:
+        asyncio.create_task(snapshot_state(STATE_SNAPSHOT, links, snapshot))
+    if hasattr(signal, "SIGUSR1"):  # kill -USR1 logs the latency histograms (not on Windows)
+        asyncio.get_running_loop().add_signal_handler(signal.SIGUSR1, lambda: log.info("latency histograms\n%s", stats.dump()))
+        asyncio.get_running_loop().add_signal_handler(signal.SIGUSR2, lambda: dump_ring(log))  # the log ring
+    if METRICS_FILE:
+        asyncio.create_task(write_metrics(stats, METRICS_FILE))
+    if METRICS_PORT:
+        await serve_metrics(stats, METRICS_PORT)
+    for link in links.values():
+        asyncio.create_task(expire_pending(link.radio))
+    if CW_KEYER:
+        from cw_keyer import CwKeyer
+        for link in links.values():
+            # the keyer process connects by itself, and again after a restart of ExpertSDR
+            keyer = CwKeyer(link.uri, CW_WPM, CW_MEMORY_MODE, stats, log = log)
+            try:
+                await asyncio.get_running_loop().run_in_executor(None, keyer.start)
+                link.keyer = keyer
+            except OSError as exc:  # the process could not be started
+                log.warning("CW keyer of %s: %r", link.uri, exc)
+    try:
+        await asyncio.gather(*supervisors)
+    finally:
+        if STATE_SNAPSHOT:
+            snapshot.update(state_snapshot(links))
+            save_snapshot(STATE_SNAPSHOT, snapshot)
+        for link in links.values():
+            if link.recorder is not None:
+                link.recorder.close()
+            if link.keyer is not None:
+                link.keyer.close()
+            if link.proxy is not None:
+                await link.proxy.stop()
 # cfg = Config("config.json")
 # uri = cfg.get("uri", required=True)
 # midi_port = cfg.get("midi_port", required=True)
-uri = "ws://localhost:50001"
-# midi_port = "DJControl Compact 0"
-print(f"midi_port is {midi_port} and uri is {uri}")
+if __name__ == "__main__":
+    # to help future modification with new midi device
+    log_listener = setup_logging("f6ifyTCI", LOG_LEVEL, LOG_RING)
+    midi_hardware = midi_input_names()
+    midi_port = midi_hardware[0] if midi_hardware else None   # None: waits for a controller to be plugged
+    log.info("midi device is %s", midi_port)
+    uri = "ws://localhost:50001"
+    # midi_port = "DJControl Compact 0"
+    log.info("midi_port is %s and uri is %s", midi_port, uri)
 
-asyncio.run(main(uri, midi_port))
+    try:
+        asyncio.run(main(uri, midi_port, ROUTES))
+    finally:
+        log_listener.stop()   # the records still in the queue are written
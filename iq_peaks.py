@@ -0,0 +1,153 @@
+#
+# Signals in the TCI IQ stream for f6ifyTCI.py, to snap the VFO to the nearest carrier
+# The IQ packets are read straight from the websocket (IqSocket), their samples are copied once into a
+# preallocated ring and the spectrum is computed at most FFT_RATE times per second on the newest samples,
+# whatever the IQ sample rate, so the CPU used does not grow with the stream
+# numpy is only needed when IQ_SNAP is on in f6ifyTCI.py
+
+import struct
+import time
+
+import numpy as np
+
+HEADER = struct.Struct("<8I")   # rx, sample rate, format, codec, crc, length, type, channels
+HEADER_SIZE = 64                # the 8 values and 32 reserved bytes
+IQ_STREAM = 0
+SAMPLE_TYPES = {0: np.int16, 2: np.int32, 3: np.float32}   # int24 is not handled
+SCALE = {0: 1 / 32768, 2: 1 / 2147483648, 3: 1.0}
+
+FFT_SIZE = 4096     # bins of the spectrum, 11.7 Hz at 48 kHz
+FFT_RATE = 20       # spectra per second at most
+AVERAGE = 0.3       # weight of the newest spectrum in the average
+THRESHOLD_DB = 10.0 # a peak is this much above the noise floor (median of the spectrum)
+MAX_AGE = 1.0       # seconds after which a spectrum is too old to snap on
+
+class IqRing:
+    # The newest samples, written twice (at i and i + size) so the last n samples are always one
+    # contiguous view of the buffer, never copied to be read
+    def __init__(self, size):
+        self.size = size
+        self.buf = np.zeros(2 * size, np.complex64)
+        self.pos = 0
+        self.count = 0
+
+    def write(self, samples):
+        n = len(samples)
+        if n >= self.size:
+            samples = samples[-self.size:]
+            n = self.size
+        end = self.pos + n
+        if end <= self.size:
+            self.buf[self.pos:end] = samples
+            self.buf[self.pos + self.size:end + self.size] = samples
+        else:
+            first = self.size - self.pos
+            self.buf[self.pos:self.size] = samples[:first]
+            self.buf[self.pos + self.size:] = samples[:first]
+            self.buf[:n - first] = samples[first:]
+            self.buf[self.size:self.size + n - first] = samples[first:]
+        self.pos = end % self.size
+        self.count += n
+
+    def last(self, n):
+        return self.buf[self.pos + self.size - n:self.pos + self.size]
+
+class PeakDetector:
+    # Spectrum and carriers of one receiver, the offsets are in Hz from the DDS frequency (center of the IQ)
+    def __init__(self, fft_size = FFT_SIZE, rate = FFT_RATE, threshold_db = THRESHOLD_DB):
+        self.fft_size = fft_size
+        self.period = 1 / rate
+        self.threshold_db = threshold_db
+        self.ring = IqRing(4 * fft_size)
+        self.window = np.hanning(fft_size).astype(np.float32)
+        self.average = None
+        self.sample_rate = 0
+        self.peaks = np.empty(0)    # sorted offsets in Hz
+        self.updated = 0.0          # time of the last spectrum
+        self.ffts = 0
+        self.samples = 0
+
+    def feed(self, samples, sample_rate, now = None):
+        # samples is a complex64 array (a view of the packet when it is float32)
+        if sample_rate != self.sample_rate:
+            self.sample_rate = sample_rate
+            self.average = None
+        self.ring.write(samples)
+        self.samples += len(samples)
+        now = time.perf_counter() if now is None else now
+        if self.ring.count >= self.fft_size and now - self.updated >= self.period:
+            self.updated = now
+            self.spectrum()
+
+    def reset(self, value = None):
+        # DDS moved: the samples and the spectrum are of the old panorama, a new one is made of new samples only
+        self.average = None
+        self.peaks = np.empty(0)
+        self.ring.count = 0
+
+    def spectrum(self):
+        power = np.abs(np.fft.fftshift(np.fft.fft(self.ring.last(self.fft_size) * self.window))) ** 2
+        if self.average is None:
+            self.average = power
+        else:
+            self.average += AVERAGE * (power - self.average)
+        db = 10 * np.log10(self.average + 1e-20)
+        floor = np.median(db)
+        mid = db[1:-1]
+        idx = np.flatnonzero((mid > floor + self.threshold_db) & (mid > db[:-2]) & (mid >= db[2:])) + 1
+        # parabolic interpolation between the bins around each peak
+        a, b, c = db[idx - 1], db[idx], db[idx + 1]
+        delta = 0.5 * (a - c) / np.where(a - 2 * b + c == 0, -1e-9, a - 2 * b + c)
+        self.peaks = (idx + delta - self.fft_size // 2) * (self.sample_rate / self.fft_size)
+        self.ffts += 1
+
+    def nearest(self, offset, up = None, min_step = 0.0, now = None):
+        # The carrier above (up True) or below (up False) offset by more than min_step, the closest one
+        # on either side when up is None. None if there is none or the spectrum is too old
+        now = time.perf_counter() if now is None else now
+        if not len(self.peaks) or now - self.updated > MAX_AGE:
+            return None
+        i = np.searchsorted(self.peaks, offset + min_step, "right")
+        above = float(self.peaks[i]) if i < len(self.peaks) else None
+        i = np.searchsorted(self.peaks, offset - min_step, "left") - 1
+        below = float(self.peaks[i]) if i >= 0 else None
+        if up is not None:
+            return above if up else below
+        if above is None or below is None:
+            return below if above is None else above
+        return above if above - offset < offset - below else below
+
+def iq_samples(buf):
+    # (rx, sample rate, complex64 samples) of a binary TCI packet, None if it is not IQ
+    # float32 samples are a view of the packet, the others are converted
+    rx, rate, fmt, _, _, length, kind, _ = HEADER.unpack_from(buf)
+    if kind != IQ_STREAM or fmt not in SAMPLE_TYPES:
+        return None
+    values = np.frombuffer(buf, SAMPLE_TYPES[fmt], length - length % 2, HEADER_SIZE)
+    if fmt == 3:
+        return rx, rate, values.view(np.complex64)
+    return rx, rate, (values.astype(np.float32) * SCALE[fmt]).view(np.complex64)
+
+class IqSocket:
+    # The websocket as seen by Listener._listen_main: the IQ packets go to the detector of their receiver
+    # and never reach the Listener, the other messages are returned
+    def __init__(self, ws, detectors):
+        self.ws = ws
+        self.detectors = detectors  # rx -> PeakDetector
+        self.packets = 0
+
+    async def recv(self):
+        while True:
+            msg = await self.ws.recv()
+            if not isinstance(msg, bytes):
+                return msg
+            iq = iq_samples(msg)
+            if iq is None:
+                return msg
+            detector = self.detectors.get(iq[0])
+            if detector is not None:
+                detector.feed(iq[2], iq[1])
+                self.packets += 1
+
+    def __getattr__(self, name):
+        return getattr(self.ws, name)
@@ -0,0 +1,136 @@
+#
+# Latency histograms for f6ifyTCI.py
+# The values are kept in log-linear buckets like the HDR histograms: exact up to 64 us,
+# then 32 buckets per power of 2 (about 3% precision), so recording is one dict update
+
+import asyncio
+import os
+
+SUB_BITS = 5
+SUB = 1 << SUB_BITS
+
+def bucket_index(us):
+    if us < 2 * SUB:
+        return us
+    shift = us.bit_length() - SUB_BITS - 1
+    return shift * SUB + (us >> shift)
+
+def bucket_value(idx):
+    # lowest value in us of the bucket
+    if idx < 2 * SUB:
+        return idx
+    shift = idx // SUB - 1
+    return (idx % SUB + SUB) << shift
+
+class Histogram:
+    def __init__(self):
+        self.counts = {}
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def record(self, seconds):
+        idx = bucket_index(max(0, int(seconds * 1e6)))
+        self.counts[idx] = self.counts.get(idx, 0) + 1
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    def percentile(self, q):
+        if self.count == 0:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for idx in sorted(self.counts):
+            seen += self.counts[idx]
+            if seen >= rank:
+                return bucket_value(idx) / 1e6
+        return self.max
+
+# The stages of a command, from the midi callback to the echo of the new value by ExpertSDR,
+# then the reconnects to ExpertSDR (from the disconnect and from the new connection to the first echo)
+# and the lateness of the CW keyer sends on their deadline (cw_keyer.py)
+STAGES = ("midi_queue", "handler", "out_queue", "total", "echo", "round_trip", "outage", "recovery", "jitter")
+
+class LatencyStats:
+    def __init__(self):
+        self.histograms = {}    # (command name, stage) -> Histogram
+        self.gauges = {}        # (metric name, labels) -> (function returning the value, "gauge" or "counter")
+
+    def add_gauge(self, name, labels, fn, kind = "gauge"):
+        # a value read when the stats are printed or exported, e.g. the depth of a queue
+        self.gauges[(name, labels)] = (fn, kind)
+
+    def remove_gauges(self, labels):
+        for key in [key for key in self.gauges if key[1] == labels]:
+            del self.gauges[key]
+
+    def record(self, name, stage, seconds):
+        h = self.histograms.get((name, stage))
+        if h is None:
+            h = self.histograms[(name, stage)] = Histogram()
+        h.record(seconds)
+
+    def record_send(self, name, trace, sent):
+        # trace is (midi callback, dequeue, handler exit) from midi_rx, sent is the time of the websocket send
+        t0, t1, t2 = trace
+        self.record(name, "midi_queue", t1 - t0)
+        self.record(name, "handler", t2 - t1)
+        self.record(name, "out_queue", sent - t2)
+        self.record(name, "total", sent - t0)
+
+    def clear(self):
+        self.histograms.clear()
+
+    def dump(self):
+        lines = [f"{'command':18s} {'stage':11s} {'count':>7s} {'p50 ms':>8s} {'p90 ms':>8s} {'p99 ms':>8s} {'max ms':>8s}"]
+        for (name, stage) in sorted(self.histograms, key = lambda k: (k[0], STAGES.index(k[1]))):
+            h = self.histograms[(name, stage)]
+            lines.append(f"{name:18s} {stage:11s} {h.count:7d} {h.percentile(0.5) * 1000:8.2f} "
+                         f"{h.percentile(0.9) * 1000:8.2f} {h.percentile(0.99) * 1000:8.2f} {h.max * 1000:8.2f}")
+        for (name, labels), (fn, kind) in sorted(self.gauges.items(), key = lambda item: item[0]):
+            lines.append(f"{name} {labels} {fn()}")
+        return "\n".join(lines)
+
+    def prometheus(self):
+        lines = ["# HELP f6ify_latency_seconds Latency of the TCI commands per stage",
+                 "# TYPE f6ify_latency_seconds summary"]
+        for (name, stage), h in sorted(self.histograms.items()):
+            labels = f'command="{name}",stage="{stage}"'
+            for q in (0.5, 0.9, 0.99):
+                lines.append(f'f6ify_latency_seconds{{{labels},quantile="{q}"}} {h.percentile(q):.6f}')
+            lines.append(f"f6ify_latency_seconds_sum{{{labels}}} {h.total:.6f}")
+            lines.append(f"f6ify_latency_seconds_count{{{labels}}} {h.count}")
+        typed = set()
+        for (name, labels), (fn, kind) in sorted(self.gauges.items(), key = lambda item: item[0]):
+            if name not in typed:
+                lines.append(f"# TYPE f6ify_{name} {kind}")
+                typed.add(name)
+            lines.append(f"f6ify_{name}{{{labels}}} {fn()}")
+        return "\n".join(lines) + "\n"
+
+    def write(self, path):
+        # written then renamed so a collector never reads half a file
+        with open(path + ".tmp", "w") as f:
+            f.write(self.prometheus())
+        os.replace(path + ".tmp", path)
+
+async def serve_metrics(stats, port, host = "127.0.0.1"):
+    # Minimal HTTP endpoint answering every request with the Prometheus text
+    async def handle(reader, writer):
+        try:
+            await reader.readuntil(b"\r\n\r\n")
+        except (asyncio.IncompleteReadError, asyncio.LimitOverrunError):
+            pass
+        body = stats.prometheus().encode()
+        writer.write(b"HTTP/1.0 200 OK\r\nContent-Type: text/plain; version=0.0.4\r\n"
+                     + f"Content-Length: {len(body)}\r\n\r\n".encode() + body)
+        await writer.drain()
+        writer.close()
+    return await asyncio.start_server(handle, host, port)
+
+async def write_metrics(stats, path, period = 10.0):
+    while True:
+        await asyncio.sleep(period)
+        stats.write(path)
@@ -0,0 +1,223 @@
+#
+# Mock TCI server, enough of ExpertSDR for f6ifyTCI.py to run without a radio
+# It sends the handshake and the initial state like ExpertSDR, then echoes every write as the new state
+# Usage: python mock_tci.py [port]   (50001 by default, like ExpertSDR)
+
+import asyncio
+import sys
+import time
+
+import websockets
+
+from eesdr_tci import tci
+
+HANDSHAKE = [
+    "PROTOCOL:ExpertSDR3,2.0;",
+    "DEVICE:SunSDR2PRO;",
+    "RECEIVE_ONLY:false;",
+    "TRX_COUNT:2;",
+    "CHANNELS_COUNT:2;",
+    "VFO_LIMITS:10000,500000000;",
+    "IF_LIMITS:-48000,48000;",
+    "MODULATIONS_LIST:AM,SAM,DSB,LSB,USB,CW,NFM,DIGL,DIGU,WFM,DRM;",
+]
+
+def initial_state():
+    # (name, rx, subrx) -> list of the parameters as strings
+    st = {("VOLUME", None, None): ["-10"], ("MUTE", None, None): ["false"],
+          ("MON_VOLUME", None, None): ["-20"], ("MON_ENABLE", None, None): ["false"]}
+    for rx, dds in ((0, 14025000), (1, 7025000)):
+        st.update({("DDS", rx, None): [str(dds)], ("MODULATION", rx, None): ["CW"],
+                   ("RX_ENABLE", rx, None): ["true" if rx == 0 else "false"],
+                   ("RX_FILTER_BAND", rx, None): ["-250", "250"], ("RIT_ENABLE", rx, None): ["false"],
+                   ("RIT_OFFSET", rx, None): ["0"], ("XIT_ENABLE", rx, None): ["false"],
+                   ("SPLIT_ENABLE", rx, None): ["false"], ("RX_MUTE", rx, None): ["false"],
+                   ("DRIVE", rx, None): ["50"], ("TRX", rx, None): ["false"], ("TUNE", rx, None): ["false"]})
+        for subrx in (0, 1):
+            st.update({("IF", rx, subrx): ["0"], ("VFO", rx, subrx): [str(dds)],
+                       ("RX_CHANNEL_ENABLE", rx, subrx): ["true" if subrx == 0 else "false"],
+                       ("RX_VOLUME", rx, subrx): ["0"], ("RX_BALANCE", rx, subrx): ["0"]})
+    return st
+
+def parse_command(cmd):
+    # (info, (name, rx, subrx), parameters as strings) of a command without its ";", None when unknown or malformed
+    name, _, args = cmd.partition(":")
+    info = tci.COMMANDS.get(name.upper())
+    if info is None:
+        return None
+    args = args.split(",") if args else []
+    try:
+        key = (info.name, int(args[0]) if info.has_rx else None, int(args[1]) if info.has_sub_rx else None)
+    except (ValueError, IndexError):
+        return None
+    return info, key, args[info.has_rx + info.has_sub_rx:]
+
+def format_command(key, params):
+    name, rx, subrx = key
+    args = [str(a) for a in (rx, subrx) if a is not None] + list(params)
+    return f"{name}:{','.join(args)};" if args else f"{name};"
+
+class MockTciServer:
+    def __init__(self, host = "127.0.0.1", port = 50001, echo_delay = 0.0, meter_rate = 0, handshake_delay = 0.0,
+                 iq_carriers = None):
+        self.host = host
+        self.port = port
+        self.handshake_delay = handshake_delay  # seconds before the handshake, ExpertSDR takes its time
+        self.echo_delay = echo_delay  # seconds before the new state is echoed, like the radio processing time
+        self.meter_rate = meter_rate  # RX_SMETER messages per second sent to every client, 0 = none
+        self.iq_carriers = iq_carriers or []  # (frequency in Hz, level in dBFS) in the IQ stream (IQ_START, numpy)
+        self.iq_packets = 0
+        self.handshake = list(HANDSHAKE)
+        self.state = initial_state()
+        self.received = []            # (time, command) of every command received
+        self.clients = set()
+        self.server = None
+
+    async def start(self):
+        self.server = await websockets.serve(self._client, self.host, self.port)
+        if self.port == 0:
+            self.port = next(iter(self.server.sockets)).getsockname()[1]
+        return self
+
+    async def stop(self):
+        self.server.close()
+        await self.server.wait_closed()
+
+    @property
+    def uri(self):
+        return f"ws://{self.host}:{self.port}"
+
+    async def _client(self, ws, *args):
+        self.clients.add(ws)
+        meters = asyncio.create_task(self._meters(ws)) if self.meter_rate else None
+        streams = {}                  # rx -> task sending its IQ
+        try:
+            if self.handshake_delay:
+                await asyncio.sleep(self.handshake_delay)
+            for line in self.handshake:
+                await ws.send(line)
+            for key, params in self.state.items():
+                await ws.send(format_command(key, params))
+            await ws.send("READY;")
+            async for message in ws:
+                if isinstance(message, bytes):
+                    continue
+                for cmd in message.split(";"):
+                    if cmd.strip():
+                        await self._command(ws, cmd.strip(), streams)
+        except websockets.ConnectionClosed:
+            pass
+        finally:
+            self.clients.discard(ws)
+            if meters:
+                meters.cancel()
+            for task in streams.values():
+                task.cancel()
+
+    async def _command(self, ws, cmd, streams = None):
+        self.received.append((time.perf_counter(), cmd + ";"))
+        name, _, args = cmd.partition(":")
+        name = name.upper()
+        if name in ("IQ_START", "IQ_STOP") and streams is not None:
+            rx = int(args)
+            if rx in streams:
+                streams.pop(rx).cancel()
+            if name == "IQ_START":
+                streams[rx] = asyncio.create_task(self._iq(ws, rx))
+            return
+        parsed = parse_command(cmd)
+        if parsed is None:
+            return  # unknown or malformed (DDS:x;), ignored like ExpertSDR does
+        info, key, params = parsed
+        if info.param_count >= 0:
+            params = params[:info.param_count]
+        if len(params) < info.param_count:
+            # a read, answer with the current value
+            if key in self.state:
+                await ws.send(format_command(key, self.state[key]))
+            return
+        echoes = self._write(key, params)
+        if self.echo_delay:
+            await asyncio.sleep(self.echo_delay)
+        for k in echoes:
+            for client in list(self.clients):
+                try:
+                    await client.send(format_command(k, self.state[k]))
+                except websockets.ConnectionClosed:
+                    pass
+
+    def seed(self, messages):
+        # The handshake and the state sent to the clients taken from messages of ExpertSDR, e.g. the start
+        # of a session log, so a replay starts from the radio as it was
+        names = [line.partition(":")[0] for line in self.handshake]
+        for msg in messages:
+            for cmd in msg.split(";"):
+                parsed = parse_command(cmd.strip())
+                if parsed is None or not parsed[2]:
+                    continue
+                info, key, params = parsed
+                if info.name in names:
+                    self.handshake[names.index(info.name)] = cmd.strip() + ";"
+                else:
+                    self.state[key] = params
+
+    def _write(self, key, params):
+        # Updates the state like the radio and returns the keys to echo
+        name, rx, subrx = key
+        if name == "IF":
+            value = max(-48000, min(48000, int(params[0])))
+            params = [str(value)]
+        self.state[key] = params
+        echoes = [key]
+        if name in ("DDS", "IF"):
+            for sub in (0, 1):
+                dds = int(self.state[("DDS", rx, None)][0])
+                self.state[("VFO", rx, sub)] = [str(dds + int(self.state[("IF", rx, sub)][0]))]
+                echoes.append(("VFO", rx, sub))
+        return echoes
+
+    async def _meters(self, ws):
+        while True:
+            await asyncio.sleep(1 / self.meter_rate)
+            await ws.send("RX_SMETER:0,0,-95;")
+
+    async def _iq(self, ws, rx, size = 2048):
+        # float32 IQ packets in real time, the carriers are at their frequency whatever the DDS, with noise
+        import numpy as np
+        from eesdr_tci.tci import TciDataPacket, TciSampleType, TciStreamType
+        rng = np.random.default_rng(rx)
+        phases = np.zeros(len(self.iq_carriers))
+        levels = np.array([10 ** (db / 20) for _, db in self.iq_carriers])[:, None]
+        k = np.arange(size)
+        loop = asyncio.get_running_loop()
+        deadline = loop.time()
+        while True:
+            rate = int(self.state.get(("IQ_SAMPLERATE", None, None), ["48000"])[0])
+            dds = int(self.state[("DDS", rx, None)][0])
+            steps = 2 * np.pi * np.array([f - dds for f, _ in self.iq_carriers]) / rate
+            iq = (levels * np.exp(1j * (phases[:, None] + steps[:, None] * k))).sum(axis = 0)
+            iq = iq + (rng.standard_normal(size) + 1j * rng.standard_normal(size)) * 1e-3
+            phases = (phases + steps * size) % (2 * np.pi)
+            data = iq.astype(np.complex64).tobytes()
+            await ws.send(TciDataPacket(rx, rate, TciSampleType.FLOAT32, 0, 0, 2 * size, TciStreamType.IQ_STREAM,
+                                        2, data).to_bytes())
+            self.iq_packets += 1
+            deadline += size / rate
+            await asyncio.sleep(max(0.0, deadline - loop.time()))
+
+    def counts(self, since = 0.0):
+        # number of commands received by name since the given time
+        res = {}
+        for t, cmd in self.received:
+            if t >= since:
+                name = cmd.partition(":")[0].rstrip(";").upper()
+                res[name] = res.get(name, 0) + 1
+        return res
+
+async def main(port):
+    server = await MockTciServer(port = port).start()
+    print(f"Mock TCI server on {server.uri}")
+    await asyncio.Future()
+
+if __name__ == "__main__":
+    asyncio.run(main(int(sys.argv[1]) if len(sys.argv) > 1 else 50001))
@@ -0,0 +1,235 @@
+#
+# Session log for f6ifyTCI.py: every midi event and every TCI message in and out, with their time
+# One record is a 11 bytes header (time in ns from perf_counter, kind, length) and the payload,
+# the file is read through mmap so a contest weekend is streamed, never loaded in memory
+# Usage: python session_log.py dump FILE
+#        python session_log.py replay FILE [--speed N] [--target script|ws://host:port] [--out FILE]
+#   speed 1 = real time, N = N times faster, 0 = as fast as possible
+#   target script: the midi events go into midi_rx talking to the mock TCI server (mock_tci.py)
+#   target uri: the recorded TCI commands are sent to this server (the mock server, not the radio!)
+
+import argparse
+import asyncio
+import contextlib
+import mmap
+import os
+import struct
+import sys
+import time
+from collections import deque
+
+MAGIC = b"F6LOG\x00\x01\x00"
+RECORD = struct.Struct("<QBH")   # time ns, kind, payload length
+
+META = 0      # "key=value" text, e.g. the midi port name
+MIDI_IN = 1   # the 3 midi bytes
+TCI_OUT = 2   # command sent to ExpertSDR
+TCI_IN = 3    # message received from ExpertSDR
+TCI_DATA = 4  # binary packet received (IQ, audio), only with data = True
+KINDS = {META: "meta", MIDI_IN: "midi", TCI_OUT: "out", TCI_IN: "in", TCI_DATA: "data"}
+
+class SessionRecorder:
+    # record() only packs the bytes and appends them to a deque (thread safe, the rtmidi thread uses it too),
+    # run() writes them to the file from an executor thread
+    def __init__(self, path, data = False):
+        self.path = path
+        self.data = data
+        self.pending = deque()
+        self.records = 0
+        self.file = open(path, "wb")
+        self.file.write(MAGIC)
+
+    def record(self, kind, payload, t_ns = None):
+        if t_ns is None:
+            t_ns = time.perf_counter_ns()
+        self.pending.append(RECORD.pack(t_ns, kind, len(payload)) + payload)
+
+    def meta(self, text):
+        self.record(META, text.encode())
+
+    def midi(self, ev):
+        # ev is (status, data1, data2, perf_counter time) from the midi callback
+        self.pending.append(RECORD.pack(int(ev[3] * 1e9), MIDI_IN, 3) + bytes(ev[:3]))
+
+    def wrap_midi(self, callback):
+        def recording_callback(ev):
+            self.midi(ev)
+            callback(ev)
+        return recording_callback
+
+    def tci_out(self, cmd):
+        self.record(TCI_OUT, cmd.encode())
+
+    def wrap_socket(self, ws):
+        return RecordingSocket(ws, self)
+
+    def flush(self):
+        chunks = []
+        pending = self.pending
+        for _ in range(len(pending)):
+            chunks.append(pending.popleft())
+        if chunks:
+            self.file.write(b"".join(chunks))
+            self.file.flush()
+            self.records += len(chunks)
+
+    async def run(self, period = 1.0):
+        loop = asyncio.get_running_loop()
+        while True:
+            await asyncio.sleep(period)
+            await loop.run_in_executor(None, self.flush)
+
+    def close(self):
+        self.flush()
+        self.file.close()
+
+class RecordingSocket:
+    # The websocket as seen by Listener._listen_main, recv() records what it returns
+    def __init__(self, ws, recorder):
+        self.ws = ws
+        self.recorder = recorder
+
+    async def recv(self):
+        msg = await self.ws.recv()
+        if isinstance(msg, bytes):
+            if self.recorder.data:
+                self.recorder.record(TCI_DATA, msg)
+        else:
+            self.recorder.record(TCI_IN, msg.encode())
+        return msg
+
+    def __getattr__(self, name):
+        return getattr(self.ws, name)
+
+def read_records(path):
+    # yield (time ns, kind, payload) without reading the whole file, a truncated last record is ignored
+    with open(path, "rb") as f, mmap.mmap(f.fileno(), 0, access = mmap.ACCESS_READ) as m:
+        if m[:len(MAGIC)] != MAGIC:
+            raise ValueError(f"{path} is not a session log")
+        pos = len(MAGIC)
+        end = len(m)
+        header = RECORD.size
+        while pos + header <= end:
+            t_ns, kind, n = RECORD.unpack_from(m, pos)
+            pos += header
+            if pos + n > end:
+                break
+            yield t_ns, kind, m[pos:pos + n]
+            pos += n
+
+async def replay(records, handlers, speed = 1.0):
+    # handlers is kind -> function(payload, t), a coroutine function is awaited, t is the time of the record
+    # moved to now (perf_counter): the midi events keep their recorded spacing, divided by speed
+    # The time between the records is kept too, speed 0 = as fast as possible. The loop yields after every
+    # record, the tasks fed by the handlers (midi_rx) run between two records as in the session
+    start = None
+    count = 0
+    for t_ns, kind, payload in records:
+        fn = handlers.get(kind)
+        if fn is None:
+            continue
+        if start is None:
+            start = (t_ns, time.perf_counter())
+        t = start[1] + (t_ns - start[0]) / 1e9 / (speed or 1)
+        if speed and t > time.perf_counter():
+            await asyncio.sleep(t - time.perf_counter())
+        else:
+            await asyncio.sleep(0)
+        res = fn(payload, t)
+        if asyncio.iscoroutine(res):
+            await res
+        count += 1
+    return count
+
+def session_start(path):
+    # the messages of ExpertSDR before the first midi event: its handshake and state when the session began
+    messages = []
+    for _, kind, payload in read_records(path):
+        if kind == MIDI_IN:
+            break
+        if kind == TCI_IN:
+            messages.append(bytes(payload).decode(errors = "replace"))
+    return messages
+
+def find_meta(path, key):
+    for _, kind, payload in read_records(path):
+        if kind == META:
+            k, _, v = bytes(payload).decode().partition("=")
+            if k == key:
+                return v
+    return None
+
+async def replay_to_script(path, speed, out = None):
+    # The recorded midi events go into midi_rx, talking to the mock TCI server
+    from mock_tci import MockTciServer
+    from synthetic_midi import open_deck, open_link
+    server = MockTciServer(port = 0)
+    server.seed(session_start(path))
+    await server.start()
+    recorder = SessionRecorder(out) if out else None
+    link = await open_link(server.uri, lambda link: setattr(link, "recorder", recorder))
+    port = find_meta(path, "midi_port") or "DJControl Starlight 0"
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        deck, rx, midi_in = await open_deck(link, port)
+        start = time.perf_counter()
+        count = await replay(read_records(path), {MIDI_IN: lambda p, t: midi_in((p[0], p[1], p[2], t))}, speed)
+        await asyncio.sleep(0.2)   # the last writes and their echoes
+        elapsed = time.perf_counter() - start
+    rx.cancel()
+    link.shutdown()
+    await server.stop()
+    if recorder:
+        recorder.close()
+    print(f"{count} midi events of {port} replayed in {elapsed:.2f} s, {deck.events} handled")
+    print(", ".join(f"{n} {c}" for n, c in sorted(server.counts().items())))
+    print(link.stats.dump())
+
+async def replay_to_server(path, speed, uri):
+    # The recorded TCI commands are sent to a TCI server, the messages received are counted
+    import websockets
+    async with websockets.connect(uri) as ws:
+        received = 0
+        async def drain():
+            nonlocal received
+            async for _ in ws:
+                received += 1
+        reader = asyncio.create_task(drain())
+        start = time.perf_counter()
+        count = await replay(read_records(path), {TCI_OUT: lambda p, t: ws.send(bytes(p).decode())}, speed)
+        await asyncio.sleep(0.2)
+        reader.cancel()
+    print(f"{count} TCI commands sent to {uri} in {time.perf_counter() - start:.2f} s, {received} messages received")
+
+def dump(path):
+    first = None
+    for t_ns, kind, payload in read_records(path):
+        if first is None:
+            first = t_ns
+        if kind == MIDI_IN:
+            text = " ".join(f"{b:02X}" for b in payload)
+        elif kind == TCI_DATA:
+            text = f"{len(payload)} bytes"
+        else:
+            text = bytes(payload).decode(errors = "replace")
+        print(f"{(t_ns - first) / 1e6:12.3f} {KINDS.get(kind, kind):5s} {text}")
+
+def main():
+    parser = argparse.ArgumentParser(description = "Session log of f6ifyTCI.py")
+    parser.add_argument("action", choices = ["dump", "replay"])
+    parser.add_argument("file")
+    parser.add_argument("--speed", type = float, default = 1.0, help = "1 = real time, 0 = as fast as possible")
+    parser.add_argument("--target", default = "script", help = "script or the uri of a TCI server")
+    parser.add_argument("--out", help = "records the TCI commands sent by the script during the replay")
+    args = parser.parse_args()
+    if args.action == "dump":
+        dump(args.file)
+    elif args.target == "script":
+        asyncio.run(replay_to_script(args.file, args.speed, args.out))
+    else:
+        asyncio.run(replay_to_server(args.file, args.speed, args.target))
+
+if __name__ == "__main__":
+    try:
+        main()
+    except BrokenPipeError:   # dump | head
+        sys.stderr.close()
@@ -0,0 +1,111 @@
+#
+# Synthetic DJControl Compact and Starlight for the benchmarks of f6ifyTCI.py
+# A gesture is a list of (delay in seconds, (status, data1, data2)), played from a thread
+# into the same callback as the real midi input. open_link() and open_deck() run the script on a TCI server
+# (mock_tci.py) with such a callback as its midi input
+
+import asyncio
+import threading
+import time
+
+from f6ifyTCI import DJ, DJS, MIDI, Deck, TciLink, midi_rx, update_params
+
+class SyntheticController:
+    LAYOUTS = {
+        # port name, jog, RIT jog, crossfader, volume pot, a toggle button, PTT button
+        "DJ": ("DJControl Compact 0", (0xB0, DJ.JOGA), (0xB0, DJ.JOGB), (0xB0, DJ.CROSSFADER),
+               (0xB0, DJ.POTVOLUMEA), (0x90, DJ.BTN_AUTOMIX), (0x90, DJ.BTN_3A)),
+        "DJS": ("DJControl Starlight 0", (0xB1, DJS.JOG), (0xB2, DJS.JOG), (0xB0, DJS.CROSSFADER),
+                (0xB0, DJS.POTVOLUME1), (0x92, DJS.BTN_HOT), (0x96, DJS.BTN_3)),
+    }
+
+    def __init__(self, layout = "DJS"):
+        self.layout = layout
+        (self.port, self.jog, self.rit_jog, self.crossfader,
+         self.volume, self.toggle, self.ptt) = SyntheticController.LAYOUTS[layout]
+
+    def jog_spin(self, ticks = 500, fastest = 0.001, slowest = 0.010, direction = 1, jog = None):
+        # The hand accelerates to the fastest tick interval then slows down, like a real spin
+        status, control = jog or self.jog
+        value = MIDI.ENCUP if direction > 0 else MIDI.ENCDOWN
+        events = []
+        for i in range(ticks):
+            x = abs(2 * i / max(ticks - 1, 1) - 1)   # 1 -> 0 -> 1
+            events.append((fastest + (slowest - fastest) * x, (status, control, value)))
+        return events
+
+    def rit_spin(self, ticks = 100):
+        return self.jog_spin(ticks, jog = self.rit_jog)
+
+    def fader_sweep(self, seconds = 0.5, control = None):
+        # every position from 0 to 127 and back, as the fader sends them
+        status, number = control or self.crossfader
+        values = list(range(128)) + list(range(127, -1, -1))
+        return [(seconds / len(values), (status, number, v)) for v in values]
+
+    def volume_sweep(self, seconds = 0.5):
+        return self.fader_sweep(seconds, self.volume)
+
+    def filter_sweep(self, seconds = 0.5):
+        # the pot of the low edge of the filter (bass)
+        return self.fader_sweep(seconds, (0xB0, DJ.POTBASSA) if self.layout == "DJ" else (0xB1, DJS.POTBASS))
+
+    def button_storm(self, presses = 50, interval = 0.03, button = None):
+        status, note = button or self.toggle
+        events = []
+        for _ in range(presses):
+            events.append((interval / 2, (status, note, MIDI.KEYDOWN)))
+            events.append((interval / 2, (status, note, MIDI.KEYUP)))
+        return events
+
+    def ptt_storm(self, presses = 20, interval = 0.05):
+        return self.button_storm(presses, interval, self.ptt)
+
+    def flood(self, count = 20000):
+        # the jog events without any delay, for the throughput
+        status, control = self.jog
+        return [(0, (status, control, MIDI.ENCUP))] * count
+
+def play(events, callback, speed = 1.0):
+    # Sends the events to the callback with their timing, speed 0 = as fast as possible
+    next_t = time.perf_counter()
+    for delay, (status, data1, data2) in events:
+        if speed and delay:
+            next_t += delay / speed
+            while True:
+                left = next_t - time.perf_counter()
+                if left <= 0:
+                    break
+                if left > 0.002:
+                    time.sleep(left - 0.001)
+        callback((status, data1, data2, time.perf_counter()))
+
+def play_in_thread(events, callback, speed = 1.0):
+    thread = threading.Thread(target = play, args = (events, callback, speed), daemon = True)
+    thread.start()
+    return thread
+
+async def open_link(uri, prepare = None):
+    # A TciLink keeping the radio state like main() does, connected to uri and past the handshake
+    # prepare(link), a coroutine function or not, is called before the connection (proxy, recorder, IQ snap...)
+    link = TciLink(uri)
+    link.add_param_listener("*", update_params)
+    if prepare is not None:
+        res = prepare(link)
+        if asyncio.iscoroutine(res):
+            await res
+    await link.start()
+    await link.ready()
+    return link
+
+async def open_deck(link, port, **kwargs):
+    # (deck, midi_rx task, midi callback) of a controller on port driving the link, the gestures are played
+    # into the callback; kwargs go to midi_rx (open_output)
+    callbacks = []
+    deck = Deck(link, port)
+    task = asyncio.create_task(midi_rx(link, port, open_input = lambda p, cb: callbacks.append(cb), deck = deck, **kwargs))
+    while not callbacks:
+        if task.done():
+            task.result()   # midi_rx failed before opening the input
+        await asyncio.sleep(0.001)
+    return deck, task, callbacks[0]
@@ -0,0 +1,237 @@
+#
+# Local TCI server for f6ifyTCI.py: the logger, the skimmer... share its connection to ExpertSDR
+# A new client gets the handshake and the state from the cache of the link at once, then every message of
+# ExpertSDR. Its writes go into the queues of the link like the controller's, its reads are answered from the
+# cache. The meters are sent to each client at its own rate (PROXY_METER_RATE, or the interval of its
+# RX/TX_SENSORS_ENABLE) and the IQ and audio streams only to the clients which started them
+
+import struct
+import time
+
+import websockets
+
+from eesdr_tci import tci
+
+HANDSHAKE = ("PROTOCOL", "DEVICE", "RECEIVE_ONLY", "TRX_COUNT", "CHANNELS_COUNT", "VFO_LIMITS", "IF_LIMITS",
+             "MODULATIONS_LIST")
+METERS = {"RX_SMETER": "RX", "RX_SENSORS": "RX", "RX_CHANNEL_SENSORS": "RX",
+          "TX_POWER": "TX", "TX_SWR": "TX", "TX_SENSORS": "TX"}
+EVENTS = {"READY", "START", "STOP", "SPOT", "SPOT_DELETE", "SPOT_CLEAR", "CLICKED_ON_SPOT", "RX_CLICKED_ON_SPOT"}
+STREAMS = {"IQ_START": ("IQ", True), "IQ_STOP": ("IQ", False), "AUDIO_START": ("AUDIO", True),
+           "AUDIO_STOP": ("AUDIO", False)}
+HEADER = struct.Struct("<8I")
+STREAM_BUFFER = 256 * 1024  # bytes waiting to be sent to a client above which its IQ and audio packets are dropped
+READY_TIMEOUT = 10  # seconds a new client waits for the handshake of ExpertSDR before it is closed
+
+def tci_value(value):
+    if value is True or value is False:
+        return "true" if value else "false"
+    if isinstance(value, (list, tuple)):
+        return ",".join(tci_value(v) for v in value)
+    return str(value)
+
+def format_state(key, value):
+    name, rx, subrx = key
+    args = [str(a) for a in (rx, subrx) if a is not None]
+    if value is not None:
+        args.append(tci_value(value))
+    return f"{name}:{','.join(args)};" if args else f"{name};"
+
+class ProxyClient:
+    def __init__(self, ws, meter_interval):
+        self.ws = ws
+        self.intervals = {"RX": meter_interval, "TX": meter_interval}  # seconds between two values of a meter
+        self.sensors = {"RX": None, "TX": None}  # interval in ms of the RX/TX_SENSORS_ENABLE of the client
+        self.last_meter = {}    # meter key -> time sent
+        self.streams = set()    # ("IQ" or "AUDIO", rx) started by the client
+        self.commands = 0
+
+class TciProxy:
+    def __init__(self, link, host = "127.0.0.1", port = 50002, meter_rate = 5, stream_buffer = STREAM_BUFFER):
+        self.link = link
+        self.host = host
+        self.port = port
+        self.meter_interval = 1 / meter_rate if meter_rate else None  # None: only after RX/TX_SENSORS_ENABLE
+        self.stream_buffer = stream_buffer
+        self.clients = set()
+        self.server = None
+        self.running = None     # "START" or "STOP", the last one sent by ExpertSDR
+        self.sensors = {}       # "RX" / "TX" -> interval in ms asked upstream
+        self.forwarded = 0      # messages sent to the clients
+        self.filtered = 0       # meter values and stream packets not sent to a client (not wanted or not read)
+        self.rejected = 0       # malformed commands of the clients, never sent to ExpertSDR
+
+    async def start(self):
+        self.server = await websockets.serve(self._client, self.host, self.port)
+        if self.port == 0:
+            self.port = next(iter(self.server.sockets)).getsockname()[1]
+        return self
+
+    async def stop(self):
+        self.server.close()
+        await self.server.wait_closed()
+
+    def wrap_socket(self, ws):
+        return ProxySocket(ws, self)
+
+    def own_streams(self):
+        # the streams the link asks for itself (IQ_SNAP), never stopped for the clients
+        res = set()
+        for cmd in self.link.start_cmds:
+            name, _, rx = cmd.rstrip(";").partition(":")
+            if name in STREAMS and STREAMS[name][1]:
+                res.add((STREAMS[name][0], int(rx)))
+        return res
+
+    def snapshot(self):
+        # the handshake and the state as ExpertSDR sends them to a new client
+        items = dict(self.link.radio.state.items())
+        lines = [format_state(key, items.pop(key)) for name in HANDSHAKE for key in list(items) if key[0] == name]
+        lines += [format_state(key, value) for key, value in items.items() if key[0] not in EVENTS and key[0] not in METERS]
+        lines.append("READY;")
+        if self.running:
+            lines.append(f"{self.running};")
+        return lines
+
+    async def _client(self, ws, *args):
+        client = ProxyClient(ws, self.meter_interval)
+        try:
+            try:
+                await self.link.ready(READY_TIMEOUT)
+            except TimeoutError:   # ExpertSDR is down or reconnecting, the client can try again
+                await ws.close(1013, "ExpertSDR not ready")
+                return
+            # the state is queued and the client added without waiting, the next message of ExpertSDR goes after it
+            for line in self.snapshot():
+                websockets.broadcast([ws], line)
+            self.clients.add(client)
+            async for message in ws:
+                if isinstance(message, bytes):   # the TX audio of the clients is not forwarded
+                    continue
+                for cmd in message.split(";"):
+                    if cmd.strip():
+                        self._command(client, cmd.strip())
+        except websockets.ConnectionClosed:
+            pass
+        finally:
+            self.clients.discard(client)
+            for kind, rx in list(client.streams):
+                self._stream(client, kind, rx, False)
+            self._sensors()
+
+    def _command(self, client, cmd):
+        # a malformed command (DDS:x;, IF:0,0,abc;) is dropped: applied to our state at its send,
+        # it would break the handlers of the controller
+        client.commands += 1
+        try:
+            if self._local(client, cmd):
+                return
+        except ValueError:
+            self.rejected += 1
+            return
+        if self.link.radio.pending_writes.malformed(cmd + ";"):
+            self.rejected += 1
+            return
+        self.link.send_nowait(cmd + ";")
+
+    def _local(self, client, cmd):
+        # True when the command is handled here: streams, sensors and reads of a known value
+        name, _, args = cmd.partition(":")
+        name = name.upper()
+        args = args.split(",") if args else []
+        if name in STREAMS:
+            self._stream(client, STREAMS[name][0], int(args[0]) if args else 0, STREAMS[name][1])
+            return True
+        if name in ("RX_SENSORS_ENABLE", "TX_SENSORS_ENABLE"):
+            on = bool(args) and args[0].lower() == "true"
+            ms = int(args[1]) if len(args) > 1 else 200
+            client.sensors[name[:2]] = ms if on else None
+            client.intervals[name[:2]] = ms / 1000 if on else self.meter_interval
+            self._sensors()
+            return True
+        info = tci.COMMANDS.get(name)
+        if info is not None and info.param_count > 0 and len(args) == info.has_rx + info.has_sub_rx:
+            key = (name, int(args[0]) if info.has_rx else None, int(args[1]) if info.has_sub_rx else None)
+            state = self.link.radio.state
+            if state.has(*key):     # a read, answered from the cache
+                websockets.broadcast([client.ws], format_state(key, state.get(*key)))
+                return True
+        return False
+
+    def _stream(self, client, kind, rx, start):
+        # a stream runs upstream while a client or the link itself wants it
+        key = (kind, rx)
+        wanted = lambda: key in self.own_streams() or any(key in c.streams for c in self.clients if c is not client)
+        if start and key not in client.streams:
+            if not wanted():
+                self.link.send_nowait(f"{kind}_START:{rx};")
+            client.streams.add(key)
+        elif not start and key in client.streams:
+            client.streams.discard(key)
+            if not wanted():
+                self.link.send_nowait(f"{kind}_STOP:{rx};")
+
+    def _sensors(self):
+        # the sensors are enabled upstream at the fastest interval asked by a client
+        for side in ("RX", "TX"):
+            asked = [c.sensors[side] for c in self.clients if c.sensors[side] is not None]
+            ms = min(asked) if asked else None
+            if ms != self.sensors.get(side):
+                self.sensors[side] = ms
+                self.link.send_nowait(f"{side}_SENSORS_ENABLE:true,{ms};" if ms else f"{side}_SENSORS_ENABLE:false;")
+
+    def _resume(self):
+        # a new session with ExpertSDR (restarted): the streams and the sensors of the clients are asked again
+        for kind, rx in set().union(*(c.streams for c in self.clients)) - self.own_streams():
+            self.link.send_nowait(f"{kind}_START:{rx};")
+        self.sensors.clear()
+        self._sensors()
+
+    def broadcast(self, msg):
+        # a message of ExpertSDR to the clients which want it
+        if isinstance(msg, str) and msg[:5].upper() in ("START", "STOP;", "READY"):
+            if msg[:5].upper() == "READY":
+                self._resume()
+            else:
+                self.running = msg.rstrip(";").upper()
+        if not self.clients:
+            return
+        if isinstance(msg, bytes):
+            rx, _, _, _, _, _, kind, _ = HEADER.unpack_from(msg)
+            key = ("IQ" if kind == 0 else "AUDIO", rx)
+            # websockets.broadcast does not wait: a client which does not read (stalled skimmer) would keep
+            # every packet in memory, they are dropped while too much is waiting for it
+            to = [c.ws for c in self.clients
+                  if key in c.streams and c.ws.transport.get_write_buffer_size() < self.stream_buffer]
+        else:
+            name = msg.partition(":")[0].rstrip(";").upper()
+            side = METERS.get(name)
+            if side is None:
+                to = [c.ws for c in self.clients]
+            else:
+                now = time.monotonic()
+                meter = msg.rpartition(",")[0] or name
+                to = []
+                for c in self.clients:
+                    interval = c.intervals[side]
+                    if interval is not None and now - c.last_meter.get(meter, 0.0) >= interval:
+                        c.last_meter[meter] = now
+                        to.append(c.ws)
+        self.filtered += len(self.clients) - len(to)
+        if to:
+            websockets.broadcast(to, msg)
+            self.forwarded += len(to)
+
+class ProxySocket:
+    # The websocket as seen by Listener._listen_main, what it returns is sent to the clients
+    def __init__(self, ws, proxy):
+        self.ws = ws
+        self.proxy = proxy
+
+    async def recv(self):
+        msg = await self.ws.recv()
+        self.proxy.broadcast(msg)
+        return msg
+
+    def __getattr__(self, name):
+        return getattr(self.ws, name)